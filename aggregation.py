@@ -0,0 +1,263 @@
+"""
+Windowed aggregation of DTSU666 values
+
+A WindowAggregator sits after the reader and keeps running windows of
+e.g. 1 s, 1 min and 15 min, aligned to the wall clock. Every sample
+updates each window in constant time:
+- time-weighted average (trapezoidal area / covered time), min and max
+- import/export energy, the trapezoidal integral of Total_Active_Power
+  split at zero crossings (positive power = import from the grid)
+
+Segments are interpolated at window boundaries, so a window covers
+exactly its own time span. Registers missing from a poll cycle are held
+at their last value up to the boundary; samples further apart than
+max_gap (meter offline, restart) are not integrated.
+
+A window closes with the first sample after its end. If no sample comes
+(meter offline, breaker open), run() closes it on a timer max_gap seconds
+after its end, when no later sample could be integrated into it anyway.
+Such a window ends at the last sample, nothing is held beyond it.
+Windows skipped by a late sample are closed one by one, so those with
+held or interpolated values are published as well.
+
+When a window closes its document is published on
+<prefix>/aggregate/<window>, e.g. dtsu666/aggregate/1min:
+
+    {"timestamp": "...", "window": 60, "samples": 60,
+     "Total_Active_Power_avg": 1234.5, "Total_Active_Power_min": ..., "Total_Active_Power_max": ...,
+     "Import_Energy_Wh": 20.6, "Export_Energy_Wh": 0.0,
+     "Integrated_Import_Energy": 12.3456, "Integrated_Export_Energy": 1.2345}
+
+The Integrated_*_Energy totals (kWh) run since the gateway started.
+"""
+
+import asyncio
+import time
+from datetime import datetime
+
+from dtsu666_constants import TOTAL_ACTIVE_POWER
+from poll_scheduler import resolve_register
+from register_profile import REGISTER_TABLE
+
+DEFAULT_WINDOWS = (1, 60, 900)
+DEFAULT_REGISTERS = ("Total_Active_Power", "Active_Power_Phase_A", "Active_Power_Phase_B",
+                     "Active_Power_Phase_C")
+DEFAULT_MAX_GAP = 10.0
+
+
+def window_label(seconds: int) -> str:
+    """Topic suffix of a window: 1s, 1min, 15min, 1h"""
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}h"
+    if seconds % 60 == 0:
+        return f"{seconds // 60}min"
+    return f"{seconds}s"
+
+
+def split_area(t0: float, v0: float, t1: float, v1: float):
+    """Trapezoidal area of a segment as (positive, negative) part, split at the zero crossing"""
+    dt = t1 - t0
+    if v0 >= 0 and v1 >= 0:
+        return (v0 + v1) / 2 * dt, 0.0
+    if v0 <= 0 and v1 <= 0:
+        return 0.0, -(v0 + v1) / 2 * dt
+    crossing = dt * v0 / (v0 - v1)
+    if v0 > 0:
+        return v0 / 2 * crossing, -v1 / 2 * (dt - crossing)
+    return v1 / 2 * (dt - crossing), -v0 / 2 * crossing
+
+
+class _Accumulator:
+    __slots__ = ("positive", "negative", "duration", "min", "max", "sum", "samples", "cursor")
+
+    def __init__(self):
+        self.cursor = None
+        self.reset()
+
+    def reset(self):
+        self.positive = 0.0
+        self.negative = 0.0
+        self.duration = 0.0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.samples = 0
+
+    def integrate(self, t: float, value: float):
+        """Extends the integral from the cursor to (t, value)"""
+        t0, v0 = self.cursor
+        positive, negative = split_area(t0, v0, t, value)
+        self.positive += positive
+        self.negative += negative
+        self.duration += t - t0
+        self.cursor = (t, value)
+
+    def sample(self, value: float):
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sum += value
+        self.samples += 1
+
+    def average(self):
+        if self.duration > 0:
+            return (self.positive - self.negative) / self.duration
+        return self.sum / self.samples if self.samples else None
+
+
+class _Window:
+    __slots__ = ("length", "start", "end", "accumulators")
+
+    def __init__(self, length: int, keys, now: float):
+        self.length = length
+        self.accumulators = {key: _Accumulator() for key in keys}
+        self.align(now)
+
+    def align(self, now: float):
+        self.start = now - now % self.length
+        self.end = self.start + self.length
+
+
+class WindowAggregator:
+    """Running windows over the values of one meter"""
+
+    def __init__(self, windows=DEFAULT_WINDOWS, registers=DEFAULT_REGISTERS,
+                 energy_register=TOTAL_ACTIVE_POWER, max_gap: float = DEFAULT_MAX_GAP, clock=time.time):
+        self.keys = tuple(resolve_register(register) for register in registers)
+        self.energy_register = resolve_register(energy_register)
+        if self.energy_register not in self.keys:
+            self.keys += (self.energy_register,)
+        self.max_gap = max_gap
+        self.clock = clock
+        self.windows = [_Window(int(length), self.keys, clock()) for length in sorted(windows)]
+        self.labels = {window.length: window_label(window.length) for window in self.windows}
+        self.import_wh = 0.0
+        self.export_wh = 0.0
+        self._last = {}
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Creates the aggregator from cfg["aggregation"], or returns None if it is disabled"""
+        ag_cfg = cfg.get("aggregation", {})
+        if not ag_cfg.get("enabled", False):
+            return None
+        return cls(windows=ag_cfg.get("windows", DEFAULT_WINDOWS),
+                   registers=ag_cfg.get("registers", DEFAULT_REGISTERS),
+                   max_gap=ag_cfg.get("max_gap", DEFAULT_MAX_GAP))
+
+    def add(self, values: dict, timestamp: float = None) -> list:
+        """
+        Adds the values {address: value} of one poll cycle.
+
+        Returns (window label, document) for every window that closed.
+        """
+        t = self.clock() if timestamp is None else timestamp
+        samples = {}
+        for key in self.keys:
+            value = values.get(key)
+            if value is None:
+                continue
+            last = self._last.get(key)
+            # not contiguous: first sample or after a gap, the segment before it is not integrated
+            samples[key] = (value, last is not None and 0 < t - last[0] <= self.max_gap)
+
+        energy = samples.get(self.energy_register)
+        if energy is not None and energy[1]:
+            positive, negative = split_area(*self._last[self.energy_register], t, energy[0])
+            self.import_wh += positive / 3600
+            self.export_wh += negative / 3600
+
+        closed = []
+        for window in self.windows:
+            closed.extend(self._close(window, samples, t, t))
+            for key, (value, contiguous) in samples.items():
+                accumulator = window.accumulators[key]
+                if contiguous and accumulator.cursor is not None:
+                    accumulator.integrate(t, value)
+                else:
+                    accumulator.cursor = (t, value)
+                accumulator.sample(value)
+
+        for key, (value, _) in samples.items():
+            self._last[key] = (t, value)
+        return closed
+
+    def close_due(self, now: float = None) -> list:
+        """
+        Closes the windows that ended more than max_gap seconds ago without
+        a sample after them. Returns (window label, document) for each.
+        """
+        now = self.clock() if now is None else now
+        closed = []
+        for window in self.windows:
+            closed.extend(self._close(window, None, now, now - self.max_gap))
+        return closed
+
+    async def run(self, publish, stop_event: asyncio.Event):
+        """Calls publish(window label, document) for windows closed by close_due until stop_event is set"""
+        tick = min(1.0, self.windows[0].length)
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=tick)
+            except asyncio.TimeoutError:
+                for label, document in self.close_due():
+                    publish(label, document)
+
+    def _close(self, window: _Window, samples, t: float, until: float) -> list:
+        """Closes the window and its successors that end at or before until, samples is None on the timer"""
+        closed = []
+        while until >= window.end:
+            self._extend(window, window.end, samples, t)
+            document = self._document(window)
+            if document is not None:
+                closed.append((self.labels[window.length], document))
+            for accumulator in window.accumulators.values():
+                accumulator.reset()
+            window.start, window.end = window.end, window.end + window.length
+            if until >= window.end and all(accumulator.cursor is None
+                                           for accumulator in window.accumulators.values()):
+                # nothing is held or interpolated into the skipped windows, they stay empty
+                window.align(until)
+        return closed
+
+    def _extend(self, window: _Window, boundary: float, samples, t: float):
+        """Integrates every register up to the window boundary"""
+        for key, accumulator in window.accumulators.items():
+            if accumulator.cursor is None:
+                continue
+            if samples is None:
+                # closed by the timer: no sample came after the cursor, the integral ends there
+                accumulator.cursor = None
+                continue
+            t0, v0 = accumulator.cursor
+            sample = samples.get(key)
+            if sample is not None and sample[1]:
+                # interpolate between the cursor and the new sample
+                value = v0 + (sample[0] - v0) * (boundary - t0) / (t - t0)
+            elif sample is None and boundary - self._last[key][0] <= self.max_gap:
+                value = v0
+            else:
+                accumulator.cursor = None
+                continue
+            accumulator.integrate(boundary, value)
+
+    def _document(self, window: _Window):
+        samples = max(accumulator.samples for accumulator in window.accumulators.values())
+        if not samples and not any(accumulator.duration for accumulator in window.accumulators.values()):
+            return None
+        doc = {"timestamp": datetime.fromtimestamp(window.end).isoformat(), "window": window.length,
+               "samples": samples}
+        for key, accumulator in window.accumulators.items():
+            name = REGISTER_TABLE[key].name
+            average = accumulator.average()
+            if average is None:
+                continue
+            doc[f"{name}_avg"] = round(average, 3)
+            if accumulator.samples:
+                doc[f"{name}_min"] = accumulator.min
+                doc[f"{name}_max"] = accumulator.max
+        energy = window.accumulators[self.energy_register]
+        doc["Import_Energy_Wh"] = round(energy.positive / 3600, 4)
+        doc["Export_Energy_Wh"] = round(energy.negative / 3600, 4)
+        doc["Integrated_Import_Energy"] = round(self.import_wh / 1000, 6)
+        doc["Integrated_Export_Energy"] = round(self.export_wh / 1000, 6)
+        return doc
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for windowed aggregation
+
+Feeds simulated poll cycles into a WindowAggregator with 1 s, 1 min and
+15 min windows, then stops the meter and lets close_due() close the
+remaining windows on the timer. Checks that the energy of the 1 s
+windows and of every other window length adds up to the integrated
+import/export energy.
+
+Usage: python -m benchmarks.aggregation_bench [--number 20000] [--interval 2]
+"""
+
+import argparse
+import random
+import time
+
+from aggregation import WindowAggregator
+from dtsu666_constants import FOUR_WIRE_KEYS, TOTAL_ACTIVE_POWER
+
+
+def make_cycles(number: int, interval: float) -> list:
+    """Builds (timestamp, values) poll cycles with a power crossing zero now and then"""
+    cycles = []
+    for i in range(number):
+        values = {address: random.uniform(-5000, 5000) for address in FOUR_WIRE_KEYS}
+        values[TOTAL_ACTIVE_POWER] = random.uniform(-2000, 4000)
+        cycles.append((i * interval, values))
+    return cycles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DTSU666 windowed aggregation benchmark")
+    parser.add_argument("--number", type=int, default=20000, help="poll cycles per run")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between poll cycles")
+    args = parser.parse_args()
+
+    cycles = make_cycles(args.number, args.interval)
+    aggregator = WindowAggregator(clock=lambda: 0.0)
+
+    started = time.perf_counter()
+    closed = [document for timestamp, values in cycles for _, document in aggregator.add(values, timestamp)]
+    elapsed = time.perf_counter() - started
+    closed += [document for _, document in aggregator.close_due(cycles[-1][0] + 3600)]
+
+    for length in sorted({document["window"] for document in closed}):
+        documents = [document for document in closed if document["window"] == length]
+        imported = sum(document["Import_Energy_Wh"] for document in documents)
+        exported = sum(document["Export_Energy_Wh"] for document in documents)
+        # the documents are rounded to 0.1 mWh
+        tolerance = 1e-4 * len(documents)
+        assert abs(imported - aggregator.import_wh) <= tolerance, (length, imported, aggregator.import_wh)
+        assert abs(exported - aggregator.export_wh) <= tolerance, (length, exported, aggregator.export_wh)
+        print(f"{length:>5} s windows: {len(documents):6} closed, {imported:10.2f} Wh import, "
+              f"{exported:10.2f} Wh export")
+    print(f"{'integrated':>13}: {aggregator.import_wh:18.2f} Wh import, {aggregator.export_wh:10.2f} Wh export")
+    print(f"{'add()':>13}: {elapsed / args.number * 1e6:8.2f} us per cycle ({len(aggregator.keys)} registers)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for register decoding
+
+Compares the former per-register convert_from_registers path with the
+precompiled SpanDecoder on the block reads of FOUR_WIRE_KEYS.
+
+Usage: python -m benchmarks.decode_bench [--number 20000]
+"""
+
+import argparse
+import random
+import struct
+import timeit
+
+from pymodbus.client import AsyncModbusSerialClient
+
+from dtsu666_constants import FOUR_WIRE_KEYS, REGISTERS
+from read_planner import plan_reads
+from register_decoder import SpanDecoder
+
+
+def make_block(span):
+    """Builds the raw words of a span with random FLOAT32 values"""
+    registers = [0] * span.count
+    for address in span.keys:
+        offset = address - span.start
+        registers[offset:offset + 2] = struct.unpack(">HH", struct.pack(">f", random.uniform(-5000, 5000)))
+    return registers
+
+
+def decode_per_register(span, registers):
+    """Decoding as done before the block decoder"""
+    data = {}
+    for address, words in span.slice(registers).items():
+        raw = AsyncModbusSerialClient.convert_from_registers(
+            words, word_order='big',
+            data_type=AsyncModbusSerialClient.DATATYPE.FLOAT32,
+            string_encoding="ascii")
+        data[address] = raw * REGISTERS[address]["factor"]
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DTSU666 register decoding benchmark")
+    parser.add_argument("--number", type=int, default=20000, help="poll cycles per run")
+    args = parser.parse_args()
+
+    spans = plan_reads(FOUR_WIRE_KEYS)
+    blocks = [(span, SpanDecoder(span), make_block(span)) for span in spans]
+
+    def legacy():
+        for span, _, registers in blocks:
+            decode_per_register(span, registers)
+
+    def block():
+        for _, decoder, registers in blocks:
+            decoder.decode(registers)
+
+    for span, decoder, registers in blocks:
+        expected = decode_per_register(span, registers)
+        for address, value in decoder.decode(registers).items():
+            assert abs(value - expected[address]) <= 1e-9 * max(1.0, abs(value)), address
+
+    results = {}
+    for name, func in (("convert_from_registers", legacy), ("SpanDecoder", block)):
+        best = min(timeit.repeat(func, number=args.number, repeat=5))
+        results[name] = best / args.number * 1e6
+        print(f"{name:24}: {results[name]:8.2f} us per cycle ({len(FOUR_WIRE_KEYS)} registers)")
+    print(f"{'speedup':24}: {results['convert_from_registers'] / results['SpanDecoder']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark without hardware
+
+Dtsu666Reader talks Modbus RTU to Dtsu666Emulator over a virtual serial
+link (two pty pairs joined by a relay, i.e. a null-modem cable in
+software) and the values are published through the PublishPipeline to a
+stub MQTT broker on localhost. The pty link has no baud rate, so the
+numbers are the software cost of the gateway, not the cost of the bus.
+
+Scenarios:
+- per_register: one Modbus transaction per register
+- block: block reads of the read planner
+- multi_device: block reads of three device IDs per cycle
+- proxy: reader -> MqttReportingDataBlock proxy -> emulator
+- buses: BusSupervisor polling 1, 2 and 4 virtual buses in parallel,
+  every meter answering --read-delay seconds late like a slow RS485
+  line; each bus polls one block back to back for --duration seconds
+
+Reported per scenario: poll-cycle latency percentiles, Modbus
+transactions/s, decode cost per cycle and the meter->MQTT latency from
+writing a new frame into the emulator until its state document arrives
+at the broker. The buses scenario reports poll cycles/s per bus count,
+which grow linearly with the number of buses if they run in parallel.
+
+Cycles are paced by --interval: back-to-back cycles keep the event loop
+busy and starve paho's network thread of the GIL, which is not how the
+gateway runs and makes the meter->MQTT latency bimodal.
+
+Usage: python -m benchmarks.e2e_bench [--cycles 200] [--interval 0.01] [--scenario block ...]
+                                      [--duration 5] [--read-delay 0.02]
+                                      [--output results.json]
+                                      [--baseline baseline.json] [--tolerance 0.25]
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import statistics
+import struct
+import sys
+import time
+import timeit
+import tty
+
+import paho.mqtt.client as mqtt
+from pymodbus import FramerType
+from pymodbus.datastore import ModbusServerContext
+from pymodbus.server import ModbusSerialServer
+import pymodbus.client as ModbusClient
+
+from bus_supervisor import BusSupervisor
+from config import load_config
+from datablocks import DirectDeviceContext, MqttReportingDataBlock
+from dtsu666_constants import FOUR_WIRE_KEYS, TOTAL_IMPORT_ENERGY
+from dtsu666emulator import Dtsu666Emulator
+from dtsu666reader import Dtsu666Reader
+from mqtt_publisher import MqttPublisher
+from publish_pipeline import PublishPipeline
+
+SCENARIOS = ("per_register", "block", "multi_device", "proxy", "buses")
+BUS_COUNTS = (1, 2, 4)
+TOPIC_PREFIX = "bench"
+
+# metric -> True if higher is better
+METRICS = {
+    "cycle_ms.p50": False,
+    "cycle_ms.p99": False,
+    "transactions_per_s": True,
+    "decode_us": False,
+    "e2e_ms.p50": False,
+    "e2e_ms.p99": False,
+    **{f"cycles_per_s.{count}": True for count in BUS_COUNTS},
+}
+
+
+class VirtualSerialLink:
+    """
+    Two pty pairs whose masters are relayed into each other. With a delay,
+    data from the second port (the meter side) arrives delay seconds late.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self._fds = []
+        self.ports = []
+        self._masters = []
+        for _ in range(2):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            self._fds += [master, slave]
+            self._masters.append(master)
+            self.ports.append(os.ttyname(slave))
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        a, b = self._masters
+        loop.add_reader(a, self._relay, a, b)
+        loop.add_reader(b, self._relay, b, a, self.delay)
+
+    @staticmethod
+    def _relay(source, target, delay: float = 0.0):
+        try:
+            data = os.read(source, 4096)
+        except OSError:
+            return
+        if delay:
+            asyncio.get_running_loop().call_later(delay, os.write, target, data)
+        else:
+            os.write(target, data)
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        for master in self._masters:
+            loop.remove_reader(master)
+        for fd in self._fds:
+            os.close(fd)
+
+
+class StubBroker:
+    """Just enough MQTT 3.1.1 to accept QoS 0 publishes from paho"""
+
+    def __init__(self, on_publish):
+        self.on_publish = on_publish
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == 3:  # PUBLISH
+                    arrived = time.perf_counter()
+                    topic_length = struct.unpack_from(">H", body)[0]
+                    offset = 2 + topic_length + (2 if header & 0x06 else 0)
+                    self.on_publish(arrived, body[2:2 + topic_length].decode(), body[offset:])
+                elif kind == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def percentiles(samples) -> dict:
+    """p50/p90/p99/max of samples in seconds, in milliseconds"""
+    if len(samples) < 2:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": round(cuts[49] * 1e3, 3), "p90": round(cuts[89] * 1e3, 3),
+            "p99": round(cuts[98] * 1e3, 3), "max": round(max(samples) * 1e3, 3)}
+
+
+def bench_config(port: str, scenario: str) -> dict:
+    cfg = copy.deepcopy(load_config())
+    cfg["reader"].update({"port": port, "timeout": 1})
+    if scenario == "per_register":
+        cfg["reader"].update({"max_registers": 2, "max_gap": 0})
+    cfg["devices"] = [{"id": device_id} for device_id in ((1, 2, 3) if scenario == "multi_device" else (1,))]
+    cfg["mqtt"].update({"topic_prefix": TOPIC_PREFIX, "publish_mode": "state", "flush_interval": 0})
+    cfg["deadband"] = {"enabled": False}
+    return cfg
+
+
+async def wait_connected(client, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not client.is_connected():
+        if time.monotonic() > deadline:
+            raise RuntimeError("MQTT client did not connect to the stub broker")
+        await asyncio.sleep(0.01)
+
+
+async def run_scenario(scenario: str, cycles: int, interval: float) -> dict:
+    sent = {}
+    e2e = []
+
+    def on_publish(arrived, topic, payload):
+        seq = json.loads(payload).get("Total_Import_Energy")
+        if seq is not None and seq in sent:
+            e2e.append(arrived - sent[seq])
+
+    broker = StubBroker(on_publish)
+    await broker.start()
+    client = mqtt.Client()
+    pipeline = PublishPipeline(client, spool_file=None)
+    pipeline.start("127.0.0.1", broker.port, 60)
+    pipeline_task = asyncio.create_task(pipeline.run())
+
+    meter_link = VirtualSerialLink()
+    meter_link.start()
+    reader_port, meter_port = meter_link.ports
+    links = [meter_link]
+    tasks = [pipeline_task]
+
+    cfg = bench_config(reader_port, scenario)
+    emulator = Dtsu666Emulator(port=meter_port, device_id=1)
+    for device in cfg["devices"][1:]:
+        emulator.context[device["id"]] = emulator.store
+    await emulator.start()
+
+    proxy_client = None
+    if scenario == "proxy":
+        # the reader plays the inverter, the proxy publishes what it forwards
+        inverter_link = VirtualSerialLink()
+        inverter_link.start()
+        links.append(inverter_link)
+        proxy_client = ModbusClient.AsyncModbusSerialClient(framer=FramerType.RTU, port=reader_port, timeout=1)
+        await proxy_client.connect()
+        reader_port, proxy_port = inverter_link.ports
+        cfg["reader"]["port"] = reader_port
+        datablock = MqttReportingDataBlock(MqttPublisher.from_config(pipeline, cfg), proxy_client, 1,
+                                           cache_ttl=0, prefetch=False)
+        context = ModbusServerContext(devices={1: DirectDeviceContext(hr=datablock)}, single=False)
+        proxy = ModbusSerialServer(context=context, port=proxy_port, framer=FramerType.RTU)
+        tasks.append(asyncio.create_task(proxy.serve_forever()))
+
+    reader = Dtsu666Reader(cfg)
+    publishers = {meter.device_id: MqttPublisher.from_config(pipeline, cfg, f"{TOPIC_PREFIX}/{meter.device_id}")
+                  for meter in reader.meters}
+    try:
+        await wait_connected(client)
+        await asyncio.sleep(0.2)
+        await reader.connect()
+
+        frame = {key: 0.0 for key in FOUR_WIRE_KEYS}
+        decoders = reader.plan(FOUR_WIRE_KEYS)
+        # warm-up, also captures the blocks for the decode timing
+        blocks = []
+        for decoder in decoders:
+            rr = await reader.instrument.read_holding_registers(decoder.span.start, count=decoder.span.count,
+                                                                device_id=1)
+            blocks.append((decoder, rr.registers))
+
+        cycle_times = []
+        busy = 0.0
+        for seq in range(1, cycles + 1):
+            frame[TOTAL_IMPORT_ENERGY] = float(seq)
+            t0 = time.perf_counter()
+            emulator.update_values(frame)
+            sent[float(seq)] = t0
+            for meter in reader.meters:
+                values = await reader.read_values(FOUR_WIRE_KEYS, meter.device_id)
+                if proxy_client is None:
+                    publishers[meter.device_id].publish_values(values)
+            cycle_times.append(time.perf_counter() - t0)
+            busy += cycle_times[-1]
+            await asyncio.sleep(interval)
+
+        expected = cycles * (1 if proxy_client is not None else len(reader.meters))
+        deadline = time.monotonic() + 2.0
+        while len(e2e) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+        number = 2000
+        decode = min(timeit.repeat(lambda: [decoder.decode(registers) for decoder, registers in blocks],
+                                   number=number, repeat=3)) / number
+        return {
+            "cycles": cycles,
+            "transactions_per_cycle": len(decoders) * len(reader.meters),
+            "cycle_ms": percentiles(cycle_times),
+            "transactions_per_s": round(cycles * len(decoders) * len(reader.meters) / busy, 1),
+            "decode_us": round(decode * 1e6, 3),
+            "e2e_ms": percentiles(e2e),
+            "e2e_received": len(e2e),
+        }
+    finally:
+        reader.close()
+        for task in tasks:
+            task.cancel()
+        if proxy_client is not None:
+            proxy_client.close()
+        await emulator.stop()
+        pipeline.stop()
+        for link in links:
+            link.close()
+        await broker.stop()
+
+
+async def run_buses(duration: float, read_delay: float) -> dict:
+    """Poll cycles/s of the BusSupervisor with 1, 2 and 4 buses"""
+    cycles_per_s = {}
+    for count in BUS_COUNTS:
+        links = [VirtualSerialLink(read_delay) for _ in range(count)]
+        emulators = []
+        for link in links:
+            link.start()
+            emulators.append(Dtsu666Emulator(port=link.ports[1], device_id=1))
+        for emulator in emulators:
+            await emulator.start()
+
+        # one block read per cycle, polled back to back
+        registers = ["Total_Active_Power", "Active_Power_Phase_A", "Active_Power_Phase_B", "Active_Power_Phase_C"]
+        cfg = bench_config(links[0].ports[0], "block")
+        cfg["buses"] = [{"name": f"bus{i}", "port": link.ports[0], "devices": [{"id": 1, "profile": registers}]}
+                        for i, link in enumerate(links)]
+        cfg["poll_groups"] = {"power": {"interval": 0.001, "registers": registers}}
+        # publishing is not measured here, the pipeline only queues
+        supervisor = BusSupervisor(cfg, PublishPipeline(None, spool_file=None), mode="tasks")
+        stop_event = asyncio.Event()
+        asyncio.get_running_loop().call_later(duration, stop_event.set)
+        try:
+            await supervisor.run(stop_event)
+        finally:
+            for emulator in emulators:
+                await emulator.stop()
+            for link in links:
+                link.close()
+        cycles_per_s[str(count)] = round(sum(supervisor.cycles) / duration, 1)
+    return {"duration": duration, "read_delay_ms": round(read_delay * 1e3, 3), "cycles_per_s": cycles_per_s}
+
+
+def metric(result: dict, name: str):
+    for part in name.split("."):
+        result = result.get(part) if isinstance(result, dict) else None
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a description of every metric that is worse than the baseline by more than tolerance"""
+    regressions = []
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        for name, higher_is_better in METRICS.items():
+            value, reference = metric(result, name), metric(baseline[scenario], name)
+            if value is None or not reference:
+                continue
+            change = (value - reference) / reference
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{scenario} {name}: {value} vs. baseline {reference} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DTSU666 gateway end-to-end benchmark")
+    parser.add_argument("--cycles", type=int, default=200, help="poll cycles per scenario")
+    parser.add_argument("--interval", type=float, default=0.01, help="pause between poll cycles in seconds")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="seconds per bus count in the buses scenario")
+    parser.add_argument("--read-delay", type=float, default=0.02,
+                        help="response delay of the meters in the buses scenario in seconds")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    # the emulator and pymodbus log every frame at DEBUG
+    logging.getLogger().setLevel(logging.WARNING)
+    # the buses scenario polls back to back and overruns every poll slot on purpose
+    logging.getLogger("dtsu666reader").setLevel(logging.ERROR)
+
+    results = {}
+    for scenario in args.scenario or SCENARIOS:
+        if scenario == "buses":
+            results[scenario] = result = asyncio.run(run_buses(args.duration, args.read_delay))
+            print(f"{scenario:14}: poll cycles/s with {result['read_delay_ms']} ms reads: " +
+                  ", ".join(f"{count} bus(es) {cps}" for count, cps in result["cycles_per_s"].items()))
+            continue
+        results[scenario] = result = asyncio.run(run_scenario(scenario, args.cycles, args.interval))
+        print(f"{scenario:14}: cycle p50 {result['cycle_ms']['p50']} ms, p99 {result['cycle_ms']['p99']} ms, "
+              f"{result['transactions_per_s']} transactions/s, decode {result['decode_us']} us, "
+              f"meter->MQTT p50 {result['e2e_ms']['p50']} ms ({result['e2e_received']} received)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Priority arbitration of the upstream RTU bus
+
+Inverter requests forwarded by the proxy, cache prefetches and background
+polls for MQTT all share one AsyncModbusSerialClient. The BusArbiter puts
+them into one priority queue and runs one transaction at a time:
+
+    INVERTER    forwarded inverter reads, always next
+    PREFETCH    reads into the register cache ahead of the inverter
+    BACKGROUND  polls for MQTT, only in idle gaps
+
+A transaction on the wire cannot be interrupted, so a background read is
+only started if it will be done before the inverter's next request is
+expected (forecast, e.g. AccessPatternPrefetcher.next_request_time) with
+guard seconds to spare. Otherwise it waits until the inverter was served.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+log = logging.getLogger("dtsu666-arbiter")
+
+INVERTER = 0
+PREFETCH = 1
+BACKGROUND = 2
+PRIORITY_NAMES = ("inverter", "prefetch", "background")
+
+DEFAULT_GUARD = 0.02
+# weight of the newest sample in the transaction time average
+SERVICE_ALPHA = 0.2
+# assumed time of a transaction that was never measured
+DEFAULT_SERVICE_TIME = 0.15
+
+
+class ArbiterChannel:
+    """Client-like view of the arbiter that reads with one priority"""
+
+    def __init__(self, arbiter, priority: int):
+        self.arbiter = arbiter
+        self.priority = priority
+
+    @property
+    def connected(self) -> bool:
+        return self.arbiter.client.connected
+
+    async def connect(self):
+        return self.arbiter.client.connected
+
+    async def read_holding_registers(self, address: int, count: int = 1, device_id: int = 1):
+        return await self.arbiter.read_holding_registers(address, count, device_id, self.priority)
+
+    def close(self):
+        """The upstream client belongs to the arbiter's owner"""
+
+
+class BusArbiter:
+    """Priority queue in front of one upstream Modbus client"""
+
+    def __init__(self, client, guard: float = DEFAULT_GUARD, forecast=None, clock=time.monotonic):
+        """forecast() returns the monotonic time of the next expected inverter request, or None"""
+        self.client = client
+        self.guard = guard
+        self.forecast = forecast
+        self.clock = clock
+        self.served = [0] * len(PRIORITY_NAMES)
+        self.deferrals = 0
+        self.waited = [0.0] * len(PRIORITY_NAMES)
+        self._service = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+
+    def channel(self, priority: int) -> ArbiterChannel:
+        return ArbiterChannel(self, priority)
+
+    async def read_holding_registers(self, address: int, count: int = 1, device_id: int = 1,
+                                     priority: int = BACKGROUND):
+        """Queues a read and returns the response once it ran on the bus"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run(), name="bus-arbiter")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), self.clock(), future, (address, count, device_id)))
+        self._wakeup.set()
+        return await future
+
+    def service_time(self, count: int) -> float:
+        """Expected duration of a read of count registers"""
+        estimate = self._service.get(count)
+        if estimate is None:
+            estimate = max(self._service.values(), default=DEFAULT_SERVICE_TIME)
+        return estimate
+
+    def _defer_until(self, priority: int, count: int, now: float):
+        """Returns the time to wait for if the read would run into the inverter's next request"""
+        if priority < BACKGROUND or self.forecast is None:
+            return None
+        expected = self.forecast()
+        if expected is None or now >= expected + self.guard:
+            return None
+        if now + self.service_time(count) + self.guard <= expected:
+            return None
+        return expected + self.guard
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            priority, _, queued, future, (address, count, device_id) = self._queue[0]
+            now = self.clock()
+            until = self._defer_until(priority, count, now)
+            if until is not None:
+                # a higher priority request wakes us up early
+                self.deferrals += 1
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), until - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._queue)
+            if future.cancelled():
+                continue
+            self.waited[priority] += now - queued
+            try:
+                response = await self.client.read_holding_registers(address, count=count, device_id=device_id)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+                continue
+            elapsed = self.clock() - now
+            estimate = self._service.get(count)
+            self._service[count] = elapsed if estimate is None else estimate + SERVICE_ALPHA * (elapsed - estimate)
+            self.served[priority] += 1
+            if not future.cancelled():
+                future.set_result(response)
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for *_, future, _ in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    def stats(self) -> dict:
+        """Counters for diagnostics"""
+        return {
+            "served": dict(zip(PRIORITY_NAMES, self.served)),
+            "avg_wait": {name: round(waited / served, 4) if served else None
+                         for name, waited, served in zip(PRIORITY_NAMES, self.waited, self.served)},
+            "deferrals": self.deferrals,
+            "queued": len(self._queue),
+        }
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Supervisor for several RS485 buses
+
+Every serial port or TCP endpoint listed under "buses" in config.json
+gets its own polling pipeline with its own Modbus client and BusScheduler,
+so the buses are polled in parallel. The pipelines run as asyncio tasks
+in one process ("tasks", the default) or each in its own process
+("processes"), so CPU work and garbage collection on one bus cannot
+delay the timing on another. All pipelines share one MQTT publish
+pipeline in the supervisor process.
+
+    "supervisor": {"mode": "tasks"},
+    "buses": [
+        {"port": "/dev/ttyUSB0", "devices": [{"id": 1}, {"id": 2}]},
+        {"port": "/dev/ttyUSB1", "baudrate": 19200, "devices": [{"id": 1}]},
+        {"transport": "rtu-over-tcp", "host": "192.168.1.50", "tcp_port": 8899, "devices": [{"id": 3}]}
+    ]
+
+With more than one bus the values of a bus are published below
+<topic_prefix>/<bus name>, the bus name defaults to the name of the port
+or to host:tcp_port.
+Transaction telemetry is collected per bus ("reader-<bus name>") in the
+"tasks" mode only, worker processes keep their counters to themselves.
+"""
+
+import asyncio
+import copy
+import logging
+import multiprocessing
+import signal
+import threading
+
+from aggregation import WindowAggregator
+from config import load_config
+from datablocks import DEFAULT_STALE_PERIODS, RegisterImageDataBlock
+from dtsu666emulator import Dtsu666Emulator
+from dtsu666reader import Dtsu666Reader, meters_from_config
+from modbus_transport import DEFAULT_TCP_PORT, endpoint, endpoint_name, transport_of
+from mqtt_publisher import MqttPublisher
+from publish_pipeline import PublishPipeline
+from rtu_capture import CaptureWriter
+from startup import configure_logging
+from telemetry import Telemetry
+
+logger = logging.getLogger("dtsu666-supervisor")
+
+WORKER_MODES = ("tasks", "processes")
+DEFAULT_MODE = "tasks"
+READER_KEYS = ("transport", "port", "host", "tcp_port", "baudrate", "parity", "stopbits", "timeout", "retries",
+               "frame_gap", "max_registers", "max_gap")
+
+
+def bus_configs(cfg) -> list:
+    """
+    Splits the config into one config per bus.
+
+    Every bus entry overrides the reader settings it names and brings its
+    own devices. Without a buses list the reader section is the only bus.
+    """
+    buses = cfg.get("buses")
+    if not buses:
+        bus_cfg = copy.deepcopy(cfg)
+        bus_cfg["bus"] = endpoint_name(cfg["reader"])
+        return [bus_cfg]
+
+    result = []
+    for bus in buses:
+        bus_cfg = copy.deepcopy(cfg)
+        del bus_cfg["buses"]
+        bus_cfg["reader"].update({key: bus[key] for key in READER_KEYS if key in bus})
+        bus_cfg["bus"] = bus.get("name", endpoint_name(bus_cfg["reader"]))
+        bus_cfg["devices"] = bus.get("devices") or [{"id": cfg["device"]["id"]}]
+        if len(buses) > 1:
+            bus_cfg["mqtt"]["topic_prefix"] = f"{cfg['mqtt']['topic_prefix']}/{bus_cfg['bus']}"
+        result.append(bus_cfg)
+    return result
+
+
+async def poll_bus(bus_cfg, callback, stop_event: asyncio.Event, monitor=None):
+    """Polls all meters of one bus until stop_event is set"""
+    reader = Dtsu666Reader(bus_cfg, monitor)
+    await reader.connect()
+    try:
+        await reader.poll(callback, stop_event)
+    finally:
+        reader.close()
+
+
+def _bus_process(index: int, bus_cfg, queue):
+    """Entry point of a bus worker process, sends (bus, device id, values) to queue"""
+
+    def forward(values, _groups, meter):
+        queue.put((index, meter.device_id, values))
+
+    configure_logging(bus_cfg)
+
+    async def run():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+        await poll_bus(bus_cfg, forward, stop_event)
+
+    asyncio.run(run())
+
+
+class BusSupervisor:
+    """Runs one polling pipeline per serial bus and publishes all values through one pipeline"""
+
+    def __init__(self, cfg, pipeline, emulator: Dtsu666Emulator = None, mode: str = None,
+                 telemetry: Telemetry = None):
+        mode = mode or cfg.get("supervisor", {}).get("mode", DEFAULT_MODE)
+        if mode not in WORKER_MODES:
+            raise ValueError(f"Unknown worker mode {mode!r}, expected one of {WORKER_MODES}")
+        self.mode = mode
+        self.buses = bus_configs(cfg)
+        self.emulator = emulator
+        self.telemetry = telemetry
+        self.cycles = [0] * len(self.buses)
+        self._meters = []
+        self._publishers = []
+        self._aggregators = []
+        for bus_cfg in self.buses:
+            meters = {meter.device_id: meter for meter in meters_from_config(bus_cfg)}
+            self._meters.append(meters)
+            self._publishers.append({device_id: MqttPublisher.from_config(pipeline, bus_cfg, meter.topic_prefix)
+                                     for device_id, meter in meters.items()})
+            self._aggregators.append({device_id: aggregator for device_id in meters
+                                      if (aggregator := WindowAggregator.from_config(bus_cfg)) is not None})
+        # the emulator serves the first meter with the source id on any bus, the first meter by default
+        source = cfg["emulator"].get("source", next(iter(self._meters[0])))
+        self.emulator_source = next(((index, source) for index, meters in enumerate(self._meters)
+                                     if source in meters), None)
+
+    def source_interval(self, default: float) -> float:
+        """Interval of the fastest poll group of the meter the emulator serves"""
+        if self.emulator_source is None:
+            return default
+        index, device_id = self.emulator_source
+        return min((group.interval for group in self._meters[index][device_id].poll_groups), default=default)
+
+    def on_values(self, index: int, values: dict, meter):
+        """Called with the values of one poll cycle of a meter on bus index"""
+        self.cycles[index] += 1
+        if self.emulator is not None and (index, meter.device_id) == self.emulator_source:
+            self.emulator.update_values(values)
+        publisher = self._publishers[index][meter.device_id]
+        publisher.publish_values(values)
+        aggregator = self._aggregators[index].get(meter.device_id)
+        if aggregator is not None:
+            for window, document in aggregator.add(values):
+                publisher.publish_aggregate(window, document)
+
+    def _dispatch(self, message):
+        index, device_id, values = message
+        self.on_values(index, values, self._meters[index][device_id])
+
+    async def run(self, stop_event: asyncio.Event):
+        """Polls all buses until stop_event is set"""
+        for bus_cfg in self.buses:
+            logger.info("Bus %s on %s: %i meter(s)", bus_cfg["bus"], endpoint(bus_cfg["reader"]),
+                        len(bus_cfg.get("devices") or [bus_cfg["device"]]))
+        # windows of a meter that stopped answering are closed on a timer
+        aggregator_tasks = [asyncio.create_task(aggregator.run(self._publishers[index][device_id].publish_aggregate,
+                                                               stop_event))
+                            for index, aggregators in enumerate(self._aggregators)
+                            for device_id, aggregator in aggregators.items()]
+        try:
+            if self.mode == "tasks":
+                await self._run_tasks(stop_event)
+            else:
+                await self._run_processes(stop_event)
+        finally:
+            for task in aggregator_tasks:
+                task.cancel()
+        logger.info("Poll cycles per bus: %s",
+                    ", ".join(f"{bus_cfg['bus']}={cycles}" for bus_cfg, cycles in zip(self.buses, self.cycles)))
+
+    async def _run_tasks(self, stop_event: asyncio.Event):
+        tasks = []
+        for index, bus_cfg in enumerate(self.buses):
+            def callback(values, _groups, meter, index=index):
+                self.on_values(index, values, meter)
+            monitor = self.telemetry.monitor(f"reader-{bus_cfg['bus']}") if self.telemetry else None
+            tasks.append(asyncio.create_task(poll_bus(bus_cfg, callback, stop_event, monitor), name=bus_cfg["bus"]))
+        await asyncio.gather(*tasks)
+
+    async def _run_processes(self, stop_event: asyncio.Event):
+        # spawn instead of fork: the parent already runs an event loop and paho's network thread
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        loop = asyncio.get_running_loop()
+
+        def drain():
+            while (message := queue.get()) is not None:
+                loop.call_soon_threadsafe(self._dispatch, message)
+
+        drainer = threading.Thread(target=drain, name="bus-queue", daemon=True)
+        drainer.start()
+        processes = [context.Process(target=_bus_process, args=(index, bus_cfg, queue), name=bus_cfg["bus"])
+                     for index, bus_cfg in enumerate(self.buses)]
+        for process in processes:
+            process.start()
+        try:
+            await stop_event.wait()
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                await loop.run_in_executor(None, process.join)
+            queue.put(None)
+            await loop.run_in_executor(None, drainer.join)
+
+
+async def main():
+    cfg = load_config()
+    configure_logging(cfg)
+
+    # MQTT, shared by all buses. paho is imported in a worker thread while the buses start
+    pipeline = PublishPipeline.from_config(None, cfg)
+
+    async def run_pipeline():
+        await pipeline.start_from_config(cfg)
+        await pipeline.run()
+
+    pipeline_task = asyncio.create_task(run_pipeline())
+
+    telemetry = Telemetry.from_config(cfg)
+    if telemetry is not None:
+        await telemetry.start_http()
+
+    supervisor = BusSupervisor(cfg, pipeline, telemetry=telemetry)
+
+    # Emulator
+    emulator = None
+    emu_cfg = cfg["emulator"]
+    if emu_cfg.get("enabled", False):
+        # the served image expires after stale_periods periods of the source meter's fastest group
+        period = supervisor.source_interval(cfg.get("poll_interval", 30))
+        emulator = Dtsu666Emulator(
+            datablock=RegisterImageDataBlock(unmapped=emu_cfg.get("unmapped", "exception"),
+                                             max_age=emu_cfg.get("stale_periods", DEFAULT_STALE_PERIODS) * period),
+            port=emu_cfg["port"],
+            device_id=cfg["device"]["id"],
+            baudrate=emu_cfg.get("baudrate", 9600),
+            transport=transport_of(emu_cfg),
+            host=emu_cfg.get("host", ""),
+            tcp_port=emu_cfg.get("tcp_port", DEFAULT_TCP_PORT),
+            monitor=telemetry.monitor("emulator", server=True) if telemetry else None,
+            recorder=CaptureWriter.from_config(cfg, "emulator", server=True),
+        )
+        await emulator.start()
+        supervisor.emulator = emulator
+
+    stop_event = asyncio.Event()
+
+    def shutdown_handler(*_args):
+        logger.info("Shutdown signal received...")
+        stop_event.set()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, shutdown_handler)
+    loop.add_signal_handler(signal.SIGTERM, shutdown_handler)
+
+    diagnostics_task = None
+    if telemetry is not None:
+        diagnostics_task = asyncio.create_task(
+            telemetry.publish_loop(MqttPublisher.from_config(pipeline, cfg), stop_event))
+
+    try:
+        await supervisor.run(stop_event)
+    finally:
+        if diagnostics_task is not None:
+            diagnostics_task.cancel()
+            await telemetry.stop_http()
+        if emulator is not None:
+            await emulator.stop()
+        pipeline_task.cancel()
+        pipeline.stop()
+        logger.info("Shutdown complete.")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Exit.")
@@ -3,6 +3,13 @@ import os
 
 CONFIG_FILE = "config.json"
 
+def save_config(cfg):
+    """Writes the config back to the JSON file"""
+    with open(CONFIG_FILE, "w") as f:
+        json.dump(cfg, f, indent=4)
+        f.write("\n")
+
+
 def load_config():
     """Load default config from JSON file"""
     if os.path.exists(CONFIG_FILE):
@@ -12,29 +19,119 @@ def load_config():
         # fallback default
         return {
             "reader": {
+                "transport": "serial",
                 "port": "/dev/ttyUSB0",
                 "baudrate": 9600,
                 "parity": "N",
                 "stopbits": 1,
-                "timeout": 1
+                "host": "192.168.1.50",
+                "tcp_port": 502,
+                "timeout": 1,
+                "retries": 2,
+                "adaptive_timeout": True,
+                "min_timeout": 0.05,
+                "max_timeout": 2,
+                "breaker_threshold": 3,
+                "breaker_open_time": 1,
+                "breaker_max_open_time": 60,
+                "frame_gap": 0,
+                "max_registers": 64,
+                "max_gap": 20
             },
             "mqtt": {
                 "host": "localhost",
                 "port": 1883,
                 "username": "user",
                 "password": "pass",
-                "topic_prefix": "dtsu666"
+                "topic_prefix": "dtsu666",
+                "publish_mode": "state",
+                "state_topic": "state",
+                "fan_out": [],
+                "queue_size": 1000,
+                "overflow_policy": "drop-oldest",
+                "spool_file": "mqtt_spool.jsonl",
+                "spool_size": 10000
             },
             "poll_interval": 30,
+            "poll_groups": {
+                "power": {
+                    "interval": 1,
+                    "registers": ["Total_Active_Power", "Active_Power_Phase_A", "Active_Power_Phase_B",
+                                  "Active_Power_Phase_C", "Total_Reactive_Power", "Reactive_Power_Phase_A",
+                                  "Reactive_Power_Phase_B", "Reactive_Power_Phase_C"]
+                },
+                "currents": {
+                    "interval": 5,
+                    "registers": ["Current_Phase_A", "Current_Phase_B", "Current_Phase_C", "Total_Power_Factor",
+                                  "Power_Factor_Phase_A", "Power_Factor_Phase_B", "Power_Factor_Phase_C"]
+                },
+                "voltages": {
+                    "interval": 10,
+                    "registers": ["Voltage_Phase_A", "Voltage_Phase_B", "Voltage_Phase_C", "Frequency",
+                                  "Voltage_Phase_AB", "Voltage_Phase_BC", "Voltage_Phase_CA"]
+                },
+                "energy": {
+                    "interval": 60,
+                    "registers": ["Total_Import_Energy", "Total_Export_Energy"]
+                }
+            },
             "device": {
                 "id": 1
             },
             "emulator": {
                 "enabled": True,
+                "transport": "serial",
                 "port": "/dev/ttySO",
                 "baudrate": 9600,
                 "parity": "N",
-                "stopbits": 1
+                "stopbits": 1,
+                "host": "0.0.0.0",
+                "tcp_port": 5020,
+                "unmapped": "exception",
+                "stale_periods": 3,
+                "access_log": "aggregate",
+                "access_summary_interval": 60
+            },
+            "deadband": {
+                "enabled": False,
+                "max_silence": 300,
+                "report_interval": 60,
+                "registers": {}
+            },
+            "proxy": {
+                "cache_ttl": 0.5,
+                "prefetch": True,
+                "poll": False,
+                "guard": 0.02
+            },
+            "supervisor": {
+                "mode": "tasks"
+            },
+            "capture": {
+                "enabled": False,
+                "directory": "captures"
+            },
+            "aggregation": {
+                "enabled": False,
+                "windows": [1, 60, 900],
+                "registers": ["Total_Active_Power", "Active_Power_Phase_A", "Active_Power_Phase_B",
+                              "Active_Power_Phase_C"],
+                "max_gap": 10
+            },
+            "history": {
+                "enabled": False,
+                "directory": "history",
+                "raw_samples": 3600,
+                "rollups": [[60, 1440], [900, 2880], [3600, 2160]],
+                "sync_interval": 60,
+                "http_host": "127.0.0.1",
+                "http_port": 9109
+            },
+            "telemetry": {
+                "enabled": True,
+                "http_host": "127.0.0.1",
+                "http_port": 9108,
+                "mqtt_interval": 60
             },
             "logging": {
                 "level": 10
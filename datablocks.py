@@ -1,24 +1,411 @@
+import atexit
 import logging
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
 
-from pymodbus.datastore import ModbusSequentialDataBlock
+from pymodbus.constants import ExcCodes
+from pymodbus.datastore import ModbusDeviceContext
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus.exceptions import ModbusException
 
-from dtsu666_constants import REGISTERS
+from bus_arbiter import DEFAULT_GUARD, INVERTER, PREFETCH, BusArbiter
+from dtsu666_constants import MAPPED_RANGES
+from prefetcher import AccessPatternPrefetcher
+from register_cache import DEFAULT_TTL, RegisterCache
+from register_profile import REGISTER_TABLE, compile_profile
+
+ACCESS_LOG_FILE = "reader.log"
+ACCESS_LOG_MAX_BYTES = 1_000_000
+ACCESS_LOG_BACKUPS = 3
+ACCESS_LOG_MODES = ("aggregate", "requests")
+DEFAULT_SUMMARY_INTERVAL = 60
+DEFAULT_STALE_PERIODS = 3
 
-logging.basicConfig(
-    filename="reader.log",
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
 logger = logging.getLogger("dtsu-logger")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_access_listener = None
+
+log = logging.getLogger("dtsu666-proxy")
+
+
+def start_access_log(filename=ACCESS_LOG_FILE, max_bytes=ACCESS_LOG_MAX_BYTES, backups=ACCESS_LOG_BACKUPS):
+    """
+    Routes the access log through a queue to a rotating file.
+
+    Logging a read only enqueues the record, the file is written by the
+    listener thread, so disk latency never reaches the RTU response path.
+    """
+    global _access_listener
+    if _access_listener is not None:
+        return
+    queue = SimpleQueue()
+    file_handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups, delay=True)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    logger.addHandler(QueueHandler(queue))
+    _access_listener = QueueListener(queue, file_handler)
+    _access_listener.start()
+    atexit.register(stop_access_log)
+
+
+def stop_access_log():
+    """Writes the queued records and stops the listener thread"""
+    global _access_listener
+    if _access_listener is None:
+        return
+    _access_listener.stop()
+    for handler in _access_listener.handlers:
+        handler.close()
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    _access_listener = None
+
+
+class DirectDeviceContext(ModbusDeviceContext):
+    """
+    Device context that hands the protocol address unchanged to the datablock
+    and awaits the async datablock methods, so datablocks can read upstream.
+    """
+
+    def getValues(self, func_code, address, count=1):
+        return self.store[self.decode(func_code)].getValues(address, count)
+
+    def setValues(self, func_code, address, values):
+        return self.store[self.decode(func_code)].setValues(address, values)
+
+    async def async_getValues(self, func_code, address, count=1):
+        return await self.store[self.decode(func_code)].async_getValues(address, count)
+
+    async def async_setValues(self, func_code, address, values):
+        return await self.store[self.decode(func_code)].async_setValues(address, values)
+
+
+class FrameEncoder:
+    """
+    Precompiled encoder for a set of FLOAT32 measurement registers.
+
+    All values are packed with the frame struct of the compiled profile
+    and written into the segments in runs of adjacent registers.
+    """
+
+    __slots__ = ("keys", "factors", "_pack", "_runs")
+
+    def __init__(self, keys, block):
+        profile = compile_profile(sorted(keys))
+        self.keys = profile.keys
+        self.factors = profile.factors
+        self._pack = profile.frame
+
+        # runs of adjacent registers: (segment index, first offset, first word, last word)
+        runs = []
+        for i, register in enumerate(profile.registers):
+            if register.words != 2:
+                raise ValueError(f"Register 0x{register.address:04X} is not a FLOAT32 register")
+            index, offset = block.locate(register.address, 2)
+            if index is None:
+                raise ValueError(f"Register 0x{register.address:04X} is not mapped")
+            if runs and runs[-1][0] == index and runs[-1][1] + runs[-1][3] - runs[-1][2] == offset:
+                runs[-1][3] += 2
+            else:
+                runs.append([index, offset, 2 * i, 2 * i + 2])
+        self._runs = tuple(tuple(run) for run in runs)
+
+    def encode(self, segments, data: dict):
+        """Writes the scaled values of data into the given segments"""
+        words = array("H")
+        words.frombytes(self._pack.pack(*[data[address] / factor
+                                          for address, factor in zip(self.keys, self.factors)]))
+        if sys.byteorder == "little":
+            words.byteswap()
+        for index, offset, first, last in self._runs:
+            segments[index][1][offset:offset + last - first] = words[first:last]
+
+
+class RegisterImageDataBlock(BaseModbusDataBlock):
+    """
+    Sparse holding register image of a DTSU666.
+
+    Only the mapped ranges are allocated, each as one array('H') segment.
+    Reads of unmapped registers either return ILLEGAL_ADDRESS
+    (unmapped="exception") or zeros (unmapped="zero").
+
+    The image is double buffered: update_frame() encodes a measurement set
+    into the back buffer and swaps it in with one assignment, so a read
+    never sees a half written frame.
+
+    With max_age set, the image is stale if no frame came in for max_age
+    seconds (or none yet): reads then fail with GATEWAY_NO_RESPONSE like
+    the proxy's, instead of serving frozen values of a dead meter.
+    """
+
+    def __init__(self, ranges=MAPPED_RANGES, unmapped="exception", max_age=None, clock=time.monotonic):
+        if unmapped not in ("exception", "zero"):
+            raise ValueError(f"Unknown unmapped mode {unmapped!r}")
+        self.unmapped = unmapped
+        self.max_age = max_age
+        self.clock = clock
+        self.updated = None
+        self.address = 0
+        self.default_value = 0
+        self.segments = []
+        for start, count in sorted(ranges):
+            if self.segments and start < self.segments[-1][0] + len(self.segments[-1][1]):
+                raise ValueError(f"Register range 0x{start:04X} overlaps its predecessor")
+            self.segments.append((start, array("H", bytes(2 * count))))
+        self._back = [(start, array("H", segment)) for start, segment in self.segments]
+        self._starts = [start for start, _ in self.segments]
+        self._encoders = {}
+
+    @property
+    def values(self):
+        return {start + i: value for start, segment in self.segments for i, value in enumerate(segment)}
+
+    def locate(self, address, count=1):
+        """Returns (segment index, offset) if [address, address + count) lies in one segment"""
+        i = bisect_right(self._starts, address) - 1
+        if i < 0:
+            return None, 0
+        start, segment = self.segments[i]
+        offset = address - start
+        if offset + count > len(segment):
+            return None, 0
+        return i, offset
+
+    @property
+    def stale(self) -> bool:
+        return self.max_age is not None and (self.updated is None or self.clock() - self.updated > self.max_age)
+
+    def getValues(self, address, count=1):
+        if self.stale:
+            return ExcCodes.GATEWAY_NO_RESPONSE
+        segments = self.segments
+        index, offset = self.locate(address, count)
+        if index is not None:
+            return memoryview(segments[index][1])[offset:offset + count].tolist()
+        if self.unmapped == "exception":
+            return ExcCodes.ILLEGAL_ADDRESS
+        values = []
+        for register in range(address, address + count):
+            index, offset = self.locate(register)
+            values.append(segments[index][1][offset] if index is not None else 0)
+        return values
 
+    def setValues(self, address, values):
+        if not isinstance(values, (list, tuple, array)):
+            values = [values]
+        segments = self.segments
+        index, offset = self.locate(address, len(values))
+        if index is not None:
+            segments[index][1][offset:offset + len(values)] = array("H", values)
+            return None
+        if self.unmapped == "exception":
+            return ExcCodes.ILLEGAL_ADDRESS
+        for register, value in enumerate(values, address):
+            index, offset = self.locate(register)
+            if index is not None:
+                segments[index][1][offset] = value
+        return None
 
-class LoggingDataBlock(ModbusSequentialDataBlock):
-    """Datablock class for debugging the communication between WR and DTSU666"""
-    def __init__(self):
-        super().__init__(0, [0] * 0x4000)
+    def reset(self):
+        for _, segment in self.segments:
+            segment[:] = array("H", bytes(2 * len(segment)))
+
+    def update_frame(self, data: dict):
+        """
+        Encodes {address: value} for FLOAT32 measurement registers into the
+        back buffer and swaps it in as one consistent frame.
+        """
+        # the reader's frames come in the same key order every cycle, so the encoder is
+        # looked up by the keys as they are; only frames with missing values are filtered
+        keys = tuple(data) if None not in data.values() else tuple(
+            address for address, value in data.items() if value is not None)
+        encoder = self._encoders.get(keys)
+        if encoder is None:
+            encoder = self._encoders[keys] = FrameEncoder(
+                [address for address in keys if address in REGISTER_TABLE], self)
+
+        back, front = self._back, self.segments
+        for (_, target), (_, source) in zip(back, front):
+            target[:] = source
+        encoder.encode(back, data)
+        self.segments, self._back = back, front
+        if keys:
+            self.updated = self.clock()
+
+
+class _AccessEntry:
+    __slots__ = ("reads", "first", "last", "seen", "gap_sum", "gap_min", "gap_max")
+
+    def __init__(self, now, wall):
+        self.reads = 1
+        self.first = self.last = wall
+        self.seen = now
+        self.gap_sum = 0.0
+        self.gap_min = float("inf")
+        self.gap_max = 0.0
+
+    def add(self, now, wall):
+        gap = now - self.seen
+        self.reads += 1
+        self.last = wall
+        self.seen = now
+        self.gap_sum += gap
+        self.gap_min = min(self.gap_min, gap)
+        self.gap_max = max(self.gap_max, gap)
+
+
+class AccessStatistics:
+    """
+    Reads per (address, count) with first/last seen and inter-arrival times of one interval
+
+    Gaps and the interval run on the monotonic clock, so a step of the
+    wall clock (NTP) does not distort them; first/last seen are wall clock
+    times for the log.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SUMMARY_INTERVAL, clock=time.monotonic, wall_clock=time.time):
+        self.interval = interval
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.entries = {}
+        self.started = clock()
+
+    def record(self, address: int, count: int):
+        now = self.clock()
+        entry = self.entries.get((address, count))
+        if entry is None:
+            self.entries[(address, count)] = _AccessEntry(now, self.wall_clock())
+        else:
+            entry.add(now, self.wall_clock())
+
+    def remaining(self) -> float:
+        """Seconds until the current interval is due"""
+        return self.started + self.interval - self.clock()
+
+    def due(self) -> bool:
+        return self.clock() - self.started >= self.interval
+
+    def summary(self) -> list:
+        """One header line and one line per (address, count), then starts a new interval"""
+        now = self.clock()
+        lines = [f"WR access summary for {now - self.started:.0f} s: "
+                 f"{sum(entry.reads for entry in self.entries.values())} reads of {len(self.entries)} ranges"]
+        for (address, count), entry in sorted(self.entries.items()):
+            name = REGISTER_TABLE[address].name if address in REGISTER_TABLE else "unknown"
+            line = (f"0x{address:04X} ({name}) x{count}: {entry.reads} reads, "
+                    f"first {time.strftime('%H:%M:%S', time.localtime(entry.first))}, "
+                    f"last {time.strftime('%H:%M:%S', time.localtime(entry.last))}")
+            if entry.reads > 1:
+                line += (f", gap avg {entry.gap_sum / (entry.reads - 1):.3f} s "
+                         f"min {entry.gap_min:.3f} s max {entry.gap_max:.3f} s")
+            lines.append(line)
+        self.entries = {}
+        self.started = now
+        return lines
+
+
+class LoggingDataBlock(RegisterImageDataBlock):
+    """
+    Datablock class for debugging the communication between WR and DTSU666
+
+    mode="requests" logs every read of the inverter, mode="aggregate" only
+    collects AccessStatistics and logs a summary every summary_interval
+    seconds. Both write through the queued access log.
+    """
+
+    def __init__(self, ranges=MAPPED_RANGES, unmapped="exception", mode="aggregate",
+                 summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        if mode not in ACCESS_LOG_MODES:
+            raise ValueError(f"Unknown access log mode {mode!r}, expected one of {ACCESS_LOG_MODES}")
+        super().__init__(ranges, unmapped)
+        self.stats = AccessStatistics(summary_interval) if mode == "aggregate" else None
+        start_access_log()
 
     def getValues(self, address, count=1):
-        if address not in REGISTERS:
+        if self.stats is not None:
+            self.stats.record(address, count)
+            if self.stats.due():
+                self.flush_stats()
+        elif address not in REGISTER_TABLE:
             logger.info("WR wants to read unknown address %s", address)
+        else:
+            logger.info("WR reads address %s (%s) with count: %i", REGISTER_TABLE[address].name, address, count)
+        return super().getValues(address, count)
+
+    def flush_stats(self):
+        """Logs the summary of the current interval"""
+        if self.stats is None:
+            return
+        if not self.stats.entries:
+            # nothing was read, the next interval starts now
+            self.stats.started = self.stats.clock()
             return
-        logger.info("WR reads address %s (%s) with count: %i", REGISTERS[address]["name"], address, count)
+        for line in self.stats.summary():
+            logger.info(line)
+
+
+class MqttReportingDataBlock(RegisterImageDataBlock):
+    """
+    DataBlock for Modbus RTU server that forwards requests to another Modbus device
+    and publishes every upstream read through an MqttPublisher.
+
+    Upstream reads go through a RegisterCache, so repeated inverter reads of
+    the same registers within cache_ttl are answered locally. With prefetch
+    enabled the inverter's request sequence is learned and the next expected
+    range is read into the cache before the inverter asks for it.
+
+    All upstream reads go through a BusArbiter: inverter reads first, then
+    prefetches; background polls (arbiter.channel(BACKGROUND)) only run
+    when they do not delay the inverter's next expected request.
+    """
+
+    def __init__(self, publisher, reader_client, slave_id,
+                 cache_ttl=DEFAULT_TTL, prefetch=True, guard=DEFAULT_GUARD):
+        super().__init__()
+        self.publisher = publisher
+        self.reader = reader_client
+        self.slave_id = slave_id
+        self.cache = RegisterCache(self._read_upstream, ttl=cache_ttl, prefetch_fetch=self._prefetch_upstream)
+        self.prefetcher = AccessPatternPrefetcher(self.cache) if prefetch else None
+        self.arbiter = BusArbiter(reader_client, guard,
+                                  forecast=self.prefetcher.next_request_time if self.prefetcher else None)
+
+    async def _prefetch_upstream(self, device_id, address, count):
+        return await self._read_upstream(device_id, address, count, PREFETCH)
+
+    async def _read_upstream(self, device_id, address, count, priority=INVERTER):
+        rr = await self.arbiter.read_holding_registers(address, count, device_id, priority)
+        if not rr or rr.isError():
+            log.warning(f"Read error from DTSU666 @ {address}")
+            return None
+
+        values = rr.registers
+        self.publisher.publish_read(address, values)
+        return values
+
+    async def async_getValues(self, address, count=1):
+        """
+        Called when Modbus master (inverter) reads registers from this server.
+        We'll answer from the cache or forward the request to the DTSU666.
+        If the meter does not answer, the inverter gets GATEWAY_NO_RESPONSE
+        instead of zeros it would take for real measurements.
+        """
+        if self.prefetcher:
+            self.prefetcher.observe(self.slave_id, address, count)
+        try:
+            values = await self.cache.get(self.slave_id, address, count)
+            if values is None:
+                return ExcCodes.GATEWAY_NO_RESPONSE
+            return values
+
+        except ModbusException as e:
+            log.error(f"Modbus read exception: {e}")
+            return ExcCodes.GATEWAY_NO_RESPONSE
+
+        except Exception as e:
+            log.exception(f"Error forwarding read: {e}")
+            return ExcCodes.GATEWAY_NO_RESPONSE
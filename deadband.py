@@ -0,0 +1,92 @@
+"""
+Report-by-exception filter for DTSU666 values
+
+A value is only passed on if it moved out of the deadband of the last
+reported value, configured per register with deadband_abs/deadband_rel
+in REGISTERS. Every register is reported at least every max_silence
+seconds as heartbeat.
+"""
+
+import time
+
+from dtsu666_constants import REGISTERS
+from poll_scheduler import resolve_register
+
+DEFAULT_MAX_SILENCE = 300
+DEFAULT_REPORT_INTERVAL = 60
+
+
+class DeadbandFilter:
+    """Suppresses unchanged values between a reader and the MQTT publisher"""
+
+    def __init__(self, register_map=REGISTERS, max_silence: float = DEFAULT_MAX_SILENCE,
+                 overrides=None, report_interval: float = DEFAULT_REPORT_INTERVAL,
+                 clock=time.monotonic):
+        """overrides maps a register (name or address) to {"abs": ..., "rel": ...}"""
+        self.max_silence = max_silence
+        self.report_interval = report_interval
+        self.clock = clock
+        self.thresholds = {address: (spec.get("deadband_abs", 0.0), spec.get("deadband_rel", 0.0))
+                           for address, spec in register_map.items()}
+        for register, band in (overrides or {}).items():
+            address = resolve_register(register)
+            default_abs, default_rel = self.thresholds[address]
+            self.thresholds[address] = (band.get("abs", default_abs), band.get("rel", default_rel))
+
+        self._last = {}
+        self.passed = {}
+        self.suppressed = {}
+        self._last_report = clock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Creates the filter from cfg["deadband"], or returns None if it is disabled"""
+        db_cfg = cfg.get("deadband", {})
+        if not db_cfg.get("enabled", False):
+            return None
+        return cls(max_silence=db_cfg.get("max_silence", DEFAULT_MAX_SILENCE),
+                   overrides=db_cfg.get("registers"),
+                   report_interval=db_cfg.get("report_interval", DEFAULT_REPORT_INTERVAL))
+
+    def filter(self, values: dict) -> dict:
+        """Returns the values that changed beyond their deadband or are due for a heartbeat"""
+        now = self.clock()
+        result = {}
+        for address, value in values.items():
+            if value is None:
+                continue
+            last = self._last.get(address)
+            if last is not None:
+                last_value, last_time = last
+                band_abs, band_rel = self.thresholds.get(address, (0.0, 0.0))
+                if abs(value - last_value) <= max(band_abs, band_rel * abs(last_value)) \
+                        and now - last_time < self.max_silence:
+                    self.suppressed[address] = self.suppressed.get(address, 0) + 1
+                    continue
+            self._last[address] = (value, now)
+            self.passed[address] = self.passed.get(address, 0) + 1
+            result[address] = value
+        return result
+
+    def report_due(self) -> bool:
+        """True once per report_interval"""
+        now = self.clock()
+        if now - self._last_report < self.report_interval:
+            return False
+        self._last_report = now
+        return True
+
+    def stats(self) -> dict:
+        """Suppression ratios, overall and per register name"""
+        passed = sum(self.passed.values())
+        suppressed = sum(self.suppressed.values())
+        registers = {}
+        for address in sorted(set(self.passed) | set(self.suppressed)):
+            total = self.passed.get(address, 0) + self.suppressed.get(address, 0)
+            registers[REGISTERS[address]["name"]] = round(self.suppressed.get(address, 0) / total, 3)
+        return {
+            "passed": passed,
+            "suppressed": suppressed,
+            "suppression_ratio": round(suppressed / (passed + suppressed), 3) if passed + suppressed else 0.0,
+            "registers": registers,
+        }
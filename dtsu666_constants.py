@@ -35,105 +35,88 @@ FREQUENCY = 0x2044
 TOTAL_IMPORT_ENERGY = 0x401E
 TOTAL_EXPORT_ENERGY = 0x4028
 
+# Register ranges the DTSU666 answers: (first address, number of registers)
+HEADER_RANGE = (0x0000, 0x0036)
+MEASUREMENT_RANGE = (0x2000, 0x0046)
+ENERGY_RANGE = (0x401E, 0x000C)
+MAPPED_RANGES = (HEADER_RANGE, MEASUREMENT_RANGE, ENERGY_RANGE)
+
+# Communication setup in the header range: baud rate code, applied after the write is answered
+BAUD_REGISTER = 0x002D
+BAUD_CODES = {1200: 0, 2400: 1, 4800: 2, 9600: 3}
+
 # Constants for DTSU666 measurement registers
+# deadband_abs / deadband_rel: changes within max(abs, rel * |last value|) are not reported
 
 REGISTERS = {
-    0x2000: {"name": "Voltage_Phase_AB", "func": 3, "words": 2, "factor": 0.1},
-    0x2002: {"name": "Voltage_Phase_BC", "func": 3, "words": 2, "factor": 0.1},
-    0x2004: {"name": "Voltage_Phase_CA", "func": 3, "words": 2, "factor": 0.1},
-    0x2006: {"name": "Voltage_Phase_A",  "func": 3, "words": 2, "factor": 0.1},
-    0x2008: {"name": "Voltage_Phase_B",  "func": 3, "words": 2, "factor": 0.1},
-    0x200A: {"name": "Voltage_Phase_C",  "func": 3, "words": 2, "factor": 0.1},
+    0x2000: {"name": "Voltage_Phase_AB", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
+    0x2002: {"name": "Voltage_Phase_BC", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
+    0x2004: {"name": "Voltage_Phase_CA", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
+    0x2006: {"name": "Voltage_Phase_A",  "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
+    0x2008: {"name": "Voltage_Phase_B",  "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
+    0x200A: {"name": "Voltage_Phase_C",  "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 0.5},
 
-    0x200C: {"name": "Current_Phase_A", "func": 3, "words": 2, "factor": 0.001},
-    0x200E: {"name": "Current_Phase_B", "func": 3, "words": 2, "factor": 0.001},
-    0x2010: {"name": "Current_Phase_C", "func": 3, "words": 2, "factor": 0.001},
+    0x200C: {"name": "Current_Phase_A", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
+    0x200E: {"name": "Current_Phase_B", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
+    0x2010: {"name": "Current_Phase_C", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
 
-    0x2014: {"name": "Active_Power_Phase_A", "func": 3, "words": 2, "factor": 0.1},
-    0x2016: {"name": "Active_Power_Phase_B", "func": 3, "words": 2, "factor": 0.1},
-    0x2018: {"name": "Active_Power_Phase_C", "func": 3, "words": 2, "factor": 0.1},
+    0x2014: {"name": "Active_Power_Phase_A", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x2016: {"name": "Active_Power_Phase_B", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x2018: {"name": "Active_Power_Phase_C", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
 
-    0x201C: {"name": "Reactive_Power_Phase_A", "func": 3, "words": 2, "factor": 0.1},
-    0x201E: {"name": "Reactive_Power_Phase_B", "func": 3, "words": 2, "factor": 0.1},
-    0x2020: {"name": "Reactive_Power_Phase_C", "func": 3, "words": 2, "factor": 0.1},
+    0x201C: {"name": "Reactive_Power_Phase_A", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x201E: {"name": "Reactive_Power_Phase_B", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x2020: {"name": "Reactive_Power_Phase_C", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
 
-    0x202C: {"name": "Power_Factor_Phase_A", "func": 3, "words": 2, "factor": 0.001},
-    0x202E: {"name": "Power_Factor_Phase_B", "func": 3, "words": 2, "factor": 0.001},
-    0x2030: {"name": "Power_Factor_Phase_C", "func": 3, "words": 2, "factor": 0.001},
+    0x202C: {"name": "Power_Factor_Phase_A", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
+    0x202E: {"name": "Power_Factor_Phase_B", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
+    0x2030: {"name": "Power_Factor_Phase_C", "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
 
-    0x2012: {"name": "Total_Active_Power",   "func": 3, "words": 2, "factor": 0.1},
-    0x201A: {"name": "Total_Reactive_Power", "func": 3, "words": 2, "factor": 0.1},
-    0x202A: {"name": "Total_Power_Factor",   "func": 3, "words": 2, "factor": 0.001},
+    0x2012: {"name": "Total_Active_Power",   "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x201A: {"name": "Total_Reactive_Power", "func": 3, "words": 2, "factor": 0.1, "deadband_abs": 5, "deadband_rel": 0.01},
+    0x202A: {"name": "Total_Power_Factor",   "func": 3, "words": 2, "factor": 0.001, "deadband_abs": 0.01},
 
-    0x2044: {"name": "Frequency", "func": 3, "words": 2, "factor": 0.01},
+    0x2044: {"name": "Frequency", "func": 3, "words": 2, "factor": 0.01, "deadband_abs": 0.02},
 
-    0x401E: {"name": "Total_Import_Energy", "func": 3, "words": 2, "factor": 1},
-    0x4028: {"name": "Total_Export_Energy", "func": 3, "words": 2, "factor": 1}
+    0x401E: {"name": "Total_Import_Energy", "func": 3, "words": 2, "factor": 1, "deadband_abs": 0.01},
+    0x4028: {"name": "Total_Export_Energy", "func": 3, "words": 2, "factor": 1, "deadband_abs": 0.01}
 }
 
-# Optional: Liste aller Keys, z.B. für Iterationen
-ALL_KEYS = [
-    0x2000,  # VOLTAGE_PHASE_AB
-    0x2002,  # VOLTAGE_PHASE_BC
-    0x2004,  # VOLTAGE_PHASE_CA
-
-    0x2006,  # VOLTAGE_PHASE_A
-    0x2008,  # VOLTAGE_PHASE_B
-    0x200A,  # VOLTAGE_PHASE_C
-
-    0x200C,  # CURRENT_PHASE_A
-    0x200E,  # CURRENT_PHASE_B
-    0x2010,  # CURRENT_PHASE_C
-
-    0x2014,  # ACTIVE_POWER_PHASE_A
-    0x2016,  # ACTIVE_POWER_PHASE_B
-    0x2018,  # ACTIVE_POWER_PHASE_C
-
-    0x201C,  # REACTIVE_POWER_PHASE_A
-    0x201E,  # REACTIVE_POWER_PHASE_B
-    0x2020,  # REACTIVE_POWER_PHASE_C
-
-    0x202C,  # POWER_FACTOR_PHASE_A
-    0x202E,  # POWER_FACTOR_PHASE_B
-    0x2030,  # POWER_FACTOR_PHASE_C
-
-    0x2012,  # TOTAL_ACTIVE_POWER
-    0x201A,  # TOTAL_REACTIVE_POWER
-    0x202A,  # TOTAL_POWER_FACTOR
-
-    0x2044,  # FREQUENCY
-
-    0x401E,  # TOTAL_IMPORT_ENERGY
-    0x4028,  # TOTAL_EXPORT_ENERGY
-]
-
-FOUR_WIRE_KEYS = [
-    0x2006,  # VOLTAGE_PHASE_A
-    0x2008,  # VOLTAGE_PHASE_B
-    0x200A,  # VOLTAGE_PHASE_C
-
-    0x200C,  # CURRENT_PHASE_A
-    0x200E,  # CURRENT_PHASE_B
-    0x2010,  # CURRENT_PHASE_C
-
-    0x2014,  # ACTIVE_POWER_PHASE_A
-    0x2016,  # ACTIVE_POWER_PHASE_B
-    0x2018,  # ACTIVE_POWER_PHASE_C
-
-    0x201C,  # REACTIVE_POWER_PHASE_A
-    0x201E,  # REACTIVE_POWER_PHASE_B
-    0x2020,  # REACTIVE_POWER_PHASE_C
-
-    0x202C,  # POWER_FACTOR_PHASE_A
-    0x202E,  # POWER_FACTOR_PHASE_B
-    0x2030,  # POWER_FACTOR_PHASE_C
-
-    0x2012,  # TOTAL_ACTIVE_POWER
-    0x201A,  # TOTAL_REACTIVE_POWER
-    0x202A,  # TOTAL_POWER_FACTOR
-
-    0x2044,  # FREQUENCY
+# Register profiles selectable per meter ("profile" in config.json), compiled by register_profile.
+# The order of a profile is the order of its state document.
+PROFILES = {
+    # three-phase four-wire: phase quantities, totals and energy
+    "four_wire": (
+        VOLTAGE_PHASE_A, VOLTAGE_PHASE_B, VOLTAGE_PHASE_C,
+        CURRENT_PHASE_A, CURRENT_PHASE_B, CURRENT_PHASE_C,
+        ACTIVE_POWER_PHASE_A, ACTIVE_POWER_PHASE_B, ACTIVE_POWER_PHASE_C,
+        REACTIVE_POWER_PHASE_A, REACTIVE_POWER_PHASE_B, REACTIVE_POWER_PHASE_C,
+        POWER_FACTOR_PHASE_A, POWER_FACTOR_PHASE_B, POWER_FACTOR_PHASE_C,
+        TOTAL_ACTIVE_POWER, TOTAL_REACTIVE_POWER, TOTAL_POWER_FACTOR,
+        FREQUENCY,
+        TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY,
+    ),
+    # three-phase three-wire: no neutral, so line voltages and totals only
+    "three_wire": (
+        VOLTAGE_PHASE_AB, VOLTAGE_PHASE_BC, VOLTAGE_PHASE_CA,
+        CURRENT_PHASE_A, CURRENT_PHASE_B, CURRENT_PHASE_C,
+        TOTAL_ACTIVE_POWER, TOTAL_REACTIVE_POWER, TOTAL_POWER_FACTOR,
+        FREQUENCY,
+        TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY,
+    ),
+    # DTSU666-H (Huawei variant of the meter): line and phase voltages, active power per phase
+    "dtsu666_h": (
+        VOLTAGE_PHASE_AB, VOLTAGE_PHASE_BC, VOLTAGE_PHASE_CA,
+        VOLTAGE_PHASE_A, VOLTAGE_PHASE_B, VOLTAGE_PHASE_C,
+        CURRENT_PHASE_A, CURRENT_PHASE_B, CURRENT_PHASE_C,
+        ACTIVE_POWER_PHASE_A, ACTIVE_POWER_PHASE_B, ACTIVE_POWER_PHASE_C,
+        TOTAL_ACTIVE_POWER, TOTAL_REACTIVE_POWER, TOTAL_POWER_FACTOR,
+        FREQUENCY,
+        TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY,
+    ),
+    # the full register map
+    "all": tuple(REGISTERS),
+}
 
-    0x401E,  # TOTAL_IMPORT_ENERGY
-    0x4028,  # TOTAL_EXPORT_ENERGY
-]
+ALL_KEYS = list(PROFILES["all"])
+FOUR_WIRE_KEYS = list(PROFILES["four_wire"])
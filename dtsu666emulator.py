@@ -1,43 +1,54 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from startup import StartupTimer, configure_logging  # first, so the startup clock includes the imports below
+
 import asyncio
 import datetime
 import logging
 import signal
-import struct
 
-from pymodbus.server import ModbusSerialServer
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusDeviceContext, ModbusServerContext
-from pymodbus import ModbusDeviceIdentification, FramerType
+from pymodbus.datastore import ModbusServerContext
+from pymodbus.datastore.store import BaseModbusDataBlock
+from pymodbus import ModbusDeviceIdentification
 
 from config import load_config
+from datablocks import DirectDeviceContext, RegisterImageDataBlock
 from dtsu666_constants import *
+from modbus_transport import DEFAULT_TCP_PORT, SERIAL, create_server, transport_of
+from rtu_capture import CaptureWriter
+from telemetry import connection_hooks
 
 CONFIG_FILE = "config.json"
 
-logging.basicConfig(
-    format='%(asctime)s %(levelname)s:%(name)s: %(message)s',
-    level=logging.DEBUG
-)
 logger = logging.getLogger("dtsu666-emulator")
 
 
 class Dtsu666Emulator:
     """Emulator class for Chint DTSU666 energy meter"""
 
-    def __init__(self, datablock:ModbusSequentialDataBlock,
-                 port: str, device_id: int = 1, baudrate: int = 9600):
+    def __init__(self, datablock: BaseModbusDataBlock = None,
+                 port: str = None, device_id: int = 1, baudrate: int = 9600, monitor=None,
+                 recorder=None, startup_timer=None, transport: str = SERIAL, host: str = "",
+                 tcp_port: int = DEFAULT_TCP_PORT):
+        """
+        startup_timer: optional startup.StartupTimer, notes the first served register
+        transport: "serial" (RTU on port), "tcp" or "rtu-over-tcp" (server on
+        host:tcp_port for any number of clients)
+        """
         self.datetime_task = None
         self.port = port
+        self.transport = transport
+        self.endpoint = port if transport == SERIAL else f"{host}:{tcp_port}"
         self.device_id = device_id
         self.baudrate = baudrate
+        self.recorder = recorder
 
         self.server_task = None
         self.stop_event = asyncio.Event()
 
         # Prepare register space
-        self.block = datablock
-        self.store = ModbusDeviceContext(hr=self.block)
+        self.block = datablock if datablock is not None else RegisterImageDataBlock()
+        self.store = DirectDeviceContext(hr=self.block)
         self.context = ModbusServerContext(devices={self.device_id: self.store}, single=False)
 
         # identity
@@ -47,15 +58,15 @@ class Dtsu666Emulator:
         self.identity.VendorUrl = "https://github.com/riptideio/pymodbus"
         self.identity.ProductName = "DTSU666 Energy Meter Emulator"
 
-        self.server = ModbusSerialServer(
-            context=self.context,
-            identity=self.identity,
+        self.server = create_server(
+            self.context,
+            self.identity,
+            transport=transport,
             port=self.port,
-            framer=FramerType.RTU,
             baudrate=self.baudrate,
-            stopbits=1,
-            bytesize=8,
-            parity="N",
+            host=host,
+            tcp_port=tcp_port,
+            hooks=connection_hooks(monitor, recorder, startup_timer),
         )
 
         # header
@@ -79,21 +90,9 @@ class Dtsu666Emulator:
                 now.day, now.month, now.year]
         self._set_values(0x002F, regs)
 
-    def _float_to_registers(self, value: float, byteorder='>'):
-        packed = struct.pack(f"{byteorder}f", float(value))
-        high, low = struct.unpack(f"{byteorder}HH", packed)
-        return [high, low]
-
     def update_values(self, data: dict):
-        for key, value in data.items():
-            if key not in REGISTERS:
-                continue
-            info = REGISTERS[key]
-            addr = info["address"]
-            factor = info.get("factor", 1.0)
-            raw = float(value) / factor
-            regs = self._float_to_registers(raw)
-            self._set_values(addr, regs)
+        """Writes a measurement set {address: value} as one consistent frame"""
+        self.block.update_frame(data)
 
     # --------------------------
     # Background tasks
@@ -109,7 +108,8 @@ class Dtsu666Emulator:
     # --------------------------
 
     async def start(self):
-        logger.info("Starting DTSU666 emulator on %s (slave %d)", self.port, self.device_id)
+        logger.info("Starting DTSU666 emulator on %s %s (slave %d)", self.transport, self.endpoint,
+                    self.device_id)
 
         # Server starten (AsyncIO Start)
         async def run_server():
@@ -143,17 +143,28 @@ class Dtsu666Emulator:
         if hasattr(self, "datetime_task"):
             self.datetime_task.cancel()
 
+        if self.recorder is not None:
+            self.recorder.close()
+
         logger.info("DTSU666 emulator stopped.")
 
 
 async def main():
     cfg = load_config()
     emu_cfg = cfg["emulator"]
-    logging.basicConfig(level=cfg["logging"]["level"])
+    configure_logging(format='%(asctime)s %(levelname)s:%(name)s: %(message)s', level=logging.DEBUG)
+    timer = StartupTimer()
+    timer.mark("imports")
     emu = Dtsu666Emulator(
+        datablock=RegisterImageDataBlock(unmapped=emu_cfg.get("unmapped", "exception")),
         port=emu_cfg["port"],
         device_id=cfg["device"]["id"],
         baudrate=emu_cfg.get("baudrate", 9600),
+        transport=transport_of(emu_cfg),
+        host=emu_cfg.get("host", ""),
+        tcp_port=emu_cfg.get("tcp_port", DEFAULT_TCP_PORT),
+        recorder=CaptureWriter.from_config(cfg, "emulator", server=True),
+        startup_timer=timer,
     )
 
     # test data (example)
@@ -191,12 +202,14 @@ async def main():
     async def updater():
         while not emu.stop_event.is_set():
             emu.update_values(test_data)
+            timer.mark("first_values")
             await asyncio.sleep(1.1)
 
     # -----------------------------
     # Start des Emulators
     # -----------------------------
     await emu.start()
+    timer.mark("emulator_started")
     updater_task = asyncio.create_task(updater())
 
     # -----------------------------
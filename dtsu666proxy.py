@@ -12,126 +12,144 @@ Author: Christian Günther cg-ite@gmx.de
 License: GPLv3
 """
 
-import json
+from startup import StartupTimer, configure_logging  # first, so the startup clock includes the imports below
+
 import logging
 import asyncio
-from datetime import datetime
 
-import paho.mqtt.client as mqtt
+from pymodbus import FramerType
 from pymodbus.client import AsyncModbusSerialClient
-from pymodbus.datastore import ModbusServerContext, ModbusSequentialDataBlock
 from pymodbus.server import StartAsyncSerialServer
-from pymodbus.datastore.remote import RemoteSlaveContext
-from pymodbus.datastore import ModbusDeviceContext, ModbusServerContext
+from pymodbus.datastore import ModbusServerContext
 
-from pymodbus.exceptions import ModbusException
 #from pymodbus.constants import Defaults
 
+from bus_arbiter import BACKGROUND, DEFAULT_GUARD
 from config import load_config
+from datablocks import DirectDeviceContext, MqttReportingDataBlock
+from dtsu666reader import Dtsu666Reader
+from mqtt_publisher import MqttPublisher
+from publish_pipeline import PublishPipeline
+from register_cache import DEFAULT_TTL
+from rtu_capture import CaptureWriter
+from telemetry import Telemetry, trace_hooks
 
-# --------------------------------------------------------------------------- #
-# Logging configuration
-# --------------------------------------------------------------------------- #
-logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 log = logging.getLogger("dtsu666-proxy")
 
-# --------------------------------------------------------------------------- #
-# MQTT Reporting DataBlock
-# --------------------------------------------------------------------------- #
-class MqttReportingDataBlock(ModbusSequentialDataBlock):
+
+async def poll_background(cfg, channel, pipeline, stop_event: asyncio.Event):
     """
-    DataBlock for Modbus RTU server that forwards requests to another Modbus device
-    and publishes every read to MQTT.
+    Polls the configured meters and poll groups for MQTT through an arbiter
+    channel, e.g. arbiter.channel(BACKGROUND), until stop_event is set.
     """
+    reader = Dtsu666Reader(cfg, client=channel)
+    publishers = {meter.device_id: MqttPublisher.from_config(pipeline, cfg, meter.topic_prefix)
+                  for meter in reader.meters}
+
+    def publish(values, _groups, meter):
+        publishers[meter.device_id].publish_values(values)
+
+    try:
+        await reader.poll(publish, stop_event)
+    finally:
+        log.info("Background polling stopped: %s", channel.arbiter.stats())
 
-    def __init__(self, mqtt_client, topic_prefix, reader_client, slave_id):
-        super().__init__(0, [0] * 0x4000)
-        self.mqtt_client = mqtt_client
-        self.topic_prefix = topic_prefix
-        self.reader = reader_client
-        self.slave_id = slave_id
-
-    async def getValues(self, address, count=1):
-        """
-        Called when Modbus master (inverter) reads registers from this server.
-        We'll forward the request to the DTSU666 and publish results to MQTT.
-        """
-        try:
-            rr = await self.reader.read_holding_registers(address, count, slave=self.slave_id)
-            if not rr or rr.isError():
-                log.warning(f"Read error from DTSU666 @ {address}")
-                return [0] * count
-
-            values = rr.registers
-            payload = {
-                "timestamp": datetime.now().isoformat(),
-                "address": address,
-                "values": values,
-            }
-            topic = f"{self.topic_prefix}/read/{address}"
-            self.mqtt_client.publish(topic, json.dumps(payload))
-            log.info(f"MQTT publish {topic}: {values}")
-            return values
-
-        except ModbusException as e:
-            log.error(f"Modbus read exception: {e}")
-            return [0] * count
-
-        except Exception as e:
-            log.exception(f"Error forwarding read: {e}")
-            return [0] * count
 
 # --------------------------------------------------------------------------- #
 # Main async function
 # --------------------------------------------------------------------------- #
 async def main():
-    cfg = load_config("config.json")
-
-    # MQTT setup
-    mqtt_client = mqtt.Client()
-    mqtt_client.username_pw_set(cfg["mqtt"]["username"], cfg["mqtt"]["password"])
-    mqtt_client.connect(cfg["mqtt"]["host"], cfg["mqtt"]["port"], 60)
-    mqtt_client.loop_start()
-
-    # Serial client to DTSU666
-    reader_client = AsyncModbusSerialClient(
-        method="rtu",
-        port=cfg["reader"]["port"],
-        baudrate=cfg["reader"]["baudrate"],
-        parity=cfg["reader"]["parity"],
-        stopbits=cfg["reader"]["stopbits"],
-        bytesize=8,
-        timeout=cfg["reader"]["timeout"]
-    )
-
-    await reader_client.connect()
-    if not reader_client.connected:
-        log.error("Could not connect to DTSU666 serial port.")
-        return
-
-    # Create Modbus RTU server that the inverter connects to
-    datablock = MqttReportingDataBlock(
-        mqtt_client,
-        cfg["mqtt"]["topic_prefix"],
-        reader_client.protocol,
-        cfg["slave"]["id"]
-    )
-
-    store = ModbusDeviceContext(hr=datablock, zero_mode=True)
-    context = ModbusServerContext(slaves={cfg["slave"]["id"]: store}, single=False)
-
-    log.info("Starting DTSU666 MQTT RTU Proxy ...")
-    log.info(f"Reader port: {cfg['reader']['port']} → Emulator port: {cfg['emulator']['port']}")
-
-    await StartAsyncSerialServer(
-        context=context,
-        port=cfg["emulator"]["port"],
-        framer="rtu",
-        baudrate=cfg["emulator"]["baudrate"],
-        stopbits=cfg["emulator"]["stopbits"],
-        bytesize=8,
-        parity=cfg["emulator"]["parity"]
-    )
+    # every response of the proxy carries a live value, the first one counts
+    timer = StartupTimer(after=None)
+    timer.mark("imports")
+    cfg = load_config()
+    configure_logging()
+
+    # MQTT setup: paho is imported in a worker thread while the serial port opens
+    pipeline = PublishPipeline.from_config(None, cfg)
+
+    async def run_pipeline():
+        await pipeline.start_from_config(cfg)
+        timer.mark("mqtt_started")
+        await pipeline.run()
+
+    pipeline_task = asyncio.create_task(run_pipeline())
+
+    stop_event = asyncio.Event()
+    telemetry = Telemetry.from_config(cfg)
+    diagnostics_task = None
+    if telemetry is not None:
+        telemetry.startup_timer = timer
+        await telemetry.start_http()
+        diagnostics_task = asyncio.create_task(
+            telemetry.publish_loop(MqttPublisher.from_config(pipeline, cfg), stop_event))
+
+    poll_task = None
+    upstream_recorder = CaptureWriter.from_config(cfg, "proxy-upstream")
+    proxy_recorder = CaptureWriter.from_config(cfg, "proxy", server=True)
+
+    try:
+        # Serial client to DTSU666
+        reader_client = AsyncModbusSerialClient(
+            framer=FramerType.RTU,
+            port=cfg["reader"]["port"],
+            baudrate=cfg["reader"]["baudrate"],
+            parity=cfg["reader"]["parity"],
+            stopbits=cfg["reader"]["stopbits"],
+            bytesize=8,
+            timeout=cfg["reader"]["timeout"],
+            **trace_hooks(telemetry.monitor("proxy-upstream") if telemetry else None, upstream_recorder),
+        )
+
+        await reader_client.connect()
+        if not reader_client.connected:
+            log.error("Could not connect to DTSU666 serial port.")
+            return
+        timer.mark("serial_open")
+
+        # Create Modbus RTU server that the inverter connects to
+        datablock = MqttReportingDataBlock(
+            MqttPublisher.from_config(pipeline, cfg),
+            reader_client,
+            cfg["device"]["id"],
+            cache_ttl=cfg.get("proxy", {}).get("cache_ttl", DEFAULT_TTL),
+            prefetch=cfg.get("proxy", {}).get("prefetch", True),
+            guard=cfg.get("proxy", {}).get("guard", DEFAULT_GUARD),
+        )
+        if cfg.get("proxy", {}).get("poll", False):
+            # MQTT polling in the gaps between the inverter's requests
+            poll_task = asyncio.create_task(
+                poll_background(cfg, datablock.arbiter.channel(BACKGROUND), pipeline, stop_event))
+
+        store = DirectDeviceContext(hr=datablock)
+        context = ModbusServerContext(devices={cfg["device"]["id"]: store}, single=False)
+
+        log.info("Starting DTSU666 MQTT RTU Proxy ...")
+        log.info(f"Reader port: {cfg['reader']['port']} → Emulator port: {cfg['emulator']['port']}")
+
+        await StartAsyncSerialServer(
+            context=context,
+            port=cfg["emulator"]["port"],
+            framer=FramerType.RTU,
+            baudrate=cfg["emulator"]["baudrate"],
+            stopbits=cfg["emulator"]["stopbits"],
+            bytesize=8,
+            parity=cfg["emulator"]["parity"],
+            **trace_hooks(telemetry.monitor("proxy", server=True) if telemetry else None, proxy_recorder, timer),
+        )
+    finally:
+        stop_event.set()
+        if poll_task is not None:
+            # the poller ends after its current cycle
+            await poll_task
+        if diagnostics_task is not None:
+            diagnostics_task.cancel()
+            await telemetry.stop_http()
+        for recorder in (upstream_recorder, proxy_recorder):
+            if recorder is not None:
+                recorder.close()
+        pipeline_task.cancel()
+        pipeline.stop()
 
 # --------------------------------------------------------------------------- #
 # Entrypoint
@@ -3,82 +3,179 @@ import argparse
 import asyncio
 import logging
 import signal
-from pymodbus.pdu.register_message import ReadHoldingRegistersResponse
-import pymodbus.client as ModbusClient
-from pymodbus import (
-    FramerType,
-)
+import time
 
 from config import load_config
-from dtsu666_constants import FOUR_WIRE_KEYS, REGISTERS
+from dtsu666_constants import FOUR_WIRE_KEYS
+from modbus_transport import POOL, endpoint
+from poll_scheduler import BusScheduler, groups_from_config, resolve_register
+from read_planner import DEFAULT_MAX_GAP, DEFAULT_MAX_REGISTERS
+from register_profile import REGISTER_TABLE, compile_profile
+from resilience import ReadResult, TransactionGuard
+from startup import configure_logging
+from telemetry import trace_hooks
 
 CONFIG_FILE = "config.json"
 
-# --------------------------------------------------------------------------- #
-# Logging configuration
-# --------------------------------------------------------------------------- #
-logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
 log = logging.getLogger("dtsu666reader")
 
+
+class Meter:
+    """One DTSU666 on the bus with its own register profile, poll rates and topic prefix"""
+
+    def __init__(self, device_id: int, name: str, topic_prefix: str, profile, poll_groups):
+        """profile: a register_profile.RegisterProfile, a PROFILES name or a list of registers"""
+        self.device_id = device_id
+        self.name = name
+        self.topic_prefix = topic_prefix
+        self.profile = compile_profile(profile)
+        self.keys = self.profile.keys
+        self.poll_groups = poll_groups
+        self.scheduler = None
+        self.failures = 0
+        self.suspended_until = 0.0
+
+    def __repr__(self):
+        return f"Meter({self.name!r}, id={self.device_id})"
+
+
+def meters_from_config(cfg) -> list:
+    """
+    Builds the meters from cfg["devices"].
+
+    Every entry needs an "id" and may set "name", "topic_prefix", "profile"
+    (a PROFILES name or a list of registers), "poll_groups" and "poll_interval".
+    Without a devices list the single cfg["device"] is polled.
+    """
+    devices = cfg.get("devices") or [{"id": cfg["device"]["id"]}]
+    prefix = cfg["mqtt"]["topic_prefix"]
+    meters = []
+    for device in devices:
+        name = device.get("name", f"dtsu666_{device['id']}")
+        profile = device.get("profile", "four_wire")
+        profile = compile_profile(profile if isinstance(profile, str) else [resolve_register(r) for r in profile])
+        groups = groups_from_config({
+            "poll_groups": device.get("poll_groups", cfg.get("poll_groups")),
+            "poll_interval": device.get("poll_interval", cfg.get("poll_interval", 30)),
+        }, profile.keys)
+        topic_prefix = device.get("topic_prefix", prefix if len(devices) == 1 else f"{prefix}/{name}")
+        meters.append(Meter(device["id"], name, topic_prefix, profile, groups))
+    return meters
+
+
 class Dtsu666Reader:
     """Reader class for Chint DTSU666 energy meter"""
 
-    def __init__(self, cfg):
-        self.device_id = cfg["device"]["id"]
-        self.instrument = ModbusClient.AsyncModbusSerialClient(
-            framer=FramerType.RTU,
-            port=cfg["reader"]["port"],
-            timeout=cfg["reader"]["timeout"],
-            baudrate=cfg["reader"]["baudrate"],
-            parity=cfg["reader"]["parity"],
-            stopbits=cfg["reader"]["stopbits"],
-            bytesize=8,
-            # retries=3,
-            # handle_local_echo=False,
-        )
+    def __init__(self, cfg, monitor=None, client=None):
+        """
+        monitor: optional telemetry.TransactionMonitor for the serial client
+        client: optional client to read through instead of the pooled client
+        of cfg["reader"], e.g. a bus_arbiter.ArbiterChannel of the proxy
+        """
+        self.meters = meters_from_config(cfg)
+        self.device_id = self.meters[0].device_id
+        owns_client = client is None
+        if owns_client:
+            # persistent client of the configured serial port or TCP endpoint, shared
+            # with other readers of the same endpoint
+            client = POOL.acquire(cfg["reader"], **trace_hooks(monitor))
+        self.instrument = client
+        self._owns_client = owns_client
+        self.endpoint = endpoint(cfg["reader"]) if owns_client else "the shared bus"
+        self.guard = TransactionGuard.from_config(self.instrument, cfg["reader"],
+                                                  POOL.lock(client) if owns_client else None)
+        if self._owns_client:
+            # reconnect the port only if every meter stopped answering, the breakers deal with single meters
+            self.instrument.set_max_no_responses(
+                len(self.meters) * max(self.guard.breaker_threshold, 1) * (self.guard.retries + 1))
+        # silence between the end of a response and the next request, for meters with a slow turnaround
+        self.frame_gap = cfg["reader"].get("frame_gap", 0.0)
+        self._last_transaction = 0.0
+        self.max_registers = cfg["reader"].get("max_registers", DEFAULT_MAX_REGISTERS)
+        self.max_gap = cfg["reader"].get("max_gap", DEFAULT_MAX_GAP)
+        self._plans = {}
 
     async def connect(self):
-        await self.instrument.connect()
+        if self._owns_client:
+            await POOL.connect(self.instrument)
+        else:
+            await self.instrument.connect()
         if not self.instrument.connected:
-            log.error("Could not connect to DTSU666 serial port.")
+            log.error("Could not connect to DTSU666 at %s.", self.endpoint)
             return
-        log.info("Connected to DTSU666 serial port.")
+        log.info("Connected to DTSU666 at %s.", self.endpoint)
 
     def close(self):
-        self.instrument.close()
-        log.info("Close connection to DTSU666 serial port.")
-
-    async def read_values(self, count=1):
-        """Reads the most important values from the DTSU666"""
+        if self._owns_client:
+            POOL.release(self.instrument)
+        else:
+            self.instrument.close()
+        log.info("Close connection to DTSU666 at %s.", self.endpoint)
+
+    def plan(self, keys=FOUR_WIRE_KEYS):
+        """Returns the block decoders for the given keys, shared through the compiled profile"""
+        keys = tuple(keys)
+        decoders = self._plans.get(keys)
+        if decoders is None:
+            decoders = compile_profile(keys).decoders(self.max_registers, self.max_gap)
+            self._plans[keys] = decoders
+            log.debug("Read plan for %i registers: %s", len(keys), [decoder.span for decoder in decoders])
+        return decoders
+
+    async def wait_frame_gap(self):
+        """Waits until the bus was silent for frame_gap seconds since the last transaction"""
+        if self.frame_gap:
+            delay = self._last_transaction + self.frame_gap - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def read_span(self, device_id: int, decoder):
+        """Reads and decodes one span, returns None if the read failed"""
+        span = decoder.span
+        await self.wait_frame_gap()
+        try:
+            registers = await self.guard.read(device_id, span.start, span.count)
+        finally:
+            self._last_transaction = time.monotonic()
+        if registers is None:
+            return None
+        return decoder.decode(registers)
+
+    async def read_values(self, keys=FOUR_WIRE_KEYS, device_id=None) -> ReadResult:
+        """Reads the most important values from the DTSU666, registers of failed reads are missing"""
+        if device_id is None:
+            device_id = self.device_id
         data = {}
-        for address in FOUR_WIRE_KEYS:
-            try:
-                spec = REGISTERS[address]
-                rr = await self.instrument.read_holding_registers(address,
-                                                                  count=spec["words"],
-                                                                  device_id=self.device_id)
-
-                if not isinstance(rr, ReadHoldingRegistersResponse):
-                    continue
-                if not rr or rr.isError():
-                    log.warning(f"Read error from DTSU666 @ {address}")
-                    return [0] * count
-
-                raw = self.instrument.convert_from_registers(
-                    rr.registers, word_order='big',
-                    data_type=self.instrument.DATATYPE.FLOAT32,
-                    string_encoding="ascii")
-                data[address] = raw * spec["factor"]
-            except Exception as e:
-                print(f"Read error {address}: {e}")
-                data[address] = None
-        return data
+        missing = []
+        for decoder in self.plan(keys):
+            values = await self.read_span(device_id, decoder)
+            if values is None:
+                missing.extend(decoder.keys)
+            else:
+                data.update(values)
+        return ReadResult(data, missing)
+
+    async def poll(self, callback, stop_event: asyncio.Event):
+        """
+        Polls the register groups of all meters at their own rates until stop_event is set.
+
+        callback is called with the values, the polled groups and the meter.
+        """
+        scheduler = BusScheduler(self.meters)
+        for meter in self.meters:
+            log.info("Polling %s (id %i): %s", meter.name, meter.device_id,
+                     ", ".join(f"{g.name} every {g.interval:g} s" for g in meter.poll_groups))
+        await scheduler.run(self.plan, self.read_span, callback, stop_event)
+        overruns = sum(meter.scheduler.overruns for meter in self.meters)
+        if overruns:
+            log.warning("%i poll slot(s) skipped due to overruns", overruns)
 
 async def main():
     """Reads the consumption data of a dtsu666 once"""
 
     # load defaults from config.json
     config = load_config()
+    configure_logging()
 
     parser = argparse.ArgumentParser(
         description=(
@@ -87,15 +184,32 @@ async def main():
             "to a DTSU666 energy meter"
         )
     )
+    parser.add_argument("--poll", action="store_true",
+                        help="poll the configured register groups until interrupted")
+    args = parser.parse_args()
 
     reader = Dtsu666Reader(
         cfg=config
     )
 
     await reader.connect()
+    if args.poll:
+        def print_values(values, groups, meter):
+            log.info("%s %s: %s", meter.name, "+".join(g.name for g in groups),
+                     ", ".join(f"{REGISTER_TABLE[k].name}={v}" for k, v in values.items()))
+
+        stop_event = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop_event.set)
+        await reader.poll(print_values, stop_event)
+        reader.close()
+        return
+
     values = await reader.read_values()
     if values:
         for k, v in values.items():
+            if v is None:
+                print(f"{k:30}: n/a")
+                continue
             print(f"{k:30}: {v:.3f}")
     reader.close()
 
@@ -4,34 +4,42 @@
 import asyncio
 import logging
 import signal
-from pymodbus.client import AsyncModbusSerialClient
 
 from datablocks import LoggingDataBlock
-from dtsu666reader import Dtsu666Reader
 from dtsu666emulator import Dtsu666Emulator   # <-- Deine Emulator-Klasse importieren
 from config import load_config
-from dtsu666_constants import REGISTERS
+from modbus_transport import DEFAULT_TCP_PORT, transport_of
+from startup import configure_logging
 
-
-# ------------------------------------------------------------
-# Logging
-# ------------------------------------------------------------
-logging.basicConfig(
-    filename="reader.txt",
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
 logger = logging.getLogger("dtsu-reader")
 
+
+async def flush_access_stats(block: LoggingDataBlock, stop_event: asyncio.Event):
+    """Logs the access summary when an interval is due, also if the inverter stopped reading"""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=max(block.stats.remaining(), 0.1))
+        except asyncio.TimeoutError:
+            if block.stats.due():
+                block.flush_stats()
+
+
 async def main():
     cfg = load_config()
     emu_cfg = cfg["emulator"]
+    configure_logging(filename="reader.txt", format="%(asctime)s [%(levelname)s] %(message)s")
 
     emulator = Dtsu666Emulator(
-        datablock= LoggingDataBlock(),
+        datablock= LoggingDataBlock(
+            mode=emu_cfg.get("access_log", "aggregate"),
+            summary_interval=emu_cfg.get("access_summary_interval", 60),
+        ),
         port=emu_cfg["port"],
         device_id=cfg["device"]["id"],
         baudrate=emu_cfg.get("baudrate", 9600),
+        transport=transport_of(emu_cfg),
+        host=emu_cfg.get("host", ""),
+        tcp_port=emu_cfg.get("tcp_port", DEFAULT_TCP_PORT),
     )
 
     # Start Emulator
@@ -39,6 +47,9 @@ async def main():
 
     # Signal handling
     stop_event = asyncio.Event()
+    flush_task = None
+    if emulator.block.stats is not None:
+        flush_task = asyncio.create_task(flush_access_stats(emulator.block, stop_event))
 
     def shutdown_handler(*args):
         logger.info("Shutdown signal received...")
@@ -46,3 +57,14 @@ async def main():
 
     loop = asyncio.get_running_loop()
     loop.add_signal_handler(signal.SIGINT, shutdown_handler)
+    loop.add_signal_handler(signal.SIGTERM, shutdown_handler)
+
+    await stop_event.wait()
+    if flush_task is not None:
+        await flush_task
+    await emulator.stop()
+    emulator.block.flush_stats()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,150 +1,232 @@
+#!/usr/bin/env python3
+"""
+dtsu666-mqtt-gateway
+-------------------------------------------------
+Unified gateway for the DTSU666 energy meter.
+
+- Polls the DTSU666 with Dtsu666Reader.
+- Writes every decoded read straight into the register image of the
+  Dtsu666Emulator, which serves it to the inverter. If no values came in
+  for emulator.stale_periods poll periods (e.g. the meter died), the
+  emulator answers GATEWAY_NO_RESPONSE instead of frozen values.
+- Publishes the values to MQTT through the non-blocking publish pipeline,
+  every meter on the bus under its own topic prefix.
+- Optionally aggregates power into 1 s/1 min/15 min windows with
+  integrated import/export energy, published when a window closes.
+- Keeps an optional on-disk history per meter for backfills after
+  MQTT or Home Assistant outages.
+
+Reader, emulator and MQTT share one asyncio loop, no broker is involved
+between reading the meter and serving the inverter.
+
+On start the serial port, the emulator server and the metrics endpoint
+are opened concurrently while paho is imported in a worker thread, and
+polling starts as soon as the serial side is up. MQTT messages of the
+first cycles wait in the pipeline until the client is there. The time
+to first served register is logged and exported by the telemetry.
+"""
+
+from startup import StartupTimer, configure_logging  # first, so the startup clock includes the imports below
+
 import asyncio
 import logging
-import json
-import paho.mqtt.client as mqtt
-
-from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
-from pymodbus.server.async_io import StartSerialServer
+import signal
 
+from aggregation import WindowAggregator
 from config import load_config
-from dtsu666_constants import REGISTERS, VOLTAGE_PHASE_A, CURRENT_PHASE_A, TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY
+from datablocks import DEFAULT_STALE_PERIODS, RegisterImageDataBlock
+from dtsu666_constants import VOLTAGE_PHASE_A, CURRENT_PHASE_A, TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY
+from dtsu666emulator import Dtsu666Emulator
 from dtsu666reader import Dtsu666Reader
+from history_store import HistoryStore, start_history_http
+from modbus_transport import DEFAULT_TCP_PORT, transport_of
+from mqtt_publisher import MqttPublisher
+from publish_pipeline import PublishPipeline
+from rtu_capture import CaptureWriter
+from telemetry import Telemetry
 
-CONFIG_FILE = "config.json"
-config = load_config(CONFIG_FILE)
-logging.basicConfig(level=config['logging']['level'])
 logger = logging.getLogger("dtsu666-gateway")
 
-# ---------------------------------------------------------------------------
-# Konfiguration laden
-# ---------------------------------------------------------------------------
-
-MQTT_BROKER = config["mqtt"]["broker"]
-MQTT_PORT = config["mqtt"]["port"]
-MQTT_USERNAME = config["mqtt"]["username"]
-MQTT_PASSWORD = config["mqtt"]["password"]
-MQTT_TOPIC_PREFIX = config["mqtt"]["topic_prefix"]
-
-READER_PORT = config["dtsu666"]["port"]
-READER_SLAVE_ID = config["dtsu666"]["slave_id"]
-READER_BAUD = config["dtsu666"]["baudrate"]
-READ_INTERVAL = config["dtsu666"]["interval_sec"]
-
-EMU_PORT = config["emulator"]["port"]
-EMU_SLAVE_ID = config["emulator"]["slave_id"]
-EMU_BAUD = config["emulator"]["baudrate"]
-
-REG = config["registers"]
-
-# ---------------------------------------------------------------------------
-# MQTT Client
-# ---------------------------------------------------------------------------
-mqtt_client = mqtt.Client()
-if MQTT_USERNAME:
-    mqtt_client.username_pw_set(username=MQTT_USERNAME, password=MQTT_PASSWORD)
-
-shared_values = {
-    "meter_type": 0,
-    "voltage": 0.0,
-    "current": 0.0,
-    "power": 0.0
-}
-
-def on_connect(client, userdata, flags, rc):
-    logger.info("MQTT connected with result code %s", rc)
-    client.subscribe(f"{MQTT_TOPIC_PREFIX}/#")
-
-def on_message(client, userdata, msg):
-    topic = msg.topic.split("/")[-1]
-    try:
-        val = float(msg.payload.decode())
-    except ValueError:
-        return
-    if topic in shared_values:
-        shared_values[topic] = val
-
-mqtt_client.on_connect = on_connect
-mqtt_client.on_message = on_message
-mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-
-# ---------------------------------------------------------------------------
-# Reader Task
-# ---------------------------------------------------------------------------
-reader = Dtsu666Reader(READER_PORT, READER_BAUD, READER_SLAVE_ID)
-
-def read_registers_once():
-    try:
-        values = reader.read_values()
-        # Beispielwerte ins Log
+
+class Gateway:
+    """Runs reader, emulator and MQTT publisher in one process"""
+
+    def __init__(self, cfg, reader: Dtsu666Reader, emulator: Dtsu666Emulator = None,
+                 publishers: dict = None, history: dict = None, aggregators: dict = None,
+                 startup_timer: StartupTimer = None):
+        """
+        publishers, history and aggregators map the device id of a meter to
+        its MqttPublisher, HistoryStore and WindowAggregator
+        """
+        self.cfg = cfg
+        self.reader = reader
+        self.emulator = emulator
+        self.publishers = publishers or {}
+        self.history = history or {}
+        self.aggregators = aggregators or {}
+        self.startup_timer = startup_timer
+        # the meter whose values are served to the inverter
+        self.emulator_source = cfg["emulator"].get("source", reader.meters[0].device_id)
+
+    def on_values(self, values: dict, groups, meter):
+        """Called by the poll scheduler with the values of one cycle"""
+        # the inverter sees the new values right after the read, MQTT comes second
+        if self.emulator is not None and meter.device_id == self.emulator_source:
+            self.emulator.update_values(values)
+            if self.startup_timer is not None:
+                self.startup_timer.mark("first_values")
+        publisher = self.publishers.get(meter.device_id)
+        if publisher is not None:
+            publisher.publish_values(values)
+        aggregator = self.aggregators.get(meter.device_id)
+        if aggregator is not None:
+            for window, document in aggregator.add(values):
+                if publisher is not None:
+                    publisher.publish_aggregate(window, document)
+        store = self.history.get(meter.device_id)
+        if store is not None:
+            store.add(values)
         logger.debug(
-            "Some DTSU reading for debugging: "
-            f"{VOLTAGE_PHASE_A}={values.get(VOLTAGE_PHASE_A)} "
-            f"{CURRENT_PHASE_A}={values.get(CURRENT_PHASE_A)} "
-            f"{TOTAL_IMPORT_ENERGY}={values.get(TOTAL_IMPORT_ENERGY)} "
-            f"{TOTAL_EXPORT_ENERGY}={values.get(TOTAL_EXPORT_ENERGY)} "
+            "DTSU reading %s (%s): %s=%s %s=%s %s=%s %s=%s",
+            meter.name, "+".join(group.name for group in groups),
+            VOLTAGE_PHASE_A, values.get(VOLTAGE_PHASE_A),
+            CURRENT_PHASE_A, values.get(CURRENT_PHASE_A),
+            TOTAL_IMPORT_ENERGY, values.get(TOTAL_IMPORT_ENERGY),
+            TOTAL_EXPORT_ENERGY, values.get(TOTAL_EXPORT_ENERGY),
         )
 
-        # MQTT Publishes
-        for key, val in values.items():
-            if val is not None:
-                mqtt_client.publish(f"{MQTT_TOPIC_PREFIX}/{key}", val)
-
-        # shared_values für Emulator updaten
-        shared_values = values
-
-    except Exception as e:
-        logger.error("Fehler beim Lesen: %s", e)
-
-async def reader_task():
-    while True:
-        read_registers_once()
-        mqtt_client.loop(0.1)
-        await asyncio.sleep(READ_INTERVAL)
-
-# ---------------------------------------------------------------------------
-# Emulator – holt Werte aus MQTT
-# ---------------------------------------------------------------------------
-class MQTTSynchronizedDataBlock(ModbusSequentialDataBlock):
-    def __init__(self):
-        super().__init__(0, [0] * 0x3000)
-
-    def getValues(self, address, count=1):
-        if address == REG["meter_type"]:
-            return [int(shared_values["meter_type"])]
-        elif address == REG["voltage"]:
-            return [int(shared_values["voltage"] * 10)]
-        elif address == REG["current"]:
-            return [int(shared_values["current"] * 100)]
-        elif address == REG["power"]:
-            return [int(shared_values["power"])]
-        return [0] * count
-
-async def run_emulator():
-    store = ModbusSlaveContext(
-        hr=MQTTSynchronizedDataBlock(),
-        zero_mode=True
-    )
-    context = ModbusServerContext(slaves={EMU_SLAVE_ID: store}, single=False)
-
-    await StartSerialServer(
-        context=context,
-        port=EMU_PORT,
-        framer="rtu",
-        baudrate=EMU_BAUD,
-        stopbits=1,
-        bytesize=8,
-        parity="N"
-    )
-
-# ---------------------------------------------------------------------------
-# Main
-# ---------------------------------------------------------------------------
+    async def run(self, stop_event: asyncio.Event):
+        """Polls until stop_event is set"""
+        # windows of a meter that stopped answering are closed on a timer
+        tasks = [asyncio.create_task(aggregator.run(self.publishers[device_id].publish_aggregate, stop_event))
+                 for device_id, aggregator in self.aggregators.items() if device_id in self.publishers]
+        try:
+            await self.reader.poll(self.on_values, stop_event)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
 async def main():
-    task1 = asyncio.create_task(reader_task())
-    task2 = asyncio.create_task(run_emulator())
-    while True:
-        mqtt_client.loop(0.1)
-        await asyncio.sleep(0.1)
+    timer = StartupTimer()
+    timer.mark("imports")
+    cfg = load_config()
+    configure_logging(cfg)
+
+    telemetry = Telemetry.from_config(cfg)
+    if telemetry is not None:
+        telemetry.startup_timer = timer
+
+    # MQTT: messages are queued until the client exists, paho is imported in a worker thread
+    pipeline = PublishPipeline.from_config(None, cfg)
+
+    async def run_pipeline():
+        await pipeline.start_from_config(cfg)
+        timer.mark("mqtt_started")
+        await pipeline.run()
+
+    pipeline_task = asyncio.create_task(run_pipeline())
+
+    # Reader
+    reader = Dtsu666Reader(cfg, telemetry.monitor("reader") if telemetry else None)
+    publishers = {meter.device_id: MqttPublisher.from_config(pipeline, cfg, meter.topic_prefix)
+                  for meter in reader.meters}
+
+    # Emulator
+    emulator = None
+    emu_cfg = cfg["emulator"]
+    if emu_cfg.get("enabled", False):
+        # the served image expires after stale_periods periods of the source meter's fastest group
+        source = emu_cfg.get("source", reader.meters[0].device_id)
+        period = min((group.interval for meter in reader.meters if meter.device_id == source
+                      for group in meter.poll_groups), default=cfg.get("poll_interval", 30))
+        emulator = Dtsu666Emulator(
+            datablock=RegisterImageDataBlock(unmapped=emu_cfg.get("unmapped", "exception"),
+                                             max_age=emu_cfg.get("stale_periods", DEFAULT_STALE_PERIODS) * period),
+            port=emu_cfg["port"],
+            device_id=cfg["device"]["id"],
+            baudrate=emu_cfg.get("baudrate", 9600),
+            transport=transport_of(emu_cfg),
+            host=emu_cfg.get("host", ""),
+            tcp_port=emu_cfg.get("tcp_port", DEFAULT_TCP_PORT),
+            monitor=telemetry.monitor("emulator", server=True) if telemetry else None,
+            recorder=CaptureWriter.from_config(cfg, "emulator", server=True),
+            startup_timer=timer,
+        )
+
+    # Aggregation
+    aggregators = {}
+    for meter in reader.meters:
+        aggregator = WindowAggregator.from_config(cfg)
+        if aggregator is not None:
+            aggregators[meter.device_id] = aggregator
+
+    # History
+    history = {}
+    for meter in reader.meters:
+        store = HistoryStore.from_config(cfg, meter)
+        if store is not None:
+            history[meter.device_id] = store
+
+    async def connect_reader():
+        await reader.connect()
+        timer.mark("serial_open")
+
+    async def start_emulator():
+        await emulator.start()
+        timer.mark("emulator_started")
+
+    history_server = None
+
+    async def start_history():
+        nonlocal history_server
+        history_server = await start_history_http(
+            cfg, {meter.name: history[meter.device_id] for meter in reader.meters if meter.device_id in history})
+
+    # nothing of this depends on the other parts, open it all at once
+    starts = [connect_reader()]
+    if emulator is not None:
+        starts.append(start_emulator())
+    if telemetry is not None:
+        starts.append(telemetry.start_http())
+    if history:
+        starts.append(start_history())
+    await asyncio.gather(*starts)
+
+    stop_event = asyncio.Event()
+
+    def shutdown_handler(*_args):
+        logger.info("Shutdown signal received...")
+        stop_event.set()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, shutdown_handler)
+    loop.add_signal_handler(signal.SIGTERM, shutdown_handler)
+
+    diagnostics_task = None
+    if telemetry is not None:
+        diagnostics_task = asyncio.create_task(
+            telemetry.publish_loop(MqttPublisher.from_config(pipeline, cfg), stop_event))
+
+    gateway = Gateway(cfg, reader, emulator, publishers, history, aggregators, startup_timer=timer)
+    try:
+        await gateway.run(stop_event)
+    finally:
+        reader.close()
+        if diagnostics_task is not None:
+            diagnostics_task.cancel()
+            await telemetry.stop_http()
+        if history_server is not None:
+            history_server.close()
+            await history_server.wait_closed()
+        for store in history.values():
+            store.close()
+        if emulator is not None:
+            await emulator.stop()
+        pipeline_task.cancel()
+        pipeline.stop()
+        logger.info("Shutdown complete.")
+
 
 if __name__ == "__main__":
     try:
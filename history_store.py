@@ -0,0 +1,265 @@
+"""
+Ring-buffer history of DTSU666 values
+
+Every register keeps a ring of recent raw samples plus min/max/avg
+rollups at several resolutions, each a fixed-size ring of float64
+records. All rings live in one memory-mapped file, so the history
+survives restarts and the memory used never grows:
+
+    header (4096 bytes): magic, layout as JSON
+    per register: raw ring, then one ring per rollup resolution
+    ring: head, size, capacity * record
+    raw record: timestamp, value
+    rollup record: bucket start, min, max, sum, count
+
+A file written with a different layout (registers, capacities,
+resolutions) is started over. Timestamps are wall-clock seconds.
+
+query() serves backfills; HistoryStore.routes() exposes it on a local
+HTTP endpoint:
+
+    GET /history?meter=dtsu666_1&register=Total_Active_Power&since=<ts>&until=<ts>&resolution=60
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from dtsu666_constants import FOUR_WIRE_KEYS
+from http_endpoint import JSON, start_http_server
+from poll_scheduler import resolve_register
+from register_profile import REGISTER_TABLE
+
+log = logging.getLogger("dtsu666-history")
+
+MAGIC = b"DTSUHIS1"
+HEADER_SIZE = 4096
+HEADER = struct.Struct("<8sI")
+RAW_WIDTH = 2
+ROLLUP_WIDTH = 5
+
+DEFAULT_DIRECTORY = "history"
+DEFAULT_RAW_SAMPLES = 3600
+# (resolution in seconds, number of buckets): 1 day of minutes, 30 days of 15 minutes, 90 days of hours
+DEFAULT_ROLLUPS = ((60, 1440), (900, 2880), (3600, 2160))
+DEFAULT_SYNC_INTERVAL = 60
+DEFAULT_HTTP_HOST = "127.0.0.1"
+DEFAULT_HTTP_PORT = 9109
+
+
+class RingSeries:
+    """Fixed-size ring of float64 records inside a shared buffer"""
+
+    __slots__ = ("meta", "data", "width", "capacity")
+
+    def __init__(self, buffer, offset: int, width: int, capacity: int):
+        self.meta = buffer[offset:offset + 2]
+        self.data = buffer[offset + 2:offset + 2 + width * capacity]
+        self.width = width
+        self.capacity = capacity
+
+    @staticmethod
+    def size(width: int, capacity: int) -> int:
+        """Number of float64 slots a ring takes"""
+        return 2 + width * capacity
+
+    def __len__(self):
+        return int(self.meta[1])
+
+    def append(self, record):
+        head = int(self.meta[0])
+        start = head * self.width
+        for i, value in enumerate(record):
+            self.data[start + i] = value
+        self.meta[0] = (head + 1) % self.capacity
+        self.meta[1] = min(len(self) + 1, self.capacity)
+
+    def last_index(self) -> int:
+        return ((int(self.meta[0]) - 1) % self.capacity) * self.width
+
+    def first_timestamp(self):
+        if not len(self):
+            return None
+        return self.data[((int(self.meta[0]) - len(self)) % self.capacity) * self.width]
+
+    def records(self, since: float = None, until: float = None, resolution: float = 0):
+        """
+        Records in chronological order, filtered by their timestamp. With a
+        rollup resolution, the bucket that contains since is included.
+        """
+        size = len(self)
+        first = int(self.meta[0]) - size
+        width = self.width
+        for i in range(first, first + size):
+            start = (i % self.capacity) * width
+            timestamp = self.data[start]
+            if since is not None and timestamp < since and timestamp + resolution <= since:
+                continue
+            if until is not None and timestamp > until:
+                break
+            yield self.data[start:start + width].tolist()
+
+
+class HistoryStore:
+    """History of the registers of one meter"""
+
+    def __init__(self, path: str, keys=FOUR_WIRE_KEYS, raw_samples: int = DEFAULT_RAW_SAMPLES,
+                 rollups=DEFAULT_ROLLUPS, sync_interval: float = DEFAULT_SYNC_INTERVAL, clock=time.time):
+        self.path = path
+        self.keys = tuple(sorted(keys))
+        self.raw_samples = raw_samples
+        self.rollups = tuple((int(resolution), int(buckets)) for resolution, buckets in rollups)
+        self.sync_interval = sync_interval
+        self.clock = clock
+
+        layout = json.dumps({"keys": self.keys, "raw": raw_samples, "rollups": self.rollups}).encode()
+        per_key = RingSeries.size(RAW_WIDTH, raw_samples) + sum(
+            RingSeries.size(ROLLUP_WIDTH, buckets) for _, buckets in self.rollups)
+        size = HEADER_SIZE + 8 * per_key * len(self.keys)
+
+        fresh = True
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            with open(path, "rb") as f:
+                magic, length = HEADER.unpack(f.read(HEADER.size))
+                fresh = magic != MAGIC or f.read(length) != layout
+            if fresh:
+                log.warning("History %s has a different layout, starting over", path)
+        mode = "w+b" if fresh else "r+b"
+        with open(path, mode) as f:
+            if fresh:
+                f.truncate(size)
+                f.write(HEADER.pack(MAGIC, len(layout)) + layout)
+            self._map = mmap.mmap(f.fileno(), size)
+        self._view = memoryview(self._map)[HEADER_SIZE:].cast("d")
+
+        self.raw = {}
+        self.rolled = {}
+        offset = 0
+        for key in self.keys:
+            self.raw[key] = RingSeries(self._view, offset, RAW_WIDTH, raw_samples)
+            offset += RingSeries.size(RAW_WIDTH, raw_samples)
+            series = []
+            for resolution, buckets in self.rollups:
+                series.append((resolution, RingSeries(self._view, offset, ROLLUP_WIDTH, buckets)))
+                offset += RingSeries.size(ROLLUP_WIDTH, buckets)
+            self.rolled[key] = series
+        self._last_sync = clock()
+
+    @classmethod
+    def from_config(cls, cfg, meter):
+        """Creates the store of a meter from cfg["history"], or returns None if it is disabled"""
+        hs_cfg = cfg.get("history", {})
+        if not hs_cfg.get("enabled", False):
+            return None
+        directory = hs_cfg.get("directory", DEFAULT_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, f"{meter.name}.hist"), meter.keys,
+                   raw_samples=hs_cfg.get("raw_samples", DEFAULT_RAW_SAMPLES),
+                   rollups=hs_cfg.get("rollups", DEFAULT_ROLLUPS),
+                   sync_interval=hs_cfg.get("sync_interval", DEFAULT_SYNC_INTERVAL))
+
+    def add(self, values: dict, timestamp: float = None):
+        """Records the values {address: value} of one poll cycle"""
+        if timestamp is None:
+            timestamp = self.clock()
+        for key, value in values.items():
+            raw = self.raw.get(key)
+            if raw is None or value is None:
+                continue
+            raw.append((timestamp, value))
+            for resolution, series in self.rolled[key]:
+                bucket = timestamp - timestamp % resolution
+                data = series.data
+                i = series.last_index()
+                if len(series) and data[i] == bucket:
+                    data[i + 1] = min(data[i + 1], value)
+                    data[i + 2] = max(data[i + 2], value)
+                    data[i + 3] += value
+                    data[i + 4] += 1
+                else:
+                    series.append((bucket, value, value, value, 1))
+        if timestamp - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def query(self, register, since: float = None, until: float = None, resolution: int = None) -> dict:
+        """
+        History of one register.
+
+        resolution 0 returns raw samples [timestamp, value], a rollup
+        resolution returns [bucket start, min, max, avg]. Without a
+        resolution the finest one that still reaches back to since is used.
+        """
+        key = resolve_register(register)
+        if key not in self.raw:
+            raise KeyError(f"Register {register} is not recorded")
+        if resolution is None:
+            resolution = self._resolution_for(key, since)
+        if resolution == 0:
+            return {"register": REGISTER_TABLE[key].name, "resolution": 0, "fields": ["timestamp", "value"],
+                    "data": list(self.raw[key].records(since, until))}
+
+        for candidate, series in self.rolled[key]:
+            if candidate == resolution:
+                data = [[start, low, high, total / count]
+                        for start, low, high, total, count in series.records(since, until, resolution)]
+                return {"register": REGISTER_TABLE[key].name, "resolution": resolution,
+                        "fields": ["timestamp", "min", "max", "avg"], "data": data}
+        raise ValueError(f"No rollup with resolution {resolution}, available: {[r for r, _ in self.rollups]}")
+
+    def _resolution_for(self, key: int, since) -> int:
+        if since is None:
+            return 0
+        first = self.raw[key].first_timestamp()
+        if first is not None and first <= since:
+            return 0
+        for resolution, series in self.rolled[key]:
+            first = series.first_timestamp()
+            # a bucket reaches back to since if it contains it, i.e. starts at or before it
+            if first is not None and first <= since:
+                return resolution
+        return self.rollups[-1][0] if self.rollups else 0
+
+    def sync(self):
+        """Writes the mapped pages to disk"""
+        self._map.flush()
+        self._last_sync = self.clock()
+
+    def close(self):
+        self.sync()
+        self.raw.clear()
+        self.rolled.clear()
+        self._view.release()
+        self._map.close()
+
+    @staticmethod
+    def routes(stores: dict) -> dict:
+        """HTTP routes serving the stores {meter name: HistoryStore}"""
+
+        def history(query):
+            if "register" not in query:
+                body = {name: {"registers": [REGISTER_TABLE[key].name for key in store.keys],
+                               "raw_samples": store.raw_samples,
+                               "rollups": [resolution for resolution, _ in store.rollups]}
+                        for name, store in stores.items()}
+                return "200 OK", JSON, json.dumps(body).encode()
+            store = stores[query.get("meter", next(iter(stores)))]
+            result = store.query(query["register"],
+                                 since=float(query["since"]) if "since" in query else None,
+                                 until=float(query["until"]) if "until" in query else None,
+                                 resolution=int(query["resolution"]) if "resolution" in query else None)
+            return "200 OK", JSON, json.dumps(result).encode()
+
+        return {"/history": history}
+
+
+async def start_history_http(cfg, stores: dict):
+    """Serves the stores {meter name: HistoryStore} on http://<http_host>:<http_port>/history"""
+    hs_cfg = cfg.get("history", {})
+    host = hs_cfg.get("http_host", DEFAULT_HTTP_HOST)
+    port = hs_cfg.get("http_port", DEFAULT_HTTP_PORT)
+    server = await start_http_server(HistoryStore.routes(stores), host, port)
+    log.info("History on http://%s:%i/history", host, port)
+    return server
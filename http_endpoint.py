@@ -0,0 +1,46 @@
+"""
+Minimal local HTTP endpoint
+
+Serves GET requests for a few fixed paths, enough for the metrics and
+history endpoints without pulling in a web framework. A handler gets the
+query parameters and returns (status, content type, body).
+"""
+
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+
+TEXT = "text/plain; charset=utf-8"
+JSON = "application/json"
+
+
+async def start_http_server(routes: dict, host: str, port: int):
+    """
+    Starts serving routes, {path: handler(query) -> (status, content type, body)}.
+
+    query maps every parameter to its last value. Returns the asyncio server.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            url = urlsplit(request[1].decode()) if len(request) > 1 else None
+            handler = routes.get(url.path) if url is not None else None
+            if request[:1] != [b"GET"] or handler is None:
+                status, content_type, body = "404 Not Found", TEXT, f"see {', '.join(routes)}\n".encode()
+            else:
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    status, content_type, body = handler(query)
+                except (KeyError, ValueError) as e:
+                    status, content_type, body = "400 Bad Request", TEXT, f"{e}\n".encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
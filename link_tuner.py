@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Serial link auto-tuner for the DTSU666 reader
+
+Measures the link with the configured read plan at every candidate
+setting and picks the fastest stable one:
+- baud rate: every candidate rate is probed as is, with --program-meter
+  the meters are switched to it first (BAUD_REGISTER)
+- inter-frame gap: silence between a response and the next request
+  (reader.frame_gap), the smallest gap without errors wins
+- timeout: derived from the measured round trips, instead of the fixed
+  1 s a dead request costs today
+
+    python -m link_tuner [--baudrates 2400 4800 9600] [--gaps 0 0.002 0.005 0.01]
+                         [--samples 30] [--max-error 0.01] [--program-meter] [--write]
+
+--write stores baudrate, timeout, frame_gap and retries in config.json.
+With --program-meter the meters are left at the chosen rate; if a meter
+does not answer at a new rate, the tuner switches it back.
+
+The DTSU666 supports up to 9600 baud, so on a clean bus most of the gain
+comes from the timeout and the inter-frame gap, not from the baud rate.
+"""
+
+import argparse
+import asyncio
+import copy
+import logging
+import time
+
+from config import load_config, save_config
+from dtsu666_constants import BAUD_CODES, BAUD_REGISTER
+from dtsu666reader import Dtsu666Reader
+from startup import configure_logging
+
+log = logging.getLogger("dtsu666-tuner")
+
+DEFAULT_GAPS = (0.0, 0.002, 0.005, 0.01)
+DEFAULT_SAMPLES = 30
+DEFAULT_MAX_ERROR = 0.01
+# generous timeout while measuring, so slow responses count as slow and not as lost
+PROBE_TIMEOUT = 1.0
+# tuned timeout: TIMEOUT_FACTOR * slowest round trip, at least TIMEOUT_MARGIN above it
+TIMEOUT_FACTOR = 2.0
+TIMEOUT_MARGIN = 0.05
+# time the meter needs to switch to a new baud rate
+SWITCH_DELAY = 0.5
+# the tuned timeout is tight, one retry covers a single corrupted frame
+TUNED_RETRIES = 1
+
+
+class LinkProfile:
+    """Measurements of one link setting"""
+
+    __slots__ = ("baudrate", "frame_gap", "rtts", "errors", "elapsed")
+
+    def __init__(self, baudrate: int, frame_gap: float):
+        self.baudrate = baudrate
+        self.frame_gap = frame_gap
+        self.rtts = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    @property
+    def transactions(self) -> int:
+        return len(self.rtts) + self.errors
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.transactions if self.transactions else 1.0
+
+    @property
+    def throughput(self) -> float:
+        """Successful transactions per second"""
+        return len(self.rtts) / self.elapsed if self.elapsed else 0.0
+
+    def quantile(self, q: float):
+        if not self.rtts:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[min(int(q * len(rtts)), len(rtts) - 1)]
+
+    def timeout(self) -> float:
+        slowest = max(self.rtts)
+        return round(max(slowest * TIMEOUT_FACTOR, slowest + TIMEOUT_MARGIN), 3)
+
+    def summary(self) -> dict:
+        p50, p99 = self.quantile(0.5), self.quantile(0.99)
+        return {
+            "baudrate": self.baudrate,
+            "frame_gap": self.frame_gap,
+            "transactions_per_s": round(self.throughput, 1),
+            "error_rate": round(self.error_rate, 4),
+            "rtt_p50_ms": round(p50 * 1e3, 2) if p50 is not None else None,
+            "rtt_p99_ms": round(p99 * 1e3, 2) if p99 is not None else None,
+        }
+
+
+def _link_config(cfg, baudrate: int, timeout: float = PROBE_TIMEOUT, frame_gap: float = 0.0):
+    link_cfg = copy.deepcopy(cfg)
+    # fixed timeout, no retries and no breaker: every lost response counts
+    link_cfg["reader"].update({"baudrate": baudrate, "timeout": timeout, "frame_gap": frame_gap,
+                               "retries": 0, "adaptive_timeout": False, "breaker_threshold": 0})
+    return link_cfg
+
+
+async def measure(cfg, baudrate: int, frame_gap: float, samples: int) -> LinkProfile:
+    """Reads the configured plan of every meter samples times"""
+    reader = Dtsu666Reader(_link_config(cfg, baudrate, frame_gap=frame_gap))
+    await reader.connect()
+    profile = LinkProfile(baudrate, frame_gap)
+    started = time.monotonic()
+    try:
+        for _ in range(samples):
+            for meter in reader.meters:
+                for decoder in reader.plan(meter.keys):
+                    await reader.wait_frame_gap()
+                    sent = time.monotonic()
+                    if await reader.read_span(meter.device_id, decoder) is None:
+                        profile.errors += 1
+                    else:
+                        profile.rtts.append(time.monotonic() - sent)
+    finally:
+        profile.elapsed = time.monotonic() - started
+        reader.close()
+    return profile
+
+
+async def program_baudrate(cfg, current: int, baudrate: int) -> bool:
+    """Switches all meters from current to baudrate, returns False if a meter could not be switched"""
+    reader = Dtsu666Reader(_link_config(cfg, current))
+    await reader.connect()
+    try:
+        for meter in reader.meters:
+            rr = await reader.instrument.write_register(BAUD_REGISTER, BAUD_CODES[baudrate],
+                                                        device_id=meter.device_id)
+            if rr.isError():
+                log.error("Meter %s refused baud rate %i", meter.name, baudrate)
+                return False
+    except Exception as e:
+        log.error("Could not switch the baud rate to %i: %s", baudrate, e)
+        return False
+    finally:
+        reader.close()
+    await asyncio.sleep(SWITCH_DELAY)
+    return True
+
+
+async def tune(cfg, baudrates, gaps=DEFAULT_GAPS, samples: int = DEFAULT_SAMPLES,
+               max_error: float = DEFAULT_MAX_ERROR, program_meter: bool = False):
+    """
+    Measures every baud rate and gap, returns (all profiles, the fastest stable profile or None).
+    """
+    current = cfg["reader"]["baudrate"]
+    profiles = []
+    for baudrate in baudrates:
+        if program_meter and baudrate != current:
+            if baudrate not in BAUD_CODES:
+                log.warning("The meter does not support %i baud, skipped", baudrate)
+                continue
+            if not await program_baudrate(cfg, current, baudrate):
+                continue
+        probe = await measure(cfg, baudrate, max(gaps), 1)
+        if not probe.rtts:
+            log.warning("No answer at %i baud", baudrate)
+            if program_meter and baudrate != current and not (await measure(cfg, current, max(gaps), 1)).rtts:
+                # switched, but the link does not work at the new rate: switch back blind
+                if not await program_baudrate(cfg, baudrate, current):
+                    log.error("The meters answer neither at %i nor at %i baud", current, baudrate)
+            continue
+        current = baudrate
+        # largest gap first: once a gap fails, smaller ones will not do better
+        for gap in sorted(gaps, reverse=True):
+            profile = await measure(cfg, baudrate, gap, samples)
+            profiles.append(profile)
+            log.info("%s", profile.summary())
+            if profile.error_rate > max_error:
+                break
+
+    stable = [profile for profile in profiles if profile.error_rate <= max_error and profile.rtts]
+    best = max(stable, key=lambda profile: profile.throughput, default=None)
+    if program_meter and best is not None and best.baudrate != current:
+        await program_baudrate(cfg, current, best.baudrate)
+    return profiles, best
+
+
+async def main():
+    cfg = load_config()
+    configure_logging(cfg)
+
+    parser = argparse.ArgumentParser(description="DTSU666 serial link auto-tuner")
+    parser.add_argument("--baudrates", type=int, nargs="+", default=[cfg["reader"]["baudrate"]],
+                        help="candidate baud rates (default: the configured one)")
+    parser.add_argument("--gaps", type=float, nargs="+", default=list(DEFAULT_GAPS),
+                        help="candidate inter-frame gaps in seconds")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="read plan cycles per setting")
+    parser.add_argument("--max-error", type=float, default=DEFAULT_MAX_ERROR,
+                        help="highest error rate of a stable setting")
+    parser.add_argument("--program-meter", action="store_true",
+                        help=f"switch the meters to every candidate rate ({', '.join(map(str, BAUD_CODES))})")
+    parser.add_argument("--write", action="store_true", help="store the fastest stable setting in config.json")
+    args = parser.parse_args()
+
+    before = await measure(cfg, cfg["reader"]["baudrate"], cfg["reader"].get("frame_gap", 0.0), args.samples)
+    print(f"{'configured':12}: {before.summary()}")
+    profiles, best = await tune(cfg, args.baudrates, args.gaps, args.samples, args.max_error, args.program_meter)
+    for profile in profiles:
+        print(f"{'candidate':12}: {profile.summary()}")
+    if best is None:
+        print("No stable setting found, config.json is left unchanged.")
+        return
+
+    tuned = {"baudrate": best.baudrate, "timeout": best.timeout(), "frame_gap": best.frame_gap,
+             "retries": TUNED_RETRIES}
+    print(f"{'best':12}: {best.summary()} -> {tuned}")
+    if before.throughput:
+        print(f"{'speedup':12}: {best.throughput / before.throughput:.2f}x")
+    if args.write:
+        cfg["reader"].update(tuned)
+        save_config(cfg)
+        print("Written to config.json")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
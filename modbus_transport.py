@@ -0,0 +1,241 @@
+"""
+Modbus transports of the reader and the emulator
+
+Both talk Modbus RTU on a serial port by default. "transport" in the
+reader or emulator section of config.json selects another one:
+
+    serial        RTU frames on the serial port (port, baudrate, parity, stopbits)
+    tcp           Modbus TCP (MBAP header) to/on host:tcp_port
+    rtu-over-tcp  RTU frames with CRC in a TCP stream, as RS485-to-Ethernet
+                  converters in transparent mode forward them
+
+    "reader": {"transport": "rtu-over-tcp", "host": "192.168.1.50", "tcp_port": 8899, ...}
+    "emulator": {"transport": "tcp", "host": "0.0.0.0", "tcp_port": 5020, ...}
+
+Reader connections are persistent and pooled: readers of the same
+endpoint (e.g. several buses of one converter, or a reader recreated by
+the link tuner) share one client, whose transaction lock keeps their
+requests apart. The connection stays open while a reader holds it,
+pymodbus reconnects it after a loss and TCP keepalive detects converters
+that vanished without closing the connection.
+
+The emulator's TCP server accepts any number of concurrent clients (an
+inverter, an EMS, a logger), which are all served from the same register
+image, so one read of the physical bus feeds every consumer.
+Every connection gets its own trace hooks, so the transaction telemetry
+pairs requests and responses per client.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+
+log = logging.getLogger("dtsu666-transport")
+
+SERIAL = "serial"
+TCP = "tcp"
+RTU_OVER_TCP = "rtu-over-tcp"
+TRANSPORTS = (SERIAL, TCP, RTU_OVER_TCP)
+DEFAULT_TCP_PORT = 502
+# an idle connection is probed after KEEPALIVE_IDLE s, every KEEPALIVE_INTERVAL s, KEEPALIVE_COUNT times
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+# pause before the first reconnect of a lost connection, doubled up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY = 0.1
+RECONNECT_DELAY_MAX = 30
+
+
+def transport_of(section) -> str:
+    """Transport of a reader or emulator config section"""
+    transport = section.get("transport", SERIAL)
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown Modbus transport {transport!r}, expected one of {TRANSPORTS}")
+    return transport
+
+
+def endpoint(section) -> str:
+    """Human readable endpoint of a reader or emulator config section"""
+    if transport_of(section) == SERIAL:
+        return section["port"]
+    return f"{section['host']}:{section.get('tcp_port', DEFAULT_TCP_PORT)}"
+
+
+def endpoint_name(section) -> str:
+    """Short name of the endpoint, e.g. the default name of a bus"""
+    if transport_of(section) == SERIAL:
+        return os.path.basename(section["port"])
+    return endpoint(section)
+
+
+def _framer(transport: str):
+    from pymodbus import FramerType
+    return FramerType.SOCKET if transport == TCP else FramerType.RTU
+
+
+def _enable_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                          ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def create_client(reader_cfg, trace_packet=None, trace_pdu=None):
+    """Creates an unconnected pymodbus client for the reader section of the config"""
+    transport = transport_of(reader_cfg)
+    # pymodbus.client is only needed by readers with an own connection
+    from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
+
+    if transport == SERIAL:
+        return AsyncModbusSerialClient(
+            framer=_framer(transport),
+            port=reader_cfg["port"],
+            timeout=reader_cfg["timeout"],
+            baudrate=reader_cfg["baudrate"],
+            parity=reader_cfg["parity"],
+            stopbits=reader_cfg["stopbits"],
+            bytesize=8,
+            # retries, timeouts and dead meters are handled by the TransactionGuard
+            retries=0,
+            # handle_local_echo=False,
+            trace_packet=trace_packet,
+            trace_pdu=trace_pdu,
+        )
+
+    client = None
+
+    def trace_connect(connected: bool):
+        # called on every (re)connect, the new socket gets keepalive as well
+        if connected and client is not None:
+            sock = client.ctx.transport.get_extra_info("socket")
+            if sock is not None:
+                _enable_keepalive(sock)
+
+    client = AsyncModbusTcpClient(
+        reader_cfg["host"],
+        framer=_framer(transport),
+        port=reader_cfg.get("tcp_port", DEFAULT_TCP_PORT),
+        timeout=reader_cfg["timeout"],
+        retries=0,
+        reconnect_delay=reader_cfg.get("reconnect_delay", RECONNECT_DELAY),
+        reconnect_delay_max=reader_cfg.get("reconnect_delay_max", RECONNECT_DELAY_MAX),
+        trace_packet=trace_packet,
+        trace_pdu=trace_pdu,
+        trace_connect=trace_connect,
+    )
+    return client
+
+
+class _Lease:
+    __slots__ = ("client", "users", "lock")
+
+    def __init__(self, client):
+        self.client = client
+        self.users = 0
+        self.lock = asyncio.Lock()
+
+
+class ClientPool:
+    """Shares one persistent client per endpoint between the readers of a process"""
+
+    def __init__(self):
+        self._leases = {}
+
+    @staticmethod
+    def key(reader_cfg) -> tuple:
+        transport = transport_of(reader_cfg)
+        if transport == SERIAL:
+            return transport, reader_cfg["port"], reader_cfg["baudrate"], reader_cfg["parity"], reader_cfg["stopbits"]
+        return transport, reader_cfg["host"], reader_cfg.get("tcp_port", DEFAULT_TCP_PORT)
+
+    def acquire(self, reader_cfg, trace_packet=None, trace_pdu=None):
+        """
+        Returns the client of the endpoint, created on first use. The trace
+        hooks of the first reader apply to the shared client.
+        """
+        key = self.key(reader_cfg)
+        lease = self._leases.get(key)
+        if lease is None:
+            lease = self._leases[key] = _Lease(create_client(reader_cfg, trace_packet, trace_pdu))
+        elif trace_packet is not None:
+            log.debug("%s is shared, the trace hooks of its first reader stay in place", endpoint(reader_cfg))
+        lease.users += 1
+        return lease.client
+
+    def _lease(self, client) -> _Lease:
+        for lease in self._leases.values():
+            if lease.client is client:
+                return lease
+        raise ValueError("Client is not from this pool")
+
+    def lock(self, client) -> asyncio.Lock:
+        """Lock held by the readers of the client around connecting and every transaction"""
+        return self._lease(client).lock
+
+    async def connect(self, client) -> bool:
+        """Connects the client unless another reader did already"""
+        lease = self._lease(client)
+        async with lease.lock:
+            if not client.connected:
+                # the client's connect() sleeps 100 ms after opening the connection,
+                # the transport is ready as soon as it is open
+                await client.ctx.connect()
+        return client.connected
+
+    def release(self, client):
+        """Returns the client, the connection is closed when its last reader released it"""
+        for key, lease in self._leases.items():
+            if lease.client is client:
+                lease.users -= 1
+                if lease.users <= 0:
+                    del self._leases[key]
+                    client.close()
+                return
+        client.close()
+
+
+POOL = ClientPool()
+
+
+def create_server(context, identity, transport: str = SERIAL, port: str = None, baudrate: int = 9600,
+                  host: str = "", tcp_port: int = DEFAULT_TCP_PORT, hooks=None):
+    """
+    Creates the pymodbus server of the emulator for the given transport
+
+    hooks: optional factory of the trace hooks (telemetry.connection_hooks),
+    called once per connection, so every TCP client gets its own
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown Modbus transport {transport!r}, expected one of {TRANSPORTS}")
+    if transport == SERIAL:
+        from pymodbus.server import ModbusSerialServer
+        return ModbusSerialServer(
+            context=context,
+            identity=identity,
+            port=port,
+            framer=_framer(transport),
+            baudrate=baudrate,
+            stopbits=1,
+            bytesize=8,
+            parity="N",
+            **(hooks() if hooks is not None else {}),
+        )
+    from pymodbus.server import ModbusTcpServer
+    from pymodbus.server.requesthandler import ServerRequestHandler
+
+    class TcpServer(ModbusTcpServer):
+        def callback_new_connection(self):
+            if hooks is None:
+                return super().callback_new_connection()
+            connection = hooks()
+            return ServerRequestHandler(self, connection.get("trace_packet"), connection.get("trace_pdu"),
+                                        self.trace_connect)
+
+    return TcpServer(
+        context=context,
+        identity=identity,
+        framer=_framer(transport),
+        address=(host, tcp_port),
+    )
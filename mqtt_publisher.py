@@ -0,0 +1,154 @@
+"""
+MQTT publisher for DTSU666 values
+
+Depending on the publish mode a poll cycle goes out as
+- "state": one timestamped JSON document on <prefix>/<state_topic>
+- "registers": one message per register on <prefix>/<register name>
+- "both": the state document plus the per-register fan-out
+
+fan_out limits the per-register messages to a list of registers; an
+empty list means no fan-out and "all" (the default) every register.
+
+An optional DeadbandFilter drops values that did not change enough
+before they are published.
+"""
+
+import json
+import logging
+import time
+from datetime import datetime
+
+from deadband import DeadbandFilter
+from poll_scheduler import resolve_register
+from read_planner import ReadSpan
+from register_decoder import SpanDecoder
+from register_profile import FULL_PROFILE, REGISTER_TABLE
+
+log = logging.getLogger("dtsu666-mqtt")
+
+PUBLISH_MODES = ("state", "registers", "both")
+DEFAULT_PUBLISH_MODE = "state"
+FAN_OUT_ALL = "all"
+DEFAULT_STATE_TOPIC = "state"
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class MqttPublisher:
+    """Publishes measurement values as state document and/or per-register topics"""
+
+    def __init__(self, client, topic_prefix: str, mode: str = DEFAULT_PUBLISH_MODE,
+                 state_topic: str = DEFAULT_STATE_TOPIC, fan_out=FAN_OUT_ALL,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, deadband=None, clock=time.monotonic):
+        if mode not in PUBLISH_MODES:
+            raise ValueError(f"Unknown publish mode {mode!r}, expected one of {PUBLISH_MODES}")
+        self.client = client
+        self.topic_prefix = topic_prefix
+        self.mode = mode
+        self.state_topic = f"{topic_prefix}/{state_topic}"
+        # None: every register
+        self.fan_out = (None if fan_out is None or fan_out == FAN_OUT_ALL
+                        else {resolve_register(register) for register in fan_out})
+        self.flush_interval = flush_interval
+        self.deadband = deadband
+        self.clock = clock
+        self._topics = FULL_PROFILE.topics(topic_prefix)
+        self._decoders = {}
+        self._pending = {}
+        self._last_flush = clock()
+
+    @classmethod
+    def from_config(cls, client, cfg, topic_prefix=None):
+        """Creates the publisher from the mqtt section of the config"""
+        mqtt_cfg = cfg["mqtt"]
+        return cls(client,
+                   topic_prefix or mqtt_cfg["topic_prefix"],
+                   mode=mqtt_cfg.get("publish_mode", DEFAULT_PUBLISH_MODE),
+                   state_topic=mqtt_cfg.get("state_topic", DEFAULT_STATE_TOPIC),
+                   fan_out=mqtt_cfg.get("fan_out", FAN_OUT_ALL),
+                   flush_interval=mqtt_cfg.get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+                   deadband=DeadbandFilter.from_config(cfg))
+
+    @staticmethod
+    def state_document(values: dict, timestamp=None) -> dict:
+        """Builds the state document {"timestamp": ..., <register name>: value}"""
+        doc = {"timestamp": (timestamp or datetime.now()).isoformat()}
+        for address, value in values.items():
+            if value is not None:
+                doc[REGISTER_TABLE[address].name] = value
+        return doc
+
+    def publish_values(self, values: dict):
+        """Publishes the decoded values {address: value} of one poll cycle"""
+        if self.deadband is not None:
+            values = self._apply_deadband(values)
+            if not values:
+                return
+        if self.mode != "registers":
+            self.client.publish(self.state_topic, json.dumps(self.state_document(values)))
+        if self.mode != "state":
+            for address, value in values.items():
+                if value is None or (self.fan_out is not None and address not in self.fan_out):
+                    continue
+                self.client.publish(self._topics[address], value)
+
+    def _apply_deadband(self, values: dict) -> dict:
+        values = self.deadband.filter(values)
+        if self.deadband.report_due():
+            stats = self.deadband.stats()
+            log.info("Deadband suppressed %i of %i values", stats["suppressed"],
+                     stats["passed"] + stats["suppressed"])
+            self.publish_diagnostics("deadband", stats)
+        return values
+
+    def publish_aggregate(self, window: str, data: dict):
+        """Publishes the document of a closed aggregation window on <prefix>/aggregate/<window>"""
+        self.client.publish(f"{self.topic_prefix}/aggregate/{window}", json.dumps(data))
+
+    def publish_diagnostics(self, name: str, data: dict):
+        """Publishes a diagnostics document on <prefix>/diagnostics/<name>"""
+        self.client.publish(f"{self.topic_prefix}/diagnostics/{name}", json.dumps(data))
+
+    def _decoder(self, address: int, count: int):
+        key = (address, count)
+        if key not in self._decoders:
+            keys = tuple(a for a, register in sorted(REGISTER_TABLE.items())
+                         if address <= a and a + register.words <= address + count)
+            self._decoders[key] = SpanDecoder(ReadSpan(address, count, keys)) if keys else None
+        return self._decoders[key]
+
+    def publish_read(self, address: int, registers):
+        """
+        Publishes raw registers forwarded by the proxy.
+
+        Unless the mode is "state", every read goes out as JSON on
+        <prefix>/read/<address>. Unless it is "registers", the known registers of
+        the read are decoded and collected into a state document that is flushed
+        every flush_interval seconds.
+        """
+        if self.mode != "state":
+            payload = {
+                "timestamp": datetime.now().isoformat(),
+                "address": address,
+                "values": registers,
+            }
+            topic = f"{self.topic_prefix}/read/{address}"
+            self.client.publish(topic, json.dumps(payload))
+            log.info(f"MQTT publish {topic}: {registers}")
+        if self.mode == "registers":
+            return
+
+        decoder = self._decoder(address, len(registers))
+        if decoder is not None:
+            self._pending.update(decoder.decode(registers))
+        if self.clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Publishes the collected proxy values as one state document"""
+        self._last_flush = self.clock()
+        pending, self._pending = self._pending, {}
+        if self.deadband is not None:
+            pending = self._apply_deadband(pending)
+        if not pending:
+            return
+        self.client.publish(self.state_topic, json.dumps(self.state_document(pending)))
@@ -0,0 +1,276 @@
+"""
+Poll scheduler with per-group rates
+
+Register groups are polled at their own interval on a monotonic-clock
+timer wheel. Groups that fall due in the same tick are merged into one
+read, so they share the block reads of the planner. A late cycle skips
+the missed slots instead of shifting the schedule.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+from dtsu666_constants import *
+from resilience import ReadResult
+
+log = logging.getLogger("dtsu666-scheduler")
+
+DEFAULT_TICK = 0.1
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+
+DEFAULT_POLL_GROUPS = {
+    "power": {
+        "interval": 1,
+        "registers": [
+            TOTAL_ACTIVE_POWER, ACTIVE_POWER_PHASE_A, ACTIVE_POWER_PHASE_B, ACTIVE_POWER_PHASE_C,
+            TOTAL_REACTIVE_POWER, REACTIVE_POWER_PHASE_A, REACTIVE_POWER_PHASE_B, REACTIVE_POWER_PHASE_C,
+        ],
+    },
+    "currents": {
+        "interval": 5,
+        "registers": [
+            CURRENT_PHASE_A, CURRENT_PHASE_B, CURRENT_PHASE_C,
+            TOTAL_POWER_FACTOR, POWER_FACTOR_PHASE_A, POWER_FACTOR_PHASE_B, POWER_FACTOR_PHASE_C,
+        ],
+    },
+    "voltages": {
+        "interval": 10,
+        "registers": [VOLTAGE_PHASE_A, VOLTAGE_PHASE_B, VOLTAGE_PHASE_C, FREQUENCY,
+                      VOLTAGE_PHASE_AB, VOLTAGE_PHASE_BC, VOLTAGE_PHASE_CA],
+    },
+    "energy": {
+        "interval": 60,
+        "registers": [TOTAL_IMPORT_ENERGY, TOTAL_EXPORT_ENERGY],
+    },
+}
+
+_ADDRESS_BY_NAME = {spec["name"]: address for address, spec in REGISTERS.items()}
+
+
+def resolve_register(register) -> int:
+    """Accepts a register address, a hex string or a REGISTERS name"""
+    if isinstance(register, int):
+        address = register
+    elif register in _ADDRESS_BY_NAME:
+        address = _ADDRESS_BY_NAME[register]
+    else:
+        address = int(register, 0)
+    if address not in REGISTERS:
+        raise ValueError(f"Unknown DTSU666 register {register!r}")
+    return address
+
+
+class PollGroup:
+    """Registers that are polled at the same rate"""
+
+    __slots__ = ("name", "interval", "keys", "next_due")
+
+    def __init__(self, name: str, interval: float, keys):
+        if interval <= 0:
+            raise ValueError(f"Poll group {name}: interval must be positive")
+        self.name = name
+        self.interval = float(interval)
+        self.keys = tuple(resolve_register(key) for key in keys)
+        self.next_due = 0.0
+
+    def __repr__(self):
+        return f"PollGroup({self.name!r}, interval={self.interval}, keys={len(self.keys)})"
+
+
+def groups_from_config(cfg, keys=FOUR_WIRE_KEYS) -> list:
+    """
+    Builds the poll groups from cfg["poll_groups"], limited to keys.
+
+    Configurations without poll groups keep polling all keys
+    every poll_interval seconds. Keys that no group lists are polled
+    every poll_interval seconds in an extra group "ungrouped".
+    """
+    groups = cfg.get("poll_groups")
+    if not groups:
+        return [PollGroup("all", cfg.get("poll_interval", 30), keys)]
+    result = []
+    for name, group in groups.items():
+        group = PollGroup(name, group["interval"], group["registers"])
+        group.keys = tuple(key for key in group.keys if key in keys)
+        if group.keys:
+            result.append(group)
+    grouped = {key for group in result for key in group.keys}
+    leftover = [key for key in keys if key not in grouped]
+    if leftover:
+        log.warning("Registers in no poll group, polled every %s s: %s", cfg.get("poll_interval", 30),
+                    ", ".join(REGISTERS[key]["name"] for key in leftover))
+        result.append(PollGroup("ungrouped", cfg.get("poll_interval", 30), leftover))
+    return result
+
+
+class PollScheduler:
+    """Timer wheel for poll groups"""
+
+    def __init__(self, groups, tick: float = DEFAULT_TICK, clock=time.monotonic):
+        self.groups = list(groups)
+        self.tick = tick
+        self.clock = clock
+        self.overruns = 0
+        self._merged = {}
+
+        now = self.clock()
+        for group in self.groups:
+            group.next_due = now
+
+    def _slot(self, deadline: float) -> int:
+        return math.floor(deadline / self.tick)
+
+    def next_deadline(self) -> float:
+        """Monotonic time at which the next group falls due"""
+        return min(group.next_due for group in self.groups)
+
+    def due(self, now: float = None) -> list:
+        """Returns all groups whose slot on the wheel has been reached"""
+        if now is None:
+            now = self.clock()
+        slot = self._slot(now)
+        return [group for group in self.groups if self._slot(group.next_due) <= slot]
+
+    def keys(self, groups) -> tuple:
+        """Merged, sorted register keys of the given groups"""
+        names = tuple(group.name for group in groups)
+        keys = self._merged.get(names)
+        if keys is None:
+            keys = tuple(sorted({key for group in groups for key in group.keys}))
+            self._merged[names] = keys
+        return keys
+
+    def advance(self, groups, now: float = None):
+        """Moves the groups to their next slot, skipping the ones missed meanwhile"""
+        if now is None:
+            now = self.clock()
+        for group in groups:
+            group.next_due += group.interval
+            if group.next_due <= now:
+                missed = math.floor((now - group.next_due) / group.interval) + 1
+                group.next_due += missed * group.interval
+                self.overruns += missed
+                log.debug("Poll group %s overran by %i slot(s)", group.name, missed)
+
+    async def run(self, read, callback, stop_event: asyncio.Event):
+        """
+        Polls until stop_event is set.
+
+        read is awaited with the merged register keys of the due groups,
+        callback is called with the values and the polled groups.
+        """
+        while not stop_event.is_set():
+            delay = self.next_deadline() - self.clock()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+            groups = self.due()
+            if not groups:
+                continue
+            values = await read(self.keys(groups))
+            self.advance(groups)
+            callback(values, groups)
+
+
+class _BusJob:
+    """Poll cycle of one meter that is worked off span by span"""
+
+    __slots__ = ("meter", "groups", "decoders", "values", "missing")
+
+    def __init__(self, meter, groups, decoders):
+        self.meter = meter
+        self.groups = groups
+        self.decoders = deque(decoders)
+        self.values = {}
+        self.missing = []
+
+
+class BusScheduler:
+    """
+    Fair scheduler for several meters on one bus.
+
+    Every meter keeps its own PollScheduler. The cycles of all due meters
+    are interleaved span by span in round-robin order, so a meter with many
+    registers cannot delay the others by more than one block read. A failed
+    span only leaves its registers missing in the cycle's ReadResult; a
+    meter whose whole cycle failed is suspended with exponential backoff, so
+    a dead meter costs one timeout per backoff period instead of one per poll.
+    """
+
+    def __init__(self, meters, tick: float = DEFAULT_TICK, backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = DEFAULT_MAX_BACKOFF, clock=time.monotonic):
+        self.meters = list(meters)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        for meter in self.meters:
+            meter.scheduler = PollScheduler(meter.poll_groups, tick, clock)
+
+    def next_deadline(self) -> float:
+        """Monotonic time at which the next meter falls due"""
+        return min(max(meter.scheduler.next_deadline(), meter.suspended_until) for meter in self.meters)
+
+    def _suspend(self, meter, now: float):
+        meter.failures += 1
+        delay = min(self.backoff * 2 ** (meter.failures - 1), self.max_backoff)
+        meter.suspended_until = now + delay
+        log.warning("Meter %s (id %i) not responding, next attempt in %.0f s",
+                    meter.name, meter.device_id, delay)
+
+    def _start_jobs(self, jobs, plan, now: float):
+        active = {job.meter.device_id for job in jobs}
+        for meter in self.meters:
+            if meter.device_id in active or meter.suspended_until > now:
+                continue
+            groups = meter.scheduler.due(now)
+            if groups:
+                jobs.append(_BusJob(meter, groups, plan(meter.scheduler.keys(groups))))
+
+    async def run(self, plan, read_span, callback, stop_event: asyncio.Event):
+        """
+        Polls until stop_event is set.
+
+        plan(keys) returns the span decoders for the keys, read_span(device_id,
+        decoder) is awaited per block read and returns the values or None on
+        failure. callback is called with the values, groups and meter of every
+        finished cycle.
+        """
+        jobs = deque()
+        while not stop_event.is_set():
+            self._start_jobs(jobs, plan, self.clock())
+            if not jobs:
+                delay = self.next_deadline() - self.clock()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+
+            job = jobs.popleft()
+            decoder = job.decoders.popleft()
+            values = await read_span(job.meter.device_id, decoder)
+            if values is None:
+                job.missing.extend(decoder.keys)
+            else:
+                job.values.update(values)
+
+            if job.decoders:
+                jobs.append(job)
+                continue
+            if job.values:
+                job.meter.failures = 0
+            else:
+                self._suspend(job.meter, self.clock())
+            job.meter.scheduler.advance(job.groups)
+            callback(ReadResult(job.values, job.missing), job.groups, job.meter)
+
@@ -0,0 +1,113 @@
+"""
+Access pattern prefetcher for the RTU proxy
+
+Learns the inverter's request sequence and the time between requests
+online. Shortly before the next expected request is due, its range is
+read from the meter into the RegisterCache, so the inverter is answered
+from the local register image instead of waiting on the upstream bus.
+"""
+
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("dtsu666-prefetcher")
+
+# weight of the newest sample in the inter-request gap average
+GAP_ALPHA = 0.2
+DEFAULT_MIN_CONFIDENCE = 0.6
+DEFAULT_MIN_SAMPLES = 3
+DEFAULT_MARGIN = 0.05
+MAX_SUCCESSORS = 8
+
+
+class Transition:
+    """Statistics of one request following another"""
+
+    __slots__ = ("count", "gap")
+
+    def __init__(self, gap: float):
+        self.count = 1
+        self.gap = gap
+
+    def update(self, gap: float):
+        self.count += 1
+        self.gap += GAP_ALPHA * (gap - self.gap)
+
+
+class AccessPatternPrefetcher:
+    """First-order model of the request sequence that drives cache prefetches"""
+
+    def __init__(self, cache, margin: float = DEFAULT_MARGIN,
+                 min_confidence: float = DEFAULT_MIN_CONFIDENCE,
+                 min_samples: int = DEFAULT_MIN_SAMPLES, clock=time.monotonic):
+        self.cache = cache
+        self.margin = margin
+        self.min_confidence = min_confidence
+        self.min_samples = min_samples
+        self.clock = clock
+        self.predictions = 0
+        self._successors = {}
+        self._last = None
+        self._last_time = None
+        self._timer = None
+
+    def observe(self, device_id: int, address: int, count: int):
+        """Records a request and schedules the prefetch of its expected successor"""
+        now = self.clock()
+        key = (device_id, address, count)
+        if self._last is not None:
+            self._learn(self._last, key, now - self._last_time)
+        self._last, self._last_time = key, now
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        prediction = self.predict(key)
+        if prediction is None:
+            return
+        next_key, gap = prediction
+        lead = (self.cache.rtt or 0.0) + self.margin
+        self.predictions += 1
+        self._timer = asyncio.get_running_loop().call_later(max(0.0, gap - lead), self._prefetch, next_key, lead)
+
+    def _learn(self, previous, key, gap: float):
+        successors = self._successors.setdefault(previous, {})
+        transition = successors.get(key)
+        if transition is not None:
+            transition.update(gap)
+            return
+        if len(successors) >= MAX_SUCCESSORS:
+            del successors[min(successors, key=lambda k: successors[k].count)]
+        successors[key] = Transition(gap)
+
+    def predict(self, key):
+        """Returns (next key, expected gap) if the successor of key is known well enough"""
+        successors = self._successors.get(key)
+        if not successors:
+            return None
+        next_key, transition = max(successors.items(), key=lambda item: item[1].count)
+        total = sum(t.count for t in successors.values())
+        if transition.count < self.min_samples or transition.count / total < self.min_confidence:
+            return None
+        return next_key, transition.gap
+
+    def next_request_time(self):
+        """Expected clock time of the inverter's next request, None if the pattern is not known well enough"""
+        if self._last is None:
+            return None
+        prediction = self.predict(self._last)
+        if prediction is None:
+            return None
+        return self._last_time + prediction[1]
+
+    def _prefetch(self, key, lead: float):
+        self._timer = None
+        if self.cache.prefetch(*key, margin=lead):
+            log.debug("Prefetch %s", key)
+
+    def stats(self) -> dict:
+        """Counters for diagnostics"""
+        return {"patterns": sum(len(s) for s in self._successors.values()),
+                "predictions": self.predictions}
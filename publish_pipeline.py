@@ -0,0 +1,298 @@
+"""
+Non-blocking MQTT publish pipeline
+
+Publishing is decoupled from reading: publish() only queues the message
+and returns. A consumer task hands the messages to the paho client,
+whose network loop runs in its own thread. If the queue is full, the
+overflow policy decides what happens while the broker is connected.
+During a broker outage, the messages a full queue would evict go to an
+append-only spool file instead of being dropped, and so do the queue at
+shutdown, failed sends and the overflow of the "block" policy. The
+spool is replayed in bulk after reconnecting. It keeps at
+most spool_size messages: when it grows 10 % beyond that, it is
+compacted to the newest spool_size messages, with "coalesce" to the
+latest message per topic first.
+
+paho is imported by create_client only. start_from_config creates the
+client in a worker thread, so the pipeline can be created and fed before
+the import is done and the serial side starts up in the meantime.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict, deque
+
+log = logging.getLogger("dtsu666-mqtt")
+
+OVERFLOW_POLICIES = ("drop-oldest", "coalesce", "block")
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_POLICY = "drop-oldest"
+DEFAULT_SPOOL_FILE = "mqtt_spool.jsonl"
+DEFAULT_SPOOL_SIZE = 10000
+REPLAY_BATCH = 200
+
+
+def create_client(cfg):
+    """Creates the paho client for cfg["mqtt"]"""
+    import paho.mqtt.client as mqtt  # ~50 ms, kept off the import path of the entry points
+
+    client = mqtt.Client()
+    if cfg["mqtt"].get("username"):
+        client.username_pw_set(cfg["mqtt"]["username"], cfg["mqtt"]["password"])
+    return client
+
+
+class PublishPipeline:
+    """
+    Bounded publish queue in front of a paho MQTT client.
+
+    Overflow policies:
+    - "drop-oldest": the oldest queued message is discarded
+    - "coalesce": only the latest message per topic is kept queued
+    - "block": put() waits for space; publish() spools the message instead,
+      so the event loop is never blocked by the broker
+
+    While the client is offline, messages evicted by "drop-oldest" or
+    "coalesce" are spooled instead of dropped.
+    """
+
+    def __init__(self, client=None, maxsize: int = DEFAULT_QUEUE_SIZE, policy: str = DEFAULT_POLICY,
+                 spool_file=DEFAULT_SPOOL_FILE, spool_size: int = DEFAULT_SPOOL_SIZE):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        if spool_size <= 0:
+            raise ValueError("spool_size must be positive")
+        self.client = client
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spool_file = spool_file
+        self.spool_size = spool_size
+        self.dropped = 0
+        self.spooled = 0
+        self.published = 0
+        self._queue = OrderedDict() if policy == "coalesce" else deque()
+        self._available = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._loop = None
+        self._spool = None
+        # messages in the spool file, counted when it is opened
+        self._spool_count = 0
+        self._replay_pending = bool(spool_file) and os.path.exists(spool_file)
+
+    @classmethod
+    def from_config(cls, client, cfg):
+        """Creates the pipeline from the mqtt section of the config"""
+        mqtt_cfg = cfg["mqtt"]
+        return cls(client,
+                   maxsize=mqtt_cfg.get("queue_size", DEFAULT_QUEUE_SIZE),
+                   policy=mqtt_cfg.get("overflow_policy", DEFAULT_POLICY),
+                   spool_file=mqtt_cfg.get("spool_file", DEFAULT_SPOOL_FILE),
+                   spool_size=mqtt_cfg.get("spool_size", DEFAULT_SPOOL_SIZE))
+
+    # --------------------------
+    # Producer side
+    # --------------------------
+
+    def __len__(self):
+        return len(self._queue)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """Queues a message, never blocks. Same signature as paho's Client.publish"""
+        message = (topic, payload, qos, retain)
+        if self.policy == "coalesce":
+            self._queue.pop(topic, None)
+            if len(self._queue) >= self.maxsize:
+                self._evict(self._queue.popitem(last=False)[1])
+            self._queue[topic] = message
+        elif len(self._queue) >= self.maxsize:
+            if self.policy == "block":
+                self._write_spool([message])
+                return
+            self._evict(self._queue.popleft())
+            self._queue.append(message)
+        else:
+            self._queue.append(message)
+
+        self._available.set()
+        if len(self._queue) >= self.maxsize:
+            self._space.clear()
+
+    def _evict(self, message):
+        # the policy only drops while connected, during an outage the spool keeps the message
+        if self.client is None or not self.client.is_connected():
+            self._write_spool([message])
+        else:
+            self.dropped += 1
+
+    async def put(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """Queues a message, waiting for space if the policy is "block\""""
+        if self.policy == "block":
+            while len(self._queue) >= self.maxsize:
+                self._space.clear()
+                await self._space.wait()
+        self.publish(topic, payload, qos, retain)
+
+    # --------------------------
+    # Spool
+    # --------------------------
+
+    def _write_spool(self, messages):
+        if not self.spool_file:
+            self.dropped += len(messages)
+            return
+        if self._spool is None:
+            self._spool_count = self._count_spool()
+            self._spool = open(self.spool_file, "a", encoding="utf-8")
+        for topic, payload, qos, retain in messages:
+            if isinstance(payload, bytes):
+                payload = payload.decode("utf-8", "replace")
+            self._spool.write(json.dumps([topic, payload, qos, retain]) + "\n")
+        self._spool.flush()
+        self.spooled += len(messages)
+        self._spool_count += len(messages)
+        self._replay_pending = True
+        if self._spool_count > self.spool_size + self.spool_size // 10:
+            self._compact_spool()
+
+    def _count_spool(self) -> int:
+        if not os.path.exists(self.spool_file):
+            return 0
+        with open(self.spool_file, encoding="utf-8") as f:
+            return sum(1 for line in f if line.strip())
+
+    def _compact_spool(self):
+        """Keeps the newest spool_size messages, with "coalesce" only the latest per topic"""
+        self._spool.close()
+        self._spool = None
+        with open(self.spool_file, encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        kept = lines
+        if self.policy == "coalesce":
+            latest = {}
+            for line in lines:
+                topic = json.loads(line)[0]
+                latest.pop(topic, None)
+                latest[topic] = line
+            kept = list(latest.values())
+        kept = kept[-self.spool_size:]
+        self.dropped += len(lines) - len(kept)
+
+        compact_file = self.spool_file + ".compact"
+        with open(compact_file, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+        os.replace(compact_file, self.spool_file)
+        self._spool = open(self.spool_file, "a", encoding="utf-8")
+        self._spool_count = len(kept)
+        log.warning("MQTT spool full, dropped %i of %i messages", len(lines) - len(kept), len(lines))
+
+    async def _replay_spool(self):
+        self._replay_pending = False
+        if not self.spool_file or not os.path.exists(self.spool_file):
+            return
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+        replay_file = self.spool_file + ".replay"
+        os.replace(self.spool_file, replay_file)
+        self._spool_count = 0
+        with open(replay_file, encoding="utf-8") as f:
+            messages = [tuple(json.loads(line)) for line in f if line.strip()]
+        os.remove(replay_file)
+        log.info("Replaying %i spooled MQTT messages", len(messages))
+
+        for start in range(0, len(messages), REPLAY_BATCH):
+            if not self.client.is_connected():
+                self._write_spool(messages[start:])
+                return
+            self._send(messages[start:start + REPLAY_BATCH])
+            await asyncio.sleep(0)
+
+    # --------------------------
+    # Consumer side
+    # --------------------------
+
+    def _take(self):
+        if self.policy == "coalesce":
+            messages = list(self._queue.values())
+        else:
+            messages = list(self._queue)
+        self._queue.clear()
+        self._available.clear()
+        self._space.set()
+        return messages
+
+    def _send(self, messages):
+        failed = []
+        for message in messages:
+            info = self.client.publish(*message)
+            if info.rc != 0:
+                failed.append(message)
+        self.published += len(messages) - len(failed)
+        if failed:
+            self._write_spool(failed)
+
+    def start(self, host: str, port: int, keepalive: int = 60):
+        """Connects in the background and starts paho's network thread"""
+        self._loop = asyncio.get_running_loop()
+        previous = self.client.on_connect
+
+        def on_connect(client, *args):
+            if previous is not None:
+                previous(client, *args)
+            # wake the consumer, so queue and spool are sent without waiting for new messages
+            if client.is_connected():
+                self._loop.call_soon_threadsafe(self._connected.set)
+                self._loop.call_soon_threadsafe(self._available.set)
+
+        self.client.on_connect = on_connect
+        self.client.connect_async(host, port, keepalive)
+        self.client.loop_start()
+
+    async def start_from_config(self, cfg):
+        """
+        Creates the client in a worker thread if there is none yet and
+        connects to the broker of cfg["mqtt"] in the background. Messages
+        published in the meantime stay queued.
+        """
+        if self.client is None:
+            self.client = await asyncio.to_thread(create_client, cfg)
+        self.start(cfg["mqtt"]["host"], cfg["mqtt"]["port"], 60)
+
+    async def run(self):
+        """Hands queued messages to the client, keeping them queued while it is offline"""
+        try:
+            while True:
+                await self._available.wait()
+                if not self.client.is_connected():
+                    # the messages stay queued under the overflow policy until on_connect
+                    self._connected.clear()
+                    await self._connected.wait()
+                    continue
+                messages = self._take()
+                if self._replay_pending:
+                    await self._replay_spool()
+                if messages:
+                    self._send(messages)
+        finally:
+            if self._queue:
+                self._write_spool(self._take())
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    def stop(self):
+        """Stops paho's network thread"""
+        if self.client is None:
+            return
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def stats(self) -> dict:
+        """Counters for diagnostics"""
+        return {"queued": len(self._queue), "published": self.published,
+                "dropped": self.dropped, "spooled": self.spooled}
@@ -0,0 +1,78 @@
+"""
+Read planner for DTSU666 register blocks
+
+Compiles a list of measurement keys into the fewest contiguous
+holding register reads and slices the block responses back into
+per-register words.
+"""
+
+from dtsu666_constants import REGISTERS
+
+# Modbus limit for function code 3 is 125 registers per request
+MODBUS_MAX_REGISTERS = 125
+
+# 0x2006 - 0x2045 fits into a single request with these defaults
+DEFAULT_MAX_REGISTERS = 64
+DEFAULT_MAX_GAP = 20
+
+
+class ReadSpan:
+    """Contiguous register window covering one or more measurement keys"""
+
+    __slots__ = ("start", "count", "keys")
+
+    def __init__(self, start: int, count: int, keys: tuple):
+        self.start = start
+        self.count = count
+        self.keys = keys
+
+    @property
+    def end(self) -> int:
+        """First address behind the span"""
+        return self.start + self.count
+
+    def slice(self, registers, register_map=REGISTERS) -> dict:
+        """Split the raw words of a block read into {address: words}"""
+        result = {}
+        for address in self.keys:
+            offset = address - self.start
+            result[address] = registers[offset:offset + register_map[address]["words"]]
+        return result
+
+    def __repr__(self):
+        return f"ReadSpan(0x{self.start:04X}, count={self.count}, keys={len(self.keys)})"
+
+
+def plan_reads(keys, register_map=REGISTERS,
+               max_registers: int = DEFAULT_MAX_REGISTERS,
+               max_gap: int = DEFAULT_MAX_GAP) -> list:
+    """
+    Group keys into contiguous spans.
+
+    Two neighbouring registers end up in the same span as long as the
+    unused words between them do not exceed max_gap and the span stays
+    within max_registers.
+    """
+    max_registers = min(max_registers, MODBUS_MAX_REGISTERS)
+    spans = []
+    start = end = None
+    members = []
+
+    for address in sorted(set(keys)):
+        words = register_map[address]["words"]
+        if words > max_registers:
+            raise ValueError(f"Register 0x{address:04X} does not fit into {max_registers} registers")
+
+        if start is not None and address - end <= max_gap \
+                and max(end, address + words) - start <= max_registers:
+            end = max(end, address + words)
+            members.append(address)
+            continue
+
+        if start is not None:
+            spans.append(ReadSpan(start, end - start, tuple(members)))
+        start, end, members = address, address + words, [address]
+
+    if start is not None:
+        spans.append(ReadSpan(start, end - start, tuple(members)))
+    return spans
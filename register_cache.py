@@ -0,0 +1,134 @@
+"""
+Read-through cache for upstream DTSU666 register reads
+
+Fresh blocks are kept for a short TTL and keyed by
+(device_id, address, count). A read is answered from any fresh block
+that covers the requested range. Identical or covered reads that are
+already on the wire are coalesced into that single upstream request.
+"""
+
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("dtsu666-proxy")
+
+DEFAULT_TTL = 0.5
+
+# weight of the newest sample in the upstream read time average
+RTT_ALPHA = 0.2
+
+
+class RegisterCache:
+    """TTL cache with single-flight coalescing in front of an upstream read function"""
+
+    def __init__(self, fetch, ttl: float = DEFAULT_TTL, clock=time.monotonic, prefetch_fetch=None):
+        """
+        fetch is awaited as fetch(device_id, address, count) and returns
+        the register list or None if the upstream read failed. Prefetches
+        use prefetch_fetch if given, e.g. to read with a lower bus priority.
+        """
+        self.fetch = fetch
+        self.prefetch_fetch = prefetch_fetch or fetch
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.prefetches = 0
+        self.rtt = None
+        self._blocks = {}
+        self._inflight = {}
+
+    @staticmethod
+    def _covers(key, device_id, address, count) -> bool:
+        return key[0] == device_id and key[1] <= address and address + count <= key[1] + key[2]
+
+    def lookup(self, device_id: int, address: int, count: int, margin: float = 0.0):
+        """Returns the registers from a block covering the range that is fresh for margin seconds, or None"""
+        now = self.clock() + margin
+        key = (device_id, address, count)
+        block = self._blocks.get(key)
+        if block is not None and block[0] > now:
+            return block[1]
+
+        for key, (expires, values) in self._blocks.items():
+            if expires > now and self._covers(key, device_id, address, count):
+                offset = address - key[1]
+                return values[offset:offset + count]
+        return None
+
+    def put(self, device_id: int, address: int, values):
+        """Stores a block read from upstream"""
+        now = self.clock()
+        for key in [key for key, (expires, _) in self._blocks.items() if expires <= now]:
+            del self._blocks[key]
+        self._blocks[(device_id, address, len(values))] = (now + self.ttl, list(values))
+
+    def invalidate(self):
+        """Drops all cached blocks"""
+        self._blocks.clear()
+
+    async def _load(self, key, fetch):
+        start = self.clock()
+        values = await fetch(*key)
+        if values is not None:
+            elapsed = self.clock() - start
+            self.rtt = elapsed if self.rtt is None else self.rtt + RTT_ALPHA * (elapsed - self.rtt)
+            self.put(key[0], key[1], values)
+        return values
+
+    def _start(self, key, fetch=None):
+        task = asyncio.ensure_future(self._load(key, fetch or self.fetch))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    def _inflight_covering(self, device_id, address, count):
+        for key, task in self._inflight.items():
+            if self._covers(key, device_id, address, count):
+                return key, task
+        return None, None
+
+    def prefetch(self, device_id: int, address: int, count: int, margin: float = 0.0) -> bool:
+        """
+        Starts an upstream read in the background, unless the range stays
+        fresh for margin seconds or is already on the wire.
+        """
+        if self.lookup(device_id, address, count, margin) is not None:
+            return False
+        if self._inflight_covering(device_id, address, count)[1] is not None:
+            return False
+        self.prefetches += 1
+        task = self._start((device_id, address, count), self.prefetch_fetch)
+        task.add_done_callback(self._prefetch_done)
+        return True
+
+    @staticmethod
+    def _prefetch_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            log.debug("Prefetch failed: %s", task.exception())
+
+    async def get(self, device_id: int, address: int, count: int = 1):
+        """Returns the registers, reading upstream only if no fresh block covers the range"""
+        values = self.lookup(device_id, address, count)
+        if values is not None:
+            self.hits += 1
+            return values
+
+        key, task = self._inflight_covering(device_id, address, count)
+        if task is not None:
+            self.coalesced += 1
+            values = await asyncio.shield(task)
+            if values is None:
+                return None
+            offset = address - key[1]
+            return values[offset:offset + count]
+
+        self.misses += 1
+        return await asyncio.shield(self._start((device_id, address, count)))
+
+    def stats(self) -> dict:
+        """Hit/miss counters for diagnostics"""
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                "prefetches": self.prefetches, "blocks": len(self._blocks)}
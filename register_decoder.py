@@ -0,0 +1,47 @@
+"""
+Block decoder for DTSU666 register spans
+
+Decodes all FLOAT32 values of a block read in one struct call and
+applies the scale factors from REGISTERS.
+"""
+
+import struct
+from operator import mul
+
+from dtsu666_constants import REGISTERS
+
+# word count -> struct type of the big endian value
+VALUE_FORMATS = {
+    2: "f",
+}
+
+
+class SpanDecoder:
+    """Precompiled decoder for the registers of one ReadSpan"""
+
+    __slots__ = ("span", "keys", "factors", "_words", "_values")
+
+    def __init__(self, span, register_map=REGISTERS):
+        self.span = span
+        self.keys = span.keys
+        self.factors = tuple(register_map[address]["factor"] for address in span.keys)
+
+        fmt = ">"
+        position = span.start
+        for address in span.keys:
+            words = register_map[address]["words"]
+            if words not in VALUE_FORMATS:
+                raise ValueError(f"Register 0x{address:04X} with {words} words is not supported")
+            if address < position:
+                raise ValueError(f"Register 0x{address:04X} overlaps its predecessor")
+            fmt += f"{2 * (address - position)}x{VALUE_FORMATS[words]}"
+            position = address + words
+        fmt += f"{2 * (span.end - position)}x"
+
+        self._words = struct.Struct(f">{span.count}H")
+        self._values = struct.Struct(fmt)
+
+    def decode(self, registers) -> dict:
+        """Decode the raw words of the span into {address: scaled value}"""
+        raw = self._values.unpack(self._words.pack(*registers))
+        return dict(zip(self.keys, map(mul, raw, self.factors)))
@@ -0,0 +1,119 @@
+"""
+Compiled DTSU666 register profiles
+
+REGISTERS and PROFILES in dtsu666_constants are the declarative
+definition. This module compiles them once into:
+- Register: an immutable descriptor per register (frozen dataclass with
+  slots, attribute access instead of string keys)
+- RegisterProfile: the registers of a profile with the tables the hot
+  paths need: address -> index map, names, scale factor vector, the
+  struct of the whole frame as FLOAT32 values, topic names per prefix
+  and the block read decoders per read plan
+
+compile_profile() caches the profiles by register set, so the reader,
+the emulator and the publisher share the same tables and nothing is
+recomputed per poll cycle.
+"""
+
+import struct
+from dataclasses import dataclass
+
+from dtsu666_constants import PROFILES, REGISTERS
+from read_planner import DEFAULT_MAX_GAP, DEFAULT_MAX_REGISTERS, plan_reads
+from register_decoder import VALUE_FORMATS, SpanDecoder
+
+
+@dataclass(frozen=True, slots=True, repr=False)
+class Register:
+    """Immutable descriptor of one DTSU666 register"""
+
+    address: int
+    name: str
+    func: int = 3
+    words: int = 2
+    factor: float = 1.0
+    deadband_abs: float = 0.0
+    deadband_rel: float = 0.0
+
+    def __repr__(self):
+        return f"Register(0x{self.address:04X}, {self.name!r})"
+
+
+REGISTER_TABLE = {address: Register(address, **spec) for address, spec in REGISTERS.items()}
+
+
+class RegisterProfile:
+    """Precomputed tables for one set of registers, in the order of the profile"""
+
+    __slots__ = ("name", "registers", "keys", "index", "names", "factors", "frame", "_topics", "_decoders")
+
+    def __init__(self, name: str, keys, register_table=REGISTER_TABLE):
+        keys = tuple(dict.fromkeys(keys))
+        unknown = [address for address in keys if address not in register_table]
+        if unknown:
+            raise ValueError(f"Unknown DTSU666 register(s) {', '.join(f'0x{a:04X}' for a in unknown)}")
+        self.name = name
+        self.registers = tuple(register_table[address] for address in keys)
+        self.keys = keys
+        self.index = {address: i for i, address in enumerate(keys)}
+        self.names = tuple(register.name for register in self.registers)
+        self.factors = tuple(register.factor for register in self.registers)
+        # all values of the profile as one big endian struct, e.g. for the emulator's register image
+        self.frame = struct.Struct(">" + "".join(VALUE_FORMATS[register.words] for register in self.registers))
+        self._topics = {}
+        self._decoders = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return f"RegisterProfile({self.name!r}, registers={len(self.keys)})"
+
+    def topics(self, prefix: str) -> dict:
+        """{address: <prefix>/<register name>}"""
+        topics = self._topics.get(prefix)
+        if topics is None:
+            topics = self._topics[prefix] = {address: f"{prefix}/{name}"
+                                             for address, name in zip(self.keys, self.names)}
+        return topics
+
+    def decoders(self, max_registers: int = DEFAULT_MAX_REGISTERS, max_gap: int = DEFAULT_MAX_GAP) -> tuple:
+        """Block read plan of the profile as SpanDecoders"""
+        key = (max_registers, max_gap)
+        decoders = self._decoders.get(key)
+        if decoders is None:
+            decoders = self._decoders[key] = tuple(
+                SpanDecoder(span) for span in plan_reads(self.keys, REGISTERS, max_registers, max_gap))
+        return decoders
+
+
+_compiled = {}
+
+
+def compile_profile(profile) -> RegisterProfile:
+    """
+    Returns the compiled profile for a PROFILES name or an iterable of
+    register addresses. Every register set is compiled only once.
+    """
+    if isinstance(profile, RegisterProfile):
+        return profile
+    if isinstance(profile, str):
+        compiled = _compiled.get(profile)
+        if compiled is None:
+            if profile not in PROFILES:
+                raise ValueError(f"Unknown register profile {profile!r}, expected one of {tuple(PROFILES)}")
+            keys = tuple(PROFILES[profile])
+            # the same register set may already be compiled as a custom profile
+            compiled = _compiled.get(keys)
+            if compiled is None:
+                compiled = _compiled[keys] = RegisterProfile(profile, keys)
+            _compiled[profile] = compiled
+        return compiled
+    keys = tuple(profile)
+    compiled = _compiled.get(keys)
+    if compiled is None:
+        compiled = _compiled[keys] = RegisterProfile("custom", keys)
+    return compiled
+
+
+FULL_PROFILE = compile_profile("all")
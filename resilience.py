@@ -0,0 +1,266 @@
+"""
+Resilient Modbus transactions for the DTSU666 reader
+
+A TransactionGuard wraps every read of the reader:
+- the timeout follows the measured round trips per meter and read size
+  like TCP's retransmission timer (RFC 6298): SRTT/RTTVAR estimate,
+  timeout = SRTT + 4 * RTTVAR, doubled for every retry of the same read.
+  A 64 register span takes about 3.5 times as long as 16 registers at
+  9600 baud, so every span size has an estimate of its own. Reads that
+  needed a retry give no sample (Karn's rule), the backed-off timeout is
+  kept until the next read answers at the first attempt
+- a failed read is retried a bounded number of times after a short
+  random pause, so two readers on a bus do not retry in lockstep
+- readers sharing a pooled client share its lock: setting the timeout
+  and the read it applies to happen under the lock, so one reader's
+  timeout never ends up on another reader's request
+- a per-meter circuit breaker opens after a few lost responses in a row;
+  while it is open reads fail at once, after open_time one probe read
+  decides whether it closes again or stays open twice as long
+
+Reads that failed come back as None and the cycle continues, so a
+reader cycle always yields a ReadResult with the missing registers
+marked instead of an exception or a list of zeros.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+log = logging.getLogger("dtsu666-resilience")
+
+DEFAULT_RETRIES = 2
+DEFAULT_MIN_TIMEOUT = 0.05
+DEFAULT_MAX_TIMEOUT = 2.0
+# retry pauses are drawn from [0, RETRY_JITTER * timeout]
+RETRY_JITTER = 0.5
+DEFAULT_BREAKER_THRESHOLD = 3
+DEFAULT_BREAKER_OPEN_TIME = 1.0
+DEFAULT_BREAKER_MAX_OPEN_TIME = 60.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class ReadResult(dict):
+    """Values {address: value} of one read cycle, missing registers are None and listed in missing"""
+
+    def __init__(self, values=(), missing=()):
+        super().__init__(values)
+        self.missing = tuple(missing)
+        for key in self.missing:
+            self.setdefault(key, None)
+
+    @property
+    def complete(self) -> bool:
+        return not self.missing
+
+
+class RttEstimator:
+    """Smoothed round-trip time and derived timeout (RFC 6298)"""
+
+    __slots__ = ("srtt", "rttvar", "timeout", "min_timeout", "max_timeout")
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, initial: float, min_timeout: float = DEFAULT_MIN_TIMEOUT,
+                 max_timeout: float = DEFAULT_MAX_TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.min_timeout = min_timeout
+        self.max_timeout = max(max_timeout, initial)
+        self.timeout = initial
+
+    def update(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+
+
+class CircuitBreaker:
+    """Stops reading a meter that does not answer and probes it periodically"""
+
+    __slots__ = ("threshold", "open_time", "max_open_time", "clock", "state", "failures", "retry_at",
+                 "_open_for")
+
+    def __init__(self, threshold: int = DEFAULT_BREAKER_THRESHOLD, open_time: float = DEFAULT_BREAKER_OPEN_TIME,
+                 max_open_time: float = DEFAULT_BREAKER_MAX_OPEN_TIME, clock=time.monotonic):
+        """threshold 0 disables the breaker"""
+        self.threshold = threshold
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.retry_at = 0.0
+        self._open_for = open_time
+
+    def allow(self) -> bool:
+        """True if a read may go to the meter, at most one probe while the breaker is not closed"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.clock() >= self.retry_at:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def success(self) -> bool:
+        """Records an answer, returns True if the breaker closed"""
+        self.failures = 0
+        if self.state == CLOSED:
+            return False
+        self.state = CLOSED
+        self._open_for = self.open_time
+        return True
+
+    def failure(self) -> bool:
+        """Records a lost response, returns True if the breaker opened"""
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self._open_for = min(self._open_for * 2, self.max_open_time)
+        elif not self.threshold or self.failures < self.threshold:
+            return False
+        self.state = OPEN
+        self.retry_at = self.clock() + self._open_for
+        return True
+
+
+class _DeviceGuard:
+    __slots__ = ("rtt", "breaker", "reads", "retries", "timeouts", "rejected")
+
+    def __init__(self, breaker: CircuitBreaker):
+        # RttEstimator per register count
+        self.rtt = {}
+        self.breaker = breaker
+        self.reads = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+
+class TransactionGuard:
+    """Adaptive timeout, retries and circuit breaker around the reads of one Modbus client"""
+
+    def __init__(self, client, timeout: float, retries: int = DEFAULT_RETRIES, adaptive: bool = True,
+                 min_timeout: float = DEFAULT_MIN_TIMEOUT, max_timeout: float = DEFAULT_MAX_TIMEOUT,
+                 breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD,
+                 breaker_open_time: float = DEFAULT_BREAKER_OPEN_TIME,
+                 breaker_max_open_time: float = DEFAULT_BREAKER_MAX_OPEN_TIME, lock: asyncio.Lock = None,
+                 clock=time.monotonic):
+        """
+        client is a pymodbus client with retries=0 (or any object with
+        read_holding_registers). timeout is the initial timeout and, unless
+        adaptive, the fixed one. lock is shared by all guards of the client,
+        e.g. ClientPool.lock(client).
+        """
+        self.client = client
+        self.lock = lock if lock is not None else asyncio.Lock()
+        self.timeout = timeout
+        self.retries = retries
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_open_time = breaker_open_time
+        self.breaker_max_open_time = breaker_max_open_time
+        self.clock = clock
+        self.devices = {}
+
+    @classmethod
+    def from_config(cls, client, reader_cfg, lock: asyncio.Lock = None):
+        """Creates the guard from the reader section of the config"""
+        return cls(client, reader_cfg["timeout"], lock=lock,
+                   retries=reader_cfg.get("retries", DEFAULT_RETRIES),
+                   adaptive=reader_cfg.get("adaptive_timeout", True),
+                   min_timeout=reader_cfg.get("min_timeout", DEFAULT_MIN_TIMEOUT),
+                   max_timeout=reader_cfg.get("max_timeout", DEFAULT_MAX_TIMEOUT),
+                   breaker_threshold=reader_cfg.get("breaker_threshold", DEFAULT_BREAKER_THRESHOLD),
+                   breaker_open_time=reader_cfg.get("breaker_open_time", DEFAULT_BREAKER_OPEN_TIME),
+                   breaker_max_open_time=reader_cfg.get("breaker_max_open_time", DEFAULT_BREAKER_MAX_OPEN_TIME))
+
+    def _device(self, device_id: int) -> _DeviceGuard:
+        guard = self.devices.get(device_id)
+        if guard is None:
+            guard = self.devices[device_id] = _DeviceGuard(
+                CircuitBreaker(self.breaker_threshold, self.breaker_open_time, self.breaker_max_open_time,
+                               self.clock))
+        return guard
+
+    def _estimator(self, guard: _DeviceGuard, count: int) -> RttEstimator:
+        rtt = guard.rtt.get(count)
+        if rtt is None:
+            rtt = guard.rtt[count] = RttEstimator(self.timeout, self.min_timeout, self.max_timeout)
+        return rtt
+
+    def _set_timeout(self, timeout: float):
+        # pymodbus reads the response timeout from the transaction manager on every attempt
+        ctx = getattr(self.client, "ctx", None)
+        if ctx is not None:
+            ctx.comm_params.timeout_connect = timeout
+
+    async def read(self, device_id: int, address: int, count: int):
+        """Returns the registers, or None if the meter did not answer or answered with an exception"""
+        guard = self._device(device_id)
+        if not guard.breaker.allow():
+            guard.rejected += 1
+            return None
+
+        attempts = 1 if guard.breaker.state == HALF_OPEN else self.retries + 1
+        rtt = self._estimator(guard, count)
+        timeout = rtt.timeout
+        for attempt in range(attempts):
+            if attempt:
+                guard.retries += 1
+                await asyncio.sleep(random.uniform(0, RETRY_JITTER * timeout))
+            guard.reads += 1
+            async with self.lock:
+                # the timeout is a setting of the client, it must not change until this read is done
+                if self.adaptive:
+                    self._set_timeout(timeout)
+                started = self.clock()
+                try:
+                    rr = await self.client.read_holding_registers(address, count=count, device_id=device_id)
+                except Exception as e:
+                    log.debug("Read %i @ %i failed: %s", device_id, address, e)
+                    rr = None
+            if rr is not None:
+                # any answer, also an exception response, shows the meter is alive. After
+                # retries the answer may belong to an earlier attempt (Karn's problem), so
+                # only first attempts are sampled and a retried read keeps its backoff.
+                if self.adaptive:
+                    if attempt:
+                        rtt.timeout = timeout
+                    else:
+                        rtt.update(self.clock() - started)
+                if guard.breaker.success():
+                    log.info("Meter %i answers again", device_id)
+                if rr.isError():
+                    log.warning("Meter %i answered %i @ %i with %s", device_id, address, count, rr)
+                    return None
+                return rr.registers
+            guard.timeouts += 1
+            if guard.breaker.failure():
+                log.warning("Meter %i not responding, reads suspended for %.0f s",
+                            device_id, guard.breaker.retry_at - self.clock())
+                return None
+            if self.adaptive:
+                timeout = min(timeout * 2, self.max_timeout)
+        return None
+
+    def stats(self) -> dict:
+        """Counters per device for diagnostics"""
+        return {str(device_id): {"state": guard.breaker.state,
+                                 "timeout": {str(count): round(rtt.timeout, 4)
+                                             for count, rtt in sorted(guard.rtt.items())},
+                                 "srtt": {str(count): round(rtt.srtt, 4)
+                                          for count, rtt in sorted(guard.rtt.items()) if rtt.srtt is not None},
+                                 "reads": guard.reads, "retries": guard.retries,
+                                 "timeouts": guard.timeouts, "rejected": guard.rejected}
+                for device_id, guard in sorted(self.devices.items())}
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+RTU traffic capture and replay
+
+A CaptureWriter hooks into the trace_packet/trace_pdu callbacks of a
+pymodbus client or server (like telemetry.TransactionMonitor) and appends
+every request and response frame to a capture file:
+
+    header:  magic "DTSUCAP1", wall clock start (float64), role (16 bytes)
+    record:  seconds since start (float64), kind, flags, length (uint16), frame
+
+All numbers are little endian. Records are length-prefixed, so the file
+can be mapped with mmap and walked without parsing the frames. The file
+is unbuffered and every record is one write, so a capture cut short by a
+crash or a kill ends with the last complete frame.
+
+The replay tool drives a device under test from a capture:
+
+    python -m rtu_capture info capture.rtucap
+    python -m rtu_capture requests capture.rtucap --port /dev/ttyUSB1 [--speed 0]
+        sends the captured requests to an emulator or proxy and compares
+        the responses (the tool plays the inverter)
+    python -m rtu_capture responses capture.rtucap --port /dev/ttyUSB1 [--speed 0]
+        answers requests with the captured responses (the tool plays the
+        meter for the reader or the proxy)
+
+--speed 1 keeps the original timing, --speed 0 replays as fast as possible.
+"""
+
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import time
+from collections import defaultdict, deque
+
+import serial
+from pymodbus.framer import FramerRTU
+from pymodbus.pdu import DecodePDU
+
+MAGIC = b"DTSUCAP1"
+HEADER = struct.Struct("<8sd16s")
+RECORD = struct.Struct("<dBBH")
+
+REQUEST = 0
+RESPONSE = 1
+# bytes that were received but never formed a frame (CRC or framing error)
+FLAG_INCOMPLETE = 0x01
+
+DEFAULT_DIRECTORY = "captures"
+
+
+class CaptureWriter:
+    """Appends the frames of one Modbus client or server to a capture file"""
+
+    def __init__(self, path: str, role: str, server: bool = False, clock=time.monotonic):
+        self.path = path
+        self.role = role
+        self.server = server
+        self.clock = clock
+        self.frames = 0
+        self._file = open(path, "wb", buffering=0)
+        self._file.write(HEADER.pack(MAGIC, time.time(), role.encode()[:16]))
+        self._started = clock()
+        self._rx = b""
+
+    @classmethod
+    def from_config(cls, cfg, role: str, server: bool = False):
+        """Creates a writer from cfg["capture"], or returns None if capturing is disabled"""
+        cap_cfg = cfg.get("capture", {})
+        if not cap_cfg.get("enabled", False):
+            return None
+        directory = cap_cfg.get("directory", DEFAULT_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{role}-{time.strftime('%Y%m%d-%H%M%S')}.rtucap")
+        return cls(path, role, server)
+
+    def write(self, kind: int, frame: bytes, flags: int = 0):
+        self._file.write(RECORD.pack(self.clock() - self._started, kind, flags, len(frame)) + frame)
+        self.frames += 1
+
+    def trace_packet(self, sending: bool, data: bytes) -> bytes:
+        if sending:
+            if self._rx:
+                # the previous response never formed a frame
+                self.write(REQUEST if self.server else RESPONSE, self._rx, FLAG_INCOMPLETE)
+                self._rx = b""
+            self.write(RESPONSE if self.server else REQUEST, data)
+        else:
+            # pymodbus passes the whole receive buffer until a frame is cut off
+            self._rx = data
+        return data
+
+    def trace_pdu(self, sending: bool, pdu):
+        if not sending and self._rx:
+            self.write(REQUEST if self.server else RESPONSE, self._rx)
+            self._rx = b""
+        return pdu
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class Frame:
+    __slots__ = ("time", "kind", "flags", "data")
+
+    def __init__(self, time_, kind, flags, data):
+        self.time = time_
+        self.kind = kind
+        self.flags = flags
+        self.data = data
+
+
+class CaptureReader:
+    """Memory-mapped, read-only view of a capture file"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started, role = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a DTSU666 RTU capture")
+        self.role = role.rstrip(b"\0").decode()
+
+    def __iter__(self):
+        data = self._map
+        offset = HEADER.size
+        while offset + RECORD.size <= len(data):
+            time_, kind, flags, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > len(data):
+                # truncated last record, e.g. after a power cut
+                return
+            yield Frame(time_, kind, flags, data[offset:offset + length])
+            offset += length
+
+    def exchanges(self):
+        """(request, response) pairs, response is None if the request was not answered"""
+        request = None
+        for frame in self:
+            if frame.kind == REQUEST:
+                if request is not None:
+                    yield request, None
+                request = frame
+            elif request is not None:
+                yield request, frame
+                request = None
+        if request is not None:
+            yield request, None
+
+    def close(self):
+        self._map.close()
+
+
+class SerialPort:
+    """Raw RTU frames on a serial port, read through the event loop"""
+
+    def __init__(self, port: str, baudrate: int, is_server: bool):
+        self._serial = serial.Serial(port, baudrate=baudrate, timeout=0)
+        self._framer = FramerRTU(DecodePDU(is_server))
+        self._buffer = b""
+        self._data = asyncio.Event()
+        asyncio.get_running_loop().add_reader(self._serial.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        self._buffer += self._serial.read(4096)
+        self._data.set()
+
+    def write(self, frame: bytes):
+        self._serial.write(frame)
+
+    async def read_frame(self, timeout: float = None) -> bytes:
+        """Next complete frame, None on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            used, pdu = self._framer.handleFrame(self._buffer, 0, 0)
+            if pdu is not None:
+                frame, self._buffer = self._buffer[:used], self._buffer[used:]
+                return frame
+            self._data.clear()
+            try:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                await asyncio.wait_for(self._data.wait(), remaining)
+            except asyncio.TimeoutError:
+                self._buffer = b""
+                return None
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self._serial.fileno())
+        self._serial.close()
+
+
+async def _pace(started: float, offset: float, speed: float):
+    if speed > 0:
+        delay = started + offset / speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def replay_requests(capture: CaptureReader, port: str, baudrate: int = 9600,
+                          speed: float = 1.0, timeout: float = 1.0) -> dict:
+    """Sends the captured requests and compares the responses with the capture"""
+    link = SerialPort(port, baudrate, is_server=False)
+    stats = {"requests": 0, "matched": 0, "differed": 0, "timeouts": 0}
+    latencies = []
+    started = time.monotonic()
+    try:
+        for request, expected in capture.exchanges():
+            if request.flags & FLAG_INCOMPLETE:
+                continue
+            await _pace(started, request.time, speed)
+            sent = time.monotonic()
+            link.write(request.data)
+            response = await link.read_frame(timeout)
+            stats["requests"] += 1
+            if response is None:
+                stats["timeouts"] += 1
+                continue
+            latencies.append(time.monotonic() - sent)
+            if expected is not None and response == expected.data:
+                stats["matched"] += 1
+            else:
+                stats["differed"] += 1
+    finally:
+        link.close()
+    elapsed = time.monotonic() - started
+    stats["elapsed"] = round(elapsed, 3)
+    stats["requests_per_s"] = round(stats["requests"] / elapsed, 1) if elapsed else None
+    if latencies:
+        latencies.sort()
+        stats["latency_p50_ms"] = round(latencies[len(latencies) // 2] * 1e3, 3)
+        stats["latency_max_ms"] = round(latencies[-1] * 1e3, 3)
+    return stats
+
+
+async def replay_responses(capture: CaptureReader, port: str, baudrate: int = 9600,
+                           speed: float = 1.0) -> dict:
+    """
+    Answers requests with the captured responses.
+
+    Every request is answered with the next unused response that was
+    captured for the same request bytes, after the original response time.
+    Ends when all captured responses are used.
+    """
+    answers = defaultdict(deque)
+    remaining = 0
+    for request, response in capture.exchanges():
+        if response is not None and not response.flags & FLAG_INCOMPLETE:
+            answers[bytes(request.data)].append((response.time - request.time, bytes(response.data)))
+            remaining += 1
+
+    link = SerialPort(port, baudrate, is_server=True)
+    stats = {"requests": 0, "answered": 0, "unknown": 0}
+    started = time.monotonic()
+    try:
+        while remaining:
+            request = await link.read_frame()
+            stats["requests"] += 1
+            queue = answers.get(request)
+            if not queue:
+                stats["unknown"] += 1
+                continue
+            delay, response = queue.popleft()
+            remaining -= 1
+            if speed > 0:
+                await asyncio.sleep(delay / speed)
+            link.write(response)
+            stats["answered"] += 1
+    finally:
+        link.close()
+    stats["elapsed"] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def info(capture: CaptureReader) -> dict:
+    frames = list(capture)
+    return {
+        "role": capture.role,
+        "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(capture.started)),
+        "duration": round(frames[-1].time - frames[0].time, 3) if frames else 0,
+        "requests": sum(frame.kind == REQUEST for frame in frames),
+        "responses": sum(frame.kind == RESPONSE for frame in frames),
+        "incomplete": sum(bool(frame.flags & FLAG_INCOMPLETE) for frame in frames),
+        "bytes": sum(len(frame.data) for frame in frames),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DTSU666 RTU capture replay")
+    parser.add_argument("command", choices=("info", "requests", "responses"))
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--port", help="serial port of the device under test")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = original timing, 2 = twice as fast, 0 = as fast as possible")
+    parser.add_argument("--timeout", type=float, default=1.0, help="response timeout for 'requests'")
+    args = parser.parse_args()
+
+    if args.command != "info" and not args.port:
+        parser.error(f"{args.command} needs --port")
+
+    capture = CaptureReader(args.capture)
+    try:
+        if args.command == "info":
+            result = info(capture)
+        elif args.command == "requests":
+            result = asyncio.run(replay_requests(capture, args.port, args.baudrate, args.speed, args.timeout))
+        else:
+            result = asyncio.run(replay_responses(capture, args.port, args.baudrate, args.speed))
+    finally:
+        capture.close()
+    for key, value in result.items():
+        print(f"{key:16}: {value}")
+
+
+if __name__ == "__main__":
+    main()
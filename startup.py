@@ -0,0 +1,86 @@
+"""
+Cold start of the gateway entry points
+
+Import this module first: STARTED is taken when the interpreter gets
+here, so the timer covers the heavy imports that follow (pymodbus, paho).
+
+A StartupTimer records milestones in seconds since STARTED:
+
+    imports         the entry point's own imports are done
+    mqtt_started    paho is imported and connects in the background
+    serial_open     the reader's serial port is open
+    emulator_started  the emulator server is running
+    first_values    the first reading of the meter is in the register image
+    first_served    the first response with a reading went to the inverter
+
+It is attached to the emulator (or proxy) server like a TransactionMonitor
+and logs the time to first served register once it is known. Telemetry
+exports the milestones as dtsu666_startup_seconds.
+
+Logging is configured by the entry points only (configure_logging), so
+importing a module has no global side effects.
+"""
+
+import logging
+import time
+
+STARTED = time.monotonic()
+
+LOG_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
+
+log = logging.getLogger("dtsu666-startup")
+
+
+def configure_logging(cfg=None, **kwargs):
+    """Sets up the root logger of an entry point, at the level of cfg["logging"] if given"""
+    kwargs.setdefault("format", LOG_FORMAT)
+    kwargs.setdefault("level", logging.INFO)
+    logging.basicConfig(**kwargs)
+    if cfg is not None and "logging" in cfg:
+        logging.getLogger().setLevel(cfg["logging"]["level"])
+
+
+class StartupTimer:
+    """Milestones of one process start, and a server tracer for the first served register"""
+
+    def __init__(self, started: float = STARTED, after: str = "first_values", clock=time.monotonic):
+        """
+        after: milestone a response must follow to count as served reading,
+        None if every response carries a live value (proxy)
+        """
+        self.started = started
+        self.after = after
+        self.clock = clock
+        self.milestones = {}
+
+    def mark(self, milestone: str) -> float:
+        """Records the first occurrence of a milestone, returns its time since start"""
+        elapsed = self.milestones.get(milestone)
+        if elapsed is None:
+            elapsed = self.milestones[milestone] = self.clock() - self.started
+            log.debug("Startup: %s after %.1f ms", milestone, elapsed * 1e3)
+        return elapsed
+
+    @property
+    def first_served(self):
+        """Time to first served register in seconds, None until then"""
+        return self.milestones.get("first_served")
+
+    def report(self) -> dict:
+        """Milestones in milliseconds, in the order they were reached"""
+        return {milestone: round(elapsed * 1e3, 1) for milestone, elapsed in self.milestones.items()}
+
+    # --------------------------
+    # pymodbus server trace hooks
+    # --------------------------
+
+    def trace_packet(self, sending: bool, data: bytes) -> bytes:
+        return data
+
+    def trace_pdu(self, sending: bool, pdu):
+        if (sending and "first_served" not in self.milestones and not pdu.function_code & 0x80
+                and (self.after is None or self.after in self.milestones)):
+            self.mark("first_served")
+            log.info("Time to first served register: %.1f ms (%s)", self.first_served * 1e3,
+                     ", ".join(f"{milestone} {elapsed:g} ms" for milestone, elapsed in self.report().items()))
+        return pdu
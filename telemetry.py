@@ -0,0 +1,339 @@
+"""
+Modbus transaction telemetry
+
+A TransactionMonitor hooks into the trace_packet/trace_pdu callbacks of a
+pymodbus client or server and counts per device:
+- transactions and the round-trip time (client) or service time (server)
+  as histogram
+- timeouts and exception responses by exception code
+- CRC/framing errors, i.e. received bytes that never formed a valid frame
+- bytes on the wire in both directions
+
+Telemetry keeps the monitors of all roles ("reader", "emulator", "proxy",
+"proxy-upstream") and exposes them in Prometheus text format on a local
+HTTP endpoint and as JSON document on <prefix>/diagnostics/modbus.
+"""
+
+import asyncio
+import bisect
+import logging
+import time
+
+from http_endpoint import start_http_server
+
+log = logging.getLogger("dtsu666-telemetry")
+
+# 64 registers take about 150 ms at 9600 baud
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5)
+DEFAULT_HTTP_HOST = "127.0.0.1"
+DEFAULT_HTTP_PORT = 9108
+DEFAULT_MQTT_INTERVAL = 60
+
+
+class Histogram:
+    """Cumulative histogram with fixed bucket bounds"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=RTT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations <= bound) including +Inf"""
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q: float):
+        """Upper bucket bound of quantile q, None without observations"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return None
+
+
+class _DeviceStats:
+    __slots__ = ("rtt", "transactions", "timeouts", "exceptions")
+
+    def __init__(self):
+        self.rtt = Histogram()
+        self.transactions = 0
+        self.timeouts = 0
+        self.exceptions = {}
+
+
+class _Connection:
+    """
+    Open requests of one connection of a TransactionMonitor, keyed by
+    transaction id (always 0 with RTU framing)
+    """
+
+    __slots__ = ("monitor", "pending", "rx_buffered")
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.pending = {}
+        self.rx_buffered = 0
+
+    def trace_packet(self, sending: bool, data: bytes) -> bytes:
+        if sending:
+            self.monitor.bytes_tx += len(data)
+        else:
+            # pymodbus passes the whole receive buffer until a frame is cut off
+            self.rx_buffered = len(data)
+        return data
+
+    def trace_pdu(self, sending: bool, pdu):
+        monitor = self.monitor
+        if sending == monitor.server:
+            # response: sent by a server, received by a client
+            if not sending:
+                monitor.bytes_rx += self.rx_buffered
+                self.rx_buffered = 0
+            pending = self.pending.pop(pdu.transaction_id, None)
+            if pending is not None:
+                device_id, started = pending
+                stats = monitor._device(device_id)
+                stats.transactions += 1
+                stats.rtt.observe(monitor.clock() - started)
+                if pdu.isError():
+                    code = int(getattr(pdu, "exception_code", 0))
+                    stats.exceptions[code] = stats.exceptions.get(code, 0) + 1
+        else:
+            # request: sent by a client, received by a server
+            if sending:
+                self._close_unanswered()
+            else:
+                monitor.bytes_rx += self.rx_buffered
+                self.rx_buffered = 0
+            self.pending[pdu.transaction_id] = (pdu.dev_id, monitor.clock())
+        return pdu
+
+    def _close_unanswered(self):
+        if not self.pending:
+            return
+        monitor = self.monitor
+        if self.rx_buffered:
+            monitor.bytes_rx += self.rx_buffered
+            self.rx_buffered = 0
+            monitor.crc_errors += len(self.pending)
+        else:
+            for device_id, _ in self.pending.values():
+                monitor._device(device_id).timeouts += 1
+        self.pending.clear()
+
+
+class TransactionMonitor:
+    """
+    Counters of one Modbus client or server.
+
+    Pass trace_packet and trace_pdu to the pymodbus client or server. A
+    request that is still open when the next one is sent timed out; if
+    bytes arrived for it without forming a frame, it is counted as
+    CRC/framing error instead.
+
+    A server with several concurrent connections (Modbus TCP) needs the
+    hooks of connection() per connection, so that the requests and
+    receive buffers of different clients are not mixed up.
+    """
+
+    def __init__(self, role: str, server: bool = False, clock=time.perf_counter):
+        self.role = role
+        self.server = server
+        self.clock = clock
+        self.devices = {}
+        self.crc_errors = 0
+        self.bytes_rx = 0
+        self.bytes_tx = 0
+        self._default = _Connection(self)
+
+    def _device(self, device_id: int) -> _DeviceStats:
+        stats = self.devices.get(device_id)
+        if stats is None:
+            stats = self.devices[device_id] = _DeviceStats()
+        return stats
+
+    def connection(self) -> _Connection:
+        """Trace hooks of one more connection, counting into this monitor"""
+        return _Connection(self)
+
+    def trace_packet(self, sending: bool, data: bytes) -> bytes:
+        return self._default.trace_packet(sending, data)
+
+    def trace_pdu(self, sending: bool, pdu):
+        return self._default.trace_pdu(sending, pdu)
+
+    def snapshot(self) -> dict:
+        """Counters as JSON-serializable document"""
+        devices = {}
+        for device_id, stats in sorted(self.devices.items()):
+            devices[str(device_id)] = {
+                "transactions": stats.transactions,
+                "timeouts": stats.timeouts,
+                "exceptions": {f"0x{code:02X}": count for code, count in sorted(stats.exceptions.items())},
+                "rtt_p50": stats.rtt.quantile(0.5),
+                "rtt_p99": stats.rtt.quantile(0.99),
+                "rtt_avg": round(stats.rtt.sum / stats.rtt.count, 4) if stats.rtt.count else None,
+            }
+        return {"crc_errors": self.crc_errors, "bytes_rx": self.bytes_rx, "bytes_tx": self.bytes_tx,
+                "devices": devices}
+
+
+def trace_hooks(*tracers) -> dict:
+    """
+    Keyword arguments that attach tracers (monitors, capture writers) to a
+    pymodbus client or server. None entries are skipped.
+    """
+    tracers = [tracer for tracer in tracers if tracer is not None]
+    if not tracers:
+        return {}
+    if len(tracers) == 1:
+        return {"trace_packet": tracers[0].trace_packet, "trace_pdu": tracers[0].trace_pdu}
+
+    def trace_packet(sending: bool, data: bytes) -> bytes:
+        for tracer in tracers:
+            data = tracer.trace_packet(sending, data)
+        return data
+
+    def trace_pdu(sending: bool, pdu):
+        for tracer in tracers:
+            pdu = tracer.trace_pdu(sending, pdu)
+        return pdu
+
+    return {"trace_packet": trace_packet, "trace_pdu": trace_pdu}
+
+
+def connection_hooks(*tracers):
+    """
+    Factory of the trace hooks of one server connection: tracers that keep
+    per-connection state (TransactionMonitor) get a connection() of their
+    own, the others are shared. None entries are skipped.
+    """
+    def hooks() -> dict:
+        return trace_hooks(*(tracer.connection() if hasattr(tracer, "connection") else tracer
+                             for tracer in tracers if tracer is not None))
+
+    return hooks
+
+
+class Telemetry:
+    """Registry of the transaction monitors of one process"""
+
+    def __init__(self, http_host: str = DEFAULT_HTTP_HOST, http_port: int = DEFAULT_HTTP_PORT,
+                 mqtt_interval: float = DEFAULT_MQTT_INTERVAL):
+        self.http_host = http_host
+        self.http_port = http_port
+        self.mqtt_interval = mqtt_interval
+        self.monitors = {}
+        # startup.StartupTimer of the process, exported as dtsu666_startup_seconds
+        self.startup_timer = None
+        self._server = None
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Creates the registry from cfg["telemetry"], or returns None if it is disabled"""
+        tm_cfg = cfg.get("telemetry", {})
+        if not tm_cfg.get("enabled", False):
+            return None
+        return cls(http_host=tm_cfg.get("http_host", DEFAULT_HTTP_HOST),
+                   http_port=tm_cfg.get("http_port", DEFAULT_HTTP_PORT),
+                   mqtt_interval=tm_cfg.get("mqtt_interval", DEFAULT_MQTT_INTERVAL))
+
+    def monitor(self, role: str, server: bool = False) -> TransactionMonitor:
+        """Returns the monitor of a role, created on first use"""
+        monitor = self.monitors.get(role)
+        if monitor is None:
+            monitor = self.monitors[role] = TransactionMonitor(role, server)
+        return monitor
+
+    def snapshot(self) -> dict:
+        return {role: monitor.snapshot() for role, monitor in self.monitors.items()}
+
+    def render(self) -> str:
+        """All counters in Prometheus text exposition format"""
+        lines = [
+            "# HELP dtsu666_modbus_rtt_seconds Modbus round-trip (client) or service time (server)",
+            "# TYPE dtsu666_modbus_rtt_seconds histogram",
+        ]
+        for role, monitor in self.monitors.items():
+            for device_id, stats in sorted(monitor.devices.items()):
+                labels = f'role="{role}",device="{device_id}"'
+                for bound, total in stats.rtt.cumulative():
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'dtsu666_modbus_rtt_seconds_bucket{{{labels},le="{le}"}} {total}')
+                lines.append(f"dtsu666_modbus_rtt_seconds_sum{{{labels}}} {stats.rtt.sum:.6f}")
+                lines.append(f"dtsu666_modbus_rtt_seconds_count{{{labels}}} {stats.rtt.count}")
+
+        for name, help_text, attribute in (
+                ("transactions", "Completed Modbus transactions", "transactions"),
+                ("timeouts", "Modbus requests without response", "timeouts")):
+            lines.append(f"# HELP dtsu666_modbus_{name}_total {help_text}")
+            lines.append(f"# TYPE dtsu666_modbus_{name}_total counter")
+            for role, monitor in self.monitors.items():
+                for device_id, stats in sorted(monitor.devices.items()):
+                    lines.append(f'dtsu666_modbus_{name}_total{{role="{role}",device="{device_id}"}} '
+                                 f'{getattr(stats, attribute)}')
+
+        lines.append("# HELP dtsu666_modbus_exceptions_total Modbus exception responses by exception code")
+        lines.append("# TYPE dtsu666_modbus_exceptions_total counter")
+        for role, monitor in self.monitors.items():
+            for device_id, stats in sorted(monitor.devices.items()):
+                for code, count in sorted(stats.exceptions.items()):
+                    lines.append(f'dtsu666_modbus_exceptions_total{{role="{role}",device="{device_id}",'
+                                 f'code="0x{code:02X}"}} {count}')
+
+        lines.append("# HELP dtsu666_modbus_crc_errors_total Received bytes that never formed a valid frame")
+        lines.append("# TYPE dtsu666_modbus_crc_errors_total counter")
+        for role, monitor in self.monitors.items():
+            lines.append(f'dtsu666_modbus_crc_errors_total{{role="{role}"}} {monitor.crc_errors}')
+
+        lines.append("# HELP dtsu666_modbus_bytes_total Bytes on the wire")
+        lines.append("# TYPE dtsu666_modbus_bytes_total counter")
+        for role, monitor in self.monitors.items():
+            lines.append(f'dtsu666_modbus_bytes_total{{role="{role}",direction="rx"}} {monitor.bytes_rx}')
+            lines.append(f'dtsu666_modbus_bytes_total{{role="{role}",direction="tx"}} {monitor.bytes_tx}')
+
+        if self.startup_timer is not None:
+            lines.append("# HELP dtsu666_startup_seconds Time from process start to a startup milestone")
+            lines.append("# TYPE dtsu666_startup_seconds gauge")
+            for milestone, elapsed in self.startup_timer.milestones.items():
+                lines.append(f'dtsu666_startup_seconds{{milestone="{milestone}"}} {elapsed:.6f}')
+        return "\n".join(lines) + "\n"
+
+    # --------------------------
+    # Exporters
+    # --------------------------
+
+    def _metrics(self, _query):
+        return "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render().encode()
+
+    async def start_http(self):
+        """Serves the metrics on http://<http_host>:<http_port>/metrics"""
+        self._server = await start_http_server({"/metrics": self._metrics}, self.http_host, self.http_port)
+        log.info("Metrics on http://%s:%i/metrics", self.http_host, self.http_port)
+
+    async def stop_http(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def publish_loop(self, publisher, stop_event: asyncio.Event):
+        """Publishes the snapshot on <prefix>/diagnostics/modbus every mqtt_interval seconds"""
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=self.mqtt_interval)
+            except asyncio.TimeoutError:
+                publisher.publish_diagnostics("modbus", self.snapshot())